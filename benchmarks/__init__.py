@@ -0,0 +1 @@
+"""Benchmarks of the render pipeline, run with `python -m benchmarks.run`."""
@@ -0,0 +1,166 @@
+"""Time each phase of the generation of synthetic templates.
+
+Usage::
+
+    python -m benchmarks.run --files 2000 --repeat 5 --output results.json
+    python -m benchmarks.run --files 2000 --compare results.json
+
+The first run starts from an empty base directory, the next ones reuse it
+and so benefit from the caches, as repeated generations would. Results are
+saved as JSON, along with the commit they were measured at, and can be
+compared with those of another commit.
+"""
+
+import argparse
+import json
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from loguru import logger
+
+from benchmarks.synthetic import TemplateShape, make_git_template, make_template
+from pytemplator.git import GitError, run_git
+from pytemplator.profiling import TraceRecorder
+from pytemplator.pytemplator import Templator
+
+PHASES = (
+    "get_git_template",
+    "prepare_template_dir",
+    "generate_context",
+    "render_templates",
+    "finalize",
+    "add_pytemplator_yaml",
+    "commit",
+)
+
+
+def run_once(location, base_dir, destination_dir, jobs):
+    """Generate the template once, return the duration of each phase."""
+    recorder = TraceRecorder()
+    start = time.perf_counter()
+    templator = Templator(
+        base_dir=base_dir,
+        template_location=location,
+        destination_dir=destination_dir,
+        no_input=True,
+        jobs=jobs,
+        hooks=[recorder],
+    )
+    templator.generate_context()
+    templator.render()
+    timings = recorder.phases()
+    timings["total"] = time.perf_counter() - start
+    return timings
+
+
+def summarize(runs):
+    """Return the minimum and median duration of each phase across the runs."""
+    names = sorted({name for run in runs for name in run})
+    return {
+        name: {
+            "min": min(run.get(name, 0) for run in runs),
+            "median": statistics.median(run.get(name, 0) for run in runs),
+        }
+        for name in names
+    }
+
+
+def current_commit():
+    """Return the commit of pytemplator being benchmarked, if known."""
+    try:
+        return run_git("rev-parse", "HEAD", cwd=Path(__file__).parent)
+    except GitError:
+        return None
+
+
+def benchmark(shape, repeat=3, jobs=1, git=False):
+    """Generate a synthetic template of the given shape `repeat` times.
+
+    With `git`, the template is fetched from a local git repo.
+    Return the results, ready to be saved as JSON.
+    """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = Path(tmpdir)
+        if git:
+            location = f"file://{make_git_template(tmpdir / 'template', shape)}"
+        else:
+            location = str(make_template(tmpdir / "template", shape))
+        runs = []
+        for index in range(repeat):
+            destination_dir = tmpdir / f"output_{index}"
+            destination_dir.mkdir()
+            runs.append(run_once(location, tmpdir / "base", destination_dir, jobs))
+    return {
+        "commit": current_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "shape": shape._asdict(),
+        "jobs": jobs,
+        "git": git,
+        "runs": runs,
+        "summary": summarize(runs),
+    }
+
+
+def compare(results, baseline):
+    """Return a report of the median durations against those of `baseline`."""
+    lines = [f"{'phase':<24}{'baseline':>12}{'current':>12}{'ratio':>8}"]
+    for name, durations in results["summary"].items():
+        current = durations["median"]
+        previous = baseline["summary"].get(name, {}).get("median")
+        if not previous:
+            lines.append(f"{name:<24}{'-':>12}{current:>12.4f}{'-':>8}")
+            continue
+        lines.append(
+            f"{name:<24}{previous:>12.4f}{current:>12.4f}{current / previous:>8.2f}"
+        )
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    """Run the benchmark from the command line."""
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks.run", description=__doc__.split("\n", 1)[0]
+    )
+    defaults = TemplateShape()
+    for field in TemplateShape._fields:
+        parser.add_argument(
+            f"--{field.replace('_', '-')}",
+            type=type(getattr(defaults, field)),
+            default=getattr(defaults, field),
+            help=f"Defaults to {getattr(defaults, field)}",
+        )
+    parser.add_argument("--repeat", type=int, default=3, help="Defaults to 3")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Defaults to 1")
+    parser.add_argument(
+        "--git", action="store_true", help="Fetch the template from a git repo"
+    )
+    parser.add_argument("--output", default=None, help="Save the results as JSON")
+    parser.add_argument(
+        "--compare", default=None, help="JSON results to compare the durations with"
+    )
+    args = parser.parse_args(argv)
+    shape = TemplateShape(
+        **{field: getattr(args, field) for field in TemplateShape._fields}
+    )
+    # The generation logs would drown the results.
+    logger.remove()
+    results = benchmark(shape, repeat=args.repeat, jobs=args.jobs, git=args.git)
+    if args.output:
+        with open(args.output, "w", encoding="UTF-8") as output:
+            json.dump(results, output, indent=2)
+            output.write("\n")
+    if args.compare:
+        with open(args.compare, encoding="UTF-8") as baseline:
+            print(compare(results, json.load(baseline)))
+    else:
+        print(json.dumps(results["summary"], indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,105 @@
+"""Synthetic templates of configurable shape, to benchmark the render pipeline.
+
+The templates are generated deterministically from their shape, so that
+results can be compared between commits.
+"""
+
+import json
+import random
+from pathlib import Path
+from typing import NamedTuple
+
+from pytemplator.git import run_git
+
+
+class TemplateShape(NamedTuple):
+    """Shape of a synthetic template."""
+
+    # How many files are in the templates folder.
+    files: int = 500
+    # How many directories deep the files are nested, at most.
+    depth: int = 4
+    # Approximate size in bytes of each file.
+    file_size: int = 4096
+    # Share of the directory and file names which are templated.
+    templated_paths: float = 0.2
+    # Share of the files which are binary.
+    binary_fraction: float = 0.1
+    # How many keys the context has.
+    context_size: int = 50
+    seed: int = 0
+
+
+def make_context(shape: TemplateShape) -> dict:
+    """Return the context generated by the synthetic template."""
+    return {f"var_{index}": f"value_{index}" for index in range(shape.context_size)}
+
+
+def make_template(directory, shape: TemplateShape) -> Path:
+    """Write a synthetic template of the given shape into `directory`.
+
+    It has an `initialize.py` returning `make_context(shape)` and a
+    `finalize.py` doing nothing, so that every phase is exercised.
+    """
+    directory = Path(directory)
+    rng = random.Random(shape.seed)
+    templates = directory / "templates"
+    templates.mkdir(parents=True)
+    context = make_context(shape)
+    keys = sorted(context)
+    (directory / "initialize.py").write_text(
+        f'"""Synthetic template."""\n\nCONTEXT = {json.dumps(context)}\n\n\n'
+        "def generate_context(no_input):\n"
+        '    """Return the synthetic context."""\n'
+        "    return dict(CONTEXT)\n"
+    )
+    (directory / "finalize.py").write_text(
+        '"""Synthetic template."""\n\n\n'
+        "def finalize(context, output_dir):\n"
+        '    """Do nothing."""\n'
+    )
+    directories = [Path()]
+    for index in range(shape.files):
+        parent = rng.choice(directories)
+        if len(parent.parts) < shape.depth and rng.random() < 0.3:
+            parent = parent / _name(rng, shape, keys, f"dir_{index}")
+            directories.append(parent)
+        path = templates / parent / _name(rng, shape, keys, f"file_{index}")
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if rng.random() < shape.binary_fraction:
+            path.write_bytes(b"\x00" + rng.randbytes(max(shape.file_size - 1, 0)))
+        else:
+            path.write_text(_text(rng, shape, keys))
+    return directory
+
+
+def make_git_template(directory, shape: TemplateShape) -> Path:
+    """Write a synthetic template and commit it on the main branch of a git repo."""
+    directory = make_template(directory, shape)
+    user = ("-c", "user.name=Benchmark", "-c", "user.email=benchmark@example.com")
+    run_git("init", "--quiet", "--initial-branch=main", cwd=directory)
+    run_git("add", "--all", cwd=directory)
+    run_git(*user, "commit", "--quiet", "--message=Synthetic template", cwd=directory)
+    return directory
+
+
+def _name(rng, shape, keys, name):
+    """Return a file or directory name, templated for a share of them."""
+    if rng.random() < shape.templated_paths and keys:
+        return f"{name}_{{{{ {rng.choice(keys)} }}}}"
+    return name
+
+
+def _text(rng, shape, keys):
+    """Return text content of about `file_size` bytes, referring to the context."""
+    lines, size = [], 0
+    while size < shape.file_size:
+        if keys and rng.random() < 0.3:
+            line = f"{rng.choice(keys)} is {{{{ {rng.choice(keys)} }}}}."
+        elif keys and rng.random() < 0.05:
+            line = f"{{% for item in range(3) %}}{{{{ {rng.choice(keys)} }}}}{{% endfor %}}"
+        else:
+            line = " ".join(f"word{rng.randrange(1000)}" for _ in range(8))
+        lines.append(line)
+        size += len(line) + 1
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,413 @@
+"""Caches speeding up repeated generations from the same template."""
+
+import codecs
+import hashlib
+import importlib.util
+import json
+import marshal
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from jinja2 import FileSystemBytecodeCache
+from loguru import logger
+
+from pytemplator import __version__
+from pytemplator.constants import CONTEXT_ALIASES, SNIFF_SIZE
+from pytemplator.manifest import hash_file
+
+# Modules imported by ModuleCache, shared by every Templator of the process.
+_MODULES = {}
+_MODULES_LOCK = threading.Lock()
+
+
+def is_binary_file(path) -> bool:
+    """Tell whether a file is binary by sniffing the start of its content.
+
+    Only the first few kilobytes are read: a file is deemed binary if they
+    contain a NUL byte or are not valid UTF-8. A multi-byte character cut
+    by the end of the prefix is not mistaken for invalid data.
+    """
+    with open(path, "rb") as file:
+        return is_binary_bytes(file.read(SNIFF_SIZE))
+
+
+def is_binary_bytes(data: bytes) -> bool:
+    """Tell whether content is binary from its first SNIFF_SIZE bytes, see `is_binary_file`."""
+    prefix = data[:SNIFF_SIZE]
+    if b"\x00" in prefix:
+        return True
+    try:
+        codecs.getincrementaldecoder("utf-8")().decode(
+            prefix, final=len(prefix) < SNIFF_SIZE
+        )
+    except UnicodeDecodeError:
+        return True
+    return False
+
+
+class FileTypeCache:
+    """Remember which template files are binary.
+
+    Results are stored per template commit when a `path` is given, along
+    with the size and modification time of each file so that a locally
+    edited template is never served stale results.
+    """
+
+    def __init__(self, path=None):
+        """Load the cached results, if any."""
+        self.path = Path(path) if path else None
+        self._entries = {}
+        self._dirty = False
+        if self.path and self.path.exists():
+            try:
+                with open(self.path, encoding="UTF-8") as cache_file:
+                    self._entries = json.load(cache_file)
+            except (OSError, ValueError):
+                self._entries = {}
+
+    def is_binary(self, name, path, stat=None) -> bool:
+        """Tell whether the template file `name`, located at `path`, is binary.
+
+        `stat` saves looking the file up again if already known.
+        """
+        stat = stat or os.stat(path)
+        key = [stat.st_size, stat.st_mtime_ns]
+        entry = self._entries.get(name)
+        if entry and entry[:2] == key:
+            return entry[2]
+        binary = is_binary_file(path)
+        self._entries[name] = key + [binary]
+        self._dirty = True
+        return binary
+
+    def save(self):
+        """Persist the results, if there is anything new."""
+        if not self.path or not self._dirty:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_path, "w", encoding="UTF-8") as cache_file:
+            # Copied first as other threads may still be adding entries.
+            json.dump(dict(self._entries), cache_file)
+        os.replace(tmp_path, self.path)
+        self._dirty = False
+
+
+class BytecodeCache(FileSystemBytecodeCache):
+    """Jinja bytecode cache stored per template, in a directory of its own.
+
+    Each directory holding a single version of a template, the entries are
+    keyed by template name only, which keeps them valid wherever the
+    template happens to be on disk. Jinja still checks the checksum of the
+    source, so an edited template is never served stale bytecode.
+
+    Loading an entry bumps its modification time, which serves as the
+    least recently used marker for `prune_bytecode_cache`.
+    """
+
+    def __init__(self, directory):
+        """Create the cache directory if needed."""
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        super().__init__(str(directory))
+        self.has_new_entries = False
+
+    def get_cache_key(self, name, filename=None):
+        """Key the entries by template name only."""
+        return super().get_cache_key(name)
+
+    def load_bytecode(self, bucket):
+        """Load the bytecode and mark the entry as recently used."""
+        super().load_bytecode(bucket)
+        if bucket.code is not None:
+            try:
+                os.utime(self._get_cache_filename(bucket))
+            except OSError:
+                pass
+
+    def dump_bytecode(self, bucket):
+        """Store the bytecode, keeping track of the cache growing.
+
+        The directory may have been pruned meanwhile by another generation,
+        failing to store the bytecode is never fatal.
+        """
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            super().dump_bytecode(bucket)
+        except OSError as error:
+            logger.debug(f"Could not store bytecode in {self.directory}: {error}")
+            return
+        self.has_new_entries = True
+
+
+def prune_bytecode_cache(directory, max_size):
+    """Evict the least recently used bytecode until the cache fits `max_size`.
+
+    Return the number of bytes freed.
+    """
+    directory = Path(directory)
+    entries = []
+    for root, _, files in os.walk(directory):
+        for name in files:
+            path = Path(root) / name
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+    total_size = sum(size for _, size, _ in entries)
+    freed = 0
+    for _, size, path in sorted(entries):
+        if total_size - freed <= max_size:
+            break
+        try:
+            path.unlink()
+        except OSError:
+            continue
+        freed += size
+    for root, _, _ in os.walk(directory, topdown=False):
+        if Path(root) != directory:
+            try:
+                os.rmdir(root)
+            except OSError:
+                # Not empty
+                pass
+    if freed:
+        logger.debug(f"Evicted {freed} bytes from the bytecode cache.")
+    return freed
+
+
+class OutputCache:
+    """Rendered outputs of templates, to generate them again without rendering.
+
+    Each entry is keyed by the template commit, the context and the version
+    of pytemplator, see `key`. It is a directory under `directory` holding
+    the rendered files in `files`, along with `entry.json` recording the
+    content hash, size and modification time of each of them. The files
+    are hardlinked into the outputs when possible, so an entry whose files
+    got edited in place is discarded rather than served.
+
+    Using an entry bumps the modification time of its directory, which
+    serves as the least recently used marker for `prune_output_cache`.
+    """
+
+    def __init__(self, directory):
+        """Set the directory of the entries."""
+        self.directory = Path(directory)
+        self.has_new_entries = False
+
+    @staticmethod
+    def key(commit, context) -> str:
+        """Return the key of the output of the template at `commit` for `context`.
+
+        The aliases of the context, which refer to the context itself, are
+        left out.
+        """
+        context = {
+            key: value for key, value in context.items() if key not in CONTEXT_ALIASES
+        }
+        canonical = json.dumps(
+            [commit, context, __version__], sort_keys=True, default=str
+        )
+        return hashlib.sha256(canonical.encode("UTF-8")).hexdigest()
+
+    def files_dir(self, key) -> Path:
+        """Return the directory holding the files of the entry."""
+        return self.directory / key / "files"
+
+    def get(self, key):
+        """Return the content hash of each file of the entry by path, None if missing."""
+        entry_dir = self.directory / key
+        try:
+            with open(entry_dir / "entry.json", encoding="UTF-8") as entry_file:
+                files = json.load(entry_file)["files"]
+        except (OSError, ValueError, KeyError):
+            return None
+        files_dir = self.files_dir(key)
+        for path, (_, size, mtime_ns) in files.items():
+            try:
+                stat = os.stat(files_dir / path)
+            except OSError:
+                stat = None
+            if stat is None or (stat.st_size, stat.st_mtime_ns) != (size, mtime_ns):
+                logger.warning(f"Discarding the cached output {key}, {path} changed.")
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                return None
+        try:
+            os.utime(entry_dir)
+        except OSError:
+            pass
+        return {path: digest for path, (digest, _, _) in files.items()}
+
+    @contextmanager
+    def store(self, key):
+        """Yield a directory to render the output into, then store it as the entry.
+
+        Nothing is stored if rendering fails. If another generation stored
+        the same entry meanwhile, it is kept.
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        tmp_dir = Path(tempfile.mkdtemp(prefix=".tmp-", dir=self.directory))
+        try:
+            files_dir = tmp_dir / "files"
+            files_dir.mkdir()
+            yield files_dir
+            files = {}
+            for root, _, names in os.walk(files_dir):
+                for name in names:
+                    path = Path(root) / name
+                    stat = path.stat()
+                    files[path.relative_to(files_dir).as_posix()] = [
+                        hash_file(path),
+                        stat.st_size,
+                        stat.st_mtime_ns,
+                    ]
+            with open(tmp_dir / "entry.json", "w", encoding="UTF-8") as entry_file:
+                json.dump(
+                    {"files": files, "size": sum(file[1] for file in files.values())},
+                    entry_file,
+                )
+            try:
+                os.rename(tmp_dir, self.directory / key)
+            except OSError:
+                logger.debug(f"The output {key} got cached meanwhile.")
+            else:
+                self.has_new_entries = True
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def prune_output_cache(directory, max_size, max_age):
+    """Evict the cached outputs unused for `max_age` seconds.
+
+    Then evict the least recently used ones until the cache fits `max_size`.
+    Return the number of bytes freed.
+    """
+    directory = Path(directory)
+    if not directory.is_dir():
+        return 0
+    now = time.time()
+    entries = []
+    for entry in os.scandir(directory):
+        try:
+            last_used = entry.stat().st_mtime
+        except OSError:
+            continue
+        try:
+            with open(Path(entry.path) / "entry.json", encoding="UTF-8") as entry_file:
+                size = json.load(entry_file)["size"]
+        except (OSError, ValueError, KeyError):
+            # Being stored, or broken if too old to still be.
+            size = None
+        entries.append((last_used, size or 0, entry.path, size is None))
+    total_size = sum(size for _, size, _, _ in entries)
+    freed = 0
+    for last_used, size, path, incomplete in sorted(entries):
+        expired = now - last_used > max_age
+        if incomplete and not expired:
+            continue
+        if not expired and total_size - freed <= max_size:
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        freed += size
+    if freed:
+        logger.debug(f"Evicted {freed} bytes from the output cache.")
+    return freed
+
+
+class ModuleCache:
+    """Import the `initialize.py` and `finalize.py` of templates once per process.
+
+    The modules are kept in memory, keyed by the resolved path of their file
+    along with its size and modification time, or by their content when read
+    from TemplateFiles, and shared by every Templator of the process. Each
+    is registered in `sys.modules` under a name unique to its content, so
+    that the modules of different templates never collide.
+
+    Their compiled code is stored in `directory`, keyed by content hash,
+    so that the next processes don't compile them again. Loading an entry
+    bumps its modification time, see `prune_bytecode_cache`.
+    """
+
+    def __init__(self, directory):
+        """Set the directory of the compiled code."""
+        self.directory = Path(directory)
+
+    def import_file(self, name, path):
+        """Return the module `name` of the file at `path`, imported once while unchanged."""
+        path = Path(path).resolve(strict=True)
+        stat = path.stat()
+        return self._import(
+            name,
+            (str(path), stat.st_size, stat.st_mtime_ns),
+            path.read_bytes,
+            str(path),
+        )
+
+    def import_source(self, name, source: bytes, filename):
+        """Return the module `name` of `source`, imported once.
+
+        `filename` is only used in tracebacks.
+        """
+        return self._import(
+            name,
+            (filename, hashlib.sha256(source).hexdigest()),
+            lambda: source,
+            filename,
+        )
+
+    def _import(self, name, key, read_source, filename):
+        """Return the module imported under `key`, importing it if needed."""
+        with _MODULES_LOCK:
+            if key not in _MODULES:
+                source = read_source()
+                digest = hashlib.sha256(
+                    filename.encode("UTF-8") + b"\0" + source
+                ).hexdigest()
+                _MODULES[key] = _execute_module(
+                    f"_pytemplator_{name}_{digest[:16]}",
+                    self._compile(digest, source, filename),
+                    filename,
+                )
+            return _MODULES[key]
+
+    def _compile(self, digest, source, filename):
+        """Return the code of `source`, loaded from `directory` if compiled before."""
+        path = self.directory / f"{digest}.pyc"
+        try:
+            data = path.read_bytes()
+            if data.startswith(importlib.util.MAGIC_NUMBER):
+                code = marshal.loads(data.removeprefix(importlib.util.MAGIC_NUMBER))
+                os.utime(path)
+                return code
+        except (OSError, EOFError, ValueError, TypeError):
+            pass
+        code = compile(source, filename, "exec", dont_inherit=True)
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+            tmp_path.write_bytes(importlib.util.MAGIC_NUMBER + marshal.dumps(code))
+            os.replace(tmp_path, path)
+        except OSError as error:
+            logger.debug(f"Could not store the code of {filename}: {error}")
+        return code
+
+
+def _execute_module(module_name, code, filename):
+    """Execute `code` as a new module registered in `sys.modules`."""
+    spec = importlib.util.spec_from_loader(module_name, loader=None, origin=filename)
+    module = importlib.util.module_from_spec(spec)
+    module.__file__ = filename
+    sys.modules[module_name] = module
+    try:
+        exec(code, module.__dict__)  # pylint: disable=exec-used
+    except BaseException:
+        del sys.modules[module_name]
+        raise
+    return module
@@ -1,17 +1,336 @@
-"""Console script for pytemplator."""
+"""Console script for pytemplator.
 
+The CLI is run many times a day, e.g. from CI, so that its startup time
+matters: the dependencies are only imported once the arguments are parsed,
+by the command actually needing them. `tests/test_cli.py` holds the line.
+"""
+
+# pylint: disable=import-outside-toplevel
 import argparse
+import os
 import sys
-from distutils.util import strtobool
+from contextlib import contextmanager
+from pathlib import Path
+
+from pytemplator.constants import (
+    BYTECODE_CACHE_MAX_SIZE,
+    NO_SET,
+    OUTPUT_CACHE_MAX_AGE,
+    OUTPUT_CACHE_MAX_SIZE,
+    YES_SET,
+)
+
+
+def strtobool(value):
+    """Parse the value of a boolean flag, as `distutils.util.strtobool` did."""
+    value = value.lower()
+    if value in YES_SET | NO_SET:
+        return value in YES_SET
+    raise argparse.ArgumentTypeError(f"invalid truth value {value!r}")
+
+
+@contextmanager
+def open_output(path):
+    """Open the file at `path` for writing, `-` standing for the standard output."""
+    if path == "-":
+        yield sys.stdout.buffer
+        return
+    with open(path, "wb") as output:
+        yield output
+
+
+@contextmanager
+def profiling(trace_path=None, cprofile_path=None):
+    """Yield the hooks to profile the generation with, if asked to.
+
+    On exit, the timing events are saved as a Chrome trace at `trace_path`
+    and the cProfile statistics at `cprofile_path`. The slowest phases and
+    files are logged.
+    """
+    if not trace_path and not cprofile_path:
+        yield []
+        return
+    import cProfile
+
+    from loguru import logger
+
+    from pytemplator.profiling import TraceRecorder
+
+    recorder = TraceRecorder()
+    profiler = cProfile.Profile() if cprofile_path else None
+    if profiler:
+        profiler.enable()
+    try:
+        yield [recorder]
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(cprofile_path)
+            logger.info(f"cProfile statistics saved to {cprofile_path}")
+        if trace_path:
+            recorder.save(trace_path)
+            logger.info(f"Trace saved to {trace_path}")
+        logger.info(
+            "\nPhases:\n\t{}".format(
+                "\n\t".join(
+                    f"{duration * 1000:10.1f} ms  {name}"
+                    for name, duration in recorder.phases().items()
+                )
+            )
+        )
+        slowest = recorder.slowest_files()
+        if slowest:
+            logger.warning(
+                "\nSlowest files:\n\t{}".format(
+                    "\n\t".join(
+                        f"{duration * 1000:10.1f} ms  {path}"
+                        for path, duration in slowest
+                    )
+                )
+            )
+
+
+def cache(argv):
+    """Manage the caches kept in the base directory."""
+    parser = argparse.ArgumentParser(prog="pytemplate cache")
+    parser.add_argument(
+        "-b",
+        "--base-dir",
+        default=None,
+        help="The pytemplator base directory (defaults to $HOME/.pytemplator)",
+    )
+    subparsers = parser.add_subparsers(dest="action", required=True)
+    prune = subparsers.add_parser(
+        "prune",
+        help="Evict the least recently used compiled templates and cached outputs.",
+    )
+    prune.add_argument(
+        "--max-size",
+        type=int,
+        default=BYTECODE_CACHE_MAX_SIZE,
+        help=(
+            "The size in bytes the bytecode cache should be brought under, "
+            "use 0 to empty it."
+        ),
+    )
+    prune.add_argument(
+        "--max-output-size",
+        type=int,
+        default=OUTPUT_CACHE_MAX_SIZE,
+        help=(
+            "The size in bytes the cache of rendered outputs should be brought "
+            "under, use 0 to empty it."
+        ),
+    )
+    prune.add_argument(
+        "--max-output-age",
+        type=float,
+        default=OUTPUT_CACHE_MAX_AGE,
+        help="How many seconds a cached output is kept unused, defaults to a week.",
+    )
+    args = parser.parse_args(argv)
+    from loguru import logger
+
+    from pytemplator.cache import prune_bytecode_cache, prune_output_cache
+
+    base_dir = Path(args.base_dir) if args.base_dir else Path.home() / ".pytemplator"
+    freed = prune_bytecode_cache(base_dir / "cache" / "bytecode", args.max_size)
+    freed += prune_output_cache(
+        base_dir / "cache" / "outputs", args.max_output_size, args.max_output_age
+    )
+    logger.info(f"Freed {freed} bytes.")
+    return 0
+
+
+def parse_assignment(assignment):
+    """Parse a KEY=VALUE context assignment, the value being read as YAML."""
+    key, sign, value = assignment.partition("=")
+    if not sign or not key:
+        raise argparse.ArgumentTypeError(f"{assignment} is not of the form KEY=VALUE")
+    import yaml
+
+    return key, yaml.safe_load(value)
+
+
+def update(argv):
+    """Update a generated project to the latest version of its template."""
+    parser = argparse.ArgumentParser(
+        prog="pytemplate update",
+        description=(
+            "Re-render the files whose template changed since the project was "
+            "generated and merge them into the project, keeping local edits."
+        ),
+    )
+    parser.add_argument(
+        "-b",
+        "--base-dir",
+        default=None,
+        help="The pytemplator base directory (defaults to $HOME/.pytemplator)",
+    )
+    parser.add_argument(
+        "-c",
+        "--checkout-branch",
+        default=None,
+        help="Which ref of the template to update to, defaults to the recorded one",
+    )
+    parser.add_argument(
+        "-d",
+        "--project-dir",
+        default=".",
+        help="The directory of the project to update, defaults to the current one",
+    )
+    parser.add_argument(
+        "--set",
+        dest="context_overrides",
+        type=parse_assignment,
+        action="append",
+        default=[],
+        metavar="KEY=VALUE",
+        help="Change the value of a context key, can be repeated",
+    )
+    parser.add_argument(
+        "--no-input",
+        type=strtobool,
+        nargs="?",
+        const=True,
+        default=False,
+        help="If this flag is present, there is no prompt for user input.",
+    )
+    args = parser.parse_args(argv)
+    from loguru import logger
+
+    from pytemplator.update import update_project
+
+    report = update_project(
+        project_dir=args.project_dir,
+        base_dir=args.base_dir,
+        checkout_branch=args.checkout_branch,
+        context_overrides=dict(args.context_overrides),
+        no_input=args.no_input,
+    )
+    for title, paths in report._asdict().items():
+        if paths:
+            logger.info("\n{}:\n\t{}".format(title.title(), "\n\t".join(paths)))
+    if report.conflicts:
+        logger.error("\nThe conflicts must be resolved by hand.")
+        return 1
+    logger.info("\nSuccess!")
+    return 0
+
+
+def serve(argv):
+    """Serve the generation of projects over HTTP, keeping templates warm."""
+    parser = argparse.ArgumentParser(
+        prog="pytemplate serve",
+        description=(
+            "Generate projects on request, keeping the templates loaded in memory. "
+            "POST a JSON body to /render with the keys `template`, `branch`, "
+            "`context` and either `destination` or `archive`."
+        ),
+    )
+    parser.add_argument(
+        "-b",
+        "--base-dir",
+        default=None,
+        help="The pytemplator base directory (defaults to $HOME/.pytemplator)",
+    )
+    parser.add_argument(
+        "-d",
+        "--destination-root",
+        default=".",
+        help=(
+            "The directory the requested destinations are relative to, nothing is "
+            "written outside of it. Defaults to the current working directory."
+        ),
+    )
+    parser.add_argument("--host", default="127.0.0.1", help="Defaults to 127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000, help="Defaults to 8000")
+    parser.add_argument(
+        "--socket", default=None, help="Listen on this Unix socket instead of TCP"
+    )
+    parser.add_argument(
+        "--fetch-ttl",
+        type=float,
+        default=60,
+        help=(
+            "How many seconds a loaded git template is used before fetching its "
+            "branch again, defaults to 60."
+        ),
+    )
+    parser.add_argument(
+        "--offline",
+        type=strtobool,
+        nargs="?",
+        const=True,
+        default=False,
+        help="If this flag is present, git templates are never fetched.",
+    )
+    parser.add_argument(
+        "--token",
+        default=os.environ.get("PYTEMPLATOR_SERVER_TOKEN"),
+        help=(
+            "Require the requests to carry this bearer token, defaults to the "
+            "PYTEMPLATOR_SERVER_TOKEN environment variable."
+        ),
+    )
+    parser.add_argument(
+        "--allow-template",
+        action="append",
+        default=[],
+        dest="allowed_templates",
+        metavar="PATTERN",
+        help=(
+            "Only render the template locations matching this glob pattern, "
+            "can be repeated. Any template can be rendered by default."
+        ),
+    )
+    args = parser.parse_args(argv)
+    from loguru import logger
 
-from loguru import logger
+    from pytemplator.server import (
+        GenerationServer,
+        TemplatePool,
+        UnixGenerationServer,
+    )
 
-from pytemplator.pytemplator import Templator
+    pool = TemplatePool(args.base_dir, fetch_ttl=args.fetch_ttl, offline=args.offline)
+    security = {"token": args.token, "allowed_templates": args.allowed_templates}
+    if args.socket:
+        server = UnixGenerationServer(
+            args.socket, pool, args.destination_root, **security
+        )
+        logger.info(f"Serving on {args.socket}")
+    else:
+        server = GenerationServer(
+            (args.host, args.port), pool, args.destination_root, **security
+        )
+        logger.info(f"Serving on http://{args.host}:{server.server_port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        pool.close()
+    return 0
 
 
-def main():
+def main(argv=None):
     """Console script for pytemplator."""
-    parser = argparse.ArgumentParser()
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ["cache"]:
+        return cache(argv[1:])
+    if argv[:1] == ["update"]:
+        return update(argv[1:])
+    if argv[:1] == ["serve"]:
+        return serve(argv[1:])
+    parser = argparse.ArgumentParser(
+        epilog=(
+            "Use `pytemplate update` to update a generated project, "
+            "`pytemplate serve` to run a generation server and "
+            "`pytemplate cache prune` to trim the cache of compiled templates."
+        )
+    )
     parser.add_argument(
         "-b",
         "--base-dir",
@@ -36,6 +355,16 @@ def main():
             "defaults to the current working directory"
         ),
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help=(
+            "How many files to render concurrently, defaults to 1. Rendering is "
+            "done in separate processes whenever the context allows it."
+        ),
+    )
     parser.add_argument(
         "--no-input",
         type=strtobool,
@@ -48,17 +377,196 @@ def main():
             "all the variables have default values set."
         ),
     )
+    parser.add_argument(
+        "--offline",
+        type=strtobool,
+        nargs="?",
+        const=True,
+        default=False,
+        help=(
+            "If this flag is present, a git template is never fetched and its "
+            "cached version is used."
+        ),
+    )
+    parser.add_argument(
+        "--fetch-ttl",
+        type=float,
+        default=0,
+        help=(
+            "How many seconds a fetched git template is considered fresh and "
+            "used without fetching it again, defaults to 0."
+        ),
+    )
+    parser.add_argument(
+        "--no-checkout",
+        dest="checkout",
+        action="store_false",
+        help=(
+            "If this flag is present, a git template is read straight from the "
+            "objects of its commit instead of being checked out."
+        ),
+    )
+    parser.add_argument(
+        "--durable",
+        type=strtobool,
+        nargs="?",
+        const=True,
+        default=False,
+        help=(
+            "If this flag is present, the generated files are flushed to disk "
+            "before the generation completes, so that they survive a crash of "
+            "the machine. This costs a syncfs of the filesystem of the destination, "
+            "which flushes any other pending writes to it too, or a sync of every "
+            "filesystem where syncfs isn't available, plus an fsync per directory."
+        ),
+    )
+    parser.add_argument(
+        "--cache-outputs",
+        type=strtobool,
+        nargs="?",
+        const=True,
+        default=False,
+        help=(
+            "If this flag is present, the rendered output of a git template is "
+            "cached in the base directory and generating it again with the same "
+            "context only links the cached files, finalize.py still being run "
+            "unless it sets CACHEABLE = True."
+        ),
+    )
+    parser.add_argument(
+        "--contexts",
+        default=None,
+        help=(
+            "A JSON Lines or YAML file listing contexts. The template is then "
+            "rendered once per context, each output in a subdirectory of the "
+            "destination directory named after the `_destination` key of its "
+            "context, or its index."
+        ),
+    )
+    parser.add_argument(
+        "--archive",
+        default=None,
+        help=(
+            "Write the generated project into this archive instead of the "
+            "destination directory, a zip if its name ends in .zip and a gzipped "
+            "tarball otherwise. Use - for the standard output."
+        ),
+    )
+    parser.add_argument(
+        "--plan",
+        action="store_true",
+        help=(
+            "Print as JSON the files which would be generated, with their size "
+            "and content hash, and whether they would be created, modified or "
+            "left unchanged, along with the files which would be deleted. "
+            "Nothing is written, finalize.py is not run."
+        ),
+    )
+    parser.add_argument(
+        "--profile",
+        default=None,
+        metavar="TRACE_FILE",
+        help=(
+            "Time each phase of the generation and each file, and save the "
+            "timings as a Chrome trace file (see chrome://tracing or "
+            "https://ui.perfetto.dev). The slowest files are listed."
+        ),
+    )
+    parser.add_argument(
+        "--cprofile",
+        default=None,
+        metavar="STATS_FILE",
+        help="Also profile the generation with cProfile, saving its statistics.",
+    )
     parser.add_argument(
         "template_location",
         help=(
             "The location of the template to use, can be either a repo url or "
-            "its path on the filesystem."
+            "its path on the filesystem, a directory or a zip or tar archive."
         ),
     )
-    args = parser.parse_args()
-    templator = Templator(**vars(args))
+    args = vars(parser.parse_args(argv))
+    contexts = args.pop("contexts")
+    archive = args.pop("archive")
+    trace_path, cprofile_path = args.pop("profile"), args.pop("cprofile")
+    plan = args.pop("plan")
+    if contexts and archive:
+        parser.error("--archive can't be used along with --contexts")
+    if plan and archive:
+        parser.error("--archive can't be used along with --plan")
+    with profiling(trace_path, cprofile_path) as hooks:
+        return generate(args, contexts, archive, plan, hooks)
+
+
+def print_plans(results):
+    """Print the plans of the outputs as JSON, or the errors which prevented them."""
+    import json
+
+    plans = [
+        result.plan.as_dict()
+        if result.success
+        else {
+            "destination_dir": str(result.destination_dir),
+            "error": repr(result.error),
+        }
+        for result in results
+    ]
+    json.dump(plans if len(plans) != 1 else plans[0], sys.stdout, indent=2)
+    sys.stdout.write("\n")
+
+
+def generate(
+    args, contexts, archive, plan, hooks
+):  # pylint: disable=too-many-arguments
+    """Generate the project(s) as told by the parsed command line `args`.
+
+    With `plan`, the files the generation would write are printed instead.
+    """
+    from loguru import logger
+
+    from pytemplator.pytemplator import RenderResult, Templator
+
+    templator = Templator(**args, hooks=hooks)
+    if contexts:
+        from pytemplator.utils import load_contexts
+
+        if plan:
+            results = templator.plan_many(
+                load_contexts(contexts), templator.destination_dir
+            )
+            print_plans(results)
+        else:
+            results = templator.render_many(
+                load_contexts(contexts), templator.destination_dir
+            )
+        failures = [result for result in results if not result.success]
+        if failures:
+            logger.error(
+                "\n{} out of {} outputs failed:\n\t{}".format(
+                    len(failures),
+                    len(results),
+                    "\n\t".join(
+                        f"{result.destination_dir}: {result.error!r}"
+                        for result in failures
+                    ),
+                )
+            )
+            return 1
+        logger.info(
+            f"\nSuccess! {len(results)} outputs {'planned' if plan else 'generated'}."
+        )
+        return 0
     templator.generate_context()
-    templator.render()
+    if plan:
+        print_plans([RenderResult(templator.destination_dir, None, templator.plan())])
+        return 0
+    if archive:
+        from pytemplator.sinks import open_archive_sink
+
+        with open_output(archive) as output, open_archive_sink(output, archive) as sink:
+            templator.render(sink)
+    else:
+        templator.render()
     logger.info("\nSuccess!")
     return 0
 
@@ -2,12 +2,46 @@
 
 import re
 
-YES_SET = {"y", "yes", "true", "on", "yep", "yeah", "ok"}
+# Also every value accepted by the former `distutils.util.strtobool`.
+YES_SET = {"y", "yes", "t", "true", "on", "1", "yep", "yeah", "ok"}
+NO_SET = {"n", "no", "f", "false", "off", "0", "nope"}
 GIT_REGEX = re.compile(
-    r"((git|ssh|http(s)?)|(git@[\w\.]+))(:(//)?)([\w\.@\:/\-~]+)(\.git)?(/)?"
+    r"((git|ssh|file|http(s)?)|(git@[\w\.]+))(:(//)?)([\w\.@\:/\-~]+)(\.git)?(/)?"
 )
 RESERVED_DIR_NAMES = {
     "hooks",
     "__pycache__",
     ".git",
 }
+# Glob patterns, one per line, of the template files left out of the generation
+IGNORE_FILE = ".pytemplatorignore"
+# Always left out: bytecode, OS metadata and editor backup or swap files
+DEFAULT_IGNORE_PATTERNS = (
+    "__pycache__/",
+    "*.py[co]",
+    ".DS_Store",
+    "*~",
+    ".*.sw[op]",
+    ".#*",
+)
+# Records the template and context a project was generated with
+CONFIG_FILE = ".pytemplator.yml"
+# Content hashes of the generated files, written next to .pytemplator.yml
+MANIFEST_FILE = ".pytemplator-manifest.json"
+# Prefix of the directories the files are generated into before being moved in place
+STAGING_DIR_PREFIX = ".pytemplator-staging-"
+# Names under which the whole context is also available in templates
+CONTEXT_ALIASES = {"pytemplator", "cookiecutter"}
+JINJA_MARKERS = ("{{", "{%", "{#")
+# ioctl request cloning a file on copy-on-write filesystems, see ioctl_ficlone(2)
+FICLONE = 0x40049409
+# How many bytes are read to tell whether a template file is binary
+SNIFF_SIZE = 8192
+# Rendered outputs larger than this many characters are streamed to disk
+STREAMING_THRESHOLD = 1024 * 1024
+STREAMING_BUFFER_SIZE = 256 * 1024
+# Maximum size in bytes of the Jinja bytecode cache kept in the base directory
+BYTECODE_CACHE_MAX_SIZE = 256 * 1024 * 1024
+# Maximum size in bytes and age in seconds of the rendered outputs kept in the base directory
+OUTPUT_CACHE_MAX_SIZE = 1024 * 1024 * 1024
+OUTPUT_CACHE_MAX_AGE = 7 * 24 * 3600
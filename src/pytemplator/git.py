@@ -0,0 +1,313 @@
+"""Git helpers keeping a cheap local copy of remote templates.
+
+Each remote template is fetched into a bare mirror in the base directory,
+shallowly and without any file content (blobs are only downloaded when a
+commit gets checked out). Every commit used is then materialised as a
+worktree of this mirror, or read straight from its objects.
+
+Changes to a mirror and its worktrees are serialised by `mirror_lock`, so
+that several generations, in threads or processes, can share them.
+"""
+
+import json
+import os
+import subprocess
+import tarfile
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+FETCH_TIMES_FILE = "pytemplator_fetch_times.json"
+_MIRROR_LOCKS = {}
+_MIRROR_LOCKS_LOCK = threading.Lock()
+
+
+class GitError(Exception):
+    """Exception returned when a git command fails."""
+
+    def __init__(self, error: subprocess.CalledProcessError):
+        """Keep the output of the git command for the error message."""
+        self.stderr = (error.stderr or "").strip()
+        super().__init__(f"{' '.join(error.cmd)}: {self.stderr}")
+
+
+def run_git(*args, cwd=None, stdin=None) -> str:
+    """Run a git command and return its output.
+
+    Raise GitError if it fails.
+    """
+    try:
+        return subprocess.run(
+            ["git", *args],
+            cwd=cwd,
+            input=stdin,
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+    except subprocess.CalledProcessError as error:
+        raise GitError(error) from error
+
+
+def directory_size(path) -> int:
+    """Return the total size in bytes of the files under `path`."""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                continue
+    return total
+
+
+def mirror_ref(ref: str) -> str:
+    """Return the ref under which a fetched branch/tag/commit is kept."""
+    return f"refs/pytemplator/{ref}"
+
+
+def fetch_into_mirror(mirror: Path, url: str, ref: str) -> int:
+    """Fetch the tip of `ref` from `url` into the bare `mirror`.
+
+    The mirror is created if needed. Only the single commit pointed at by
+    `ref` is fetched, without its history nor any file content.
+    Return the number of bytes transferred.
+    """
+    if not (mirror / "HEAD").exists():
+        mirror.mkdir(parents=True, exist_ok=True)
+        run_git("init", "--bare", "--quiet", str(mirror))
+        run_git("remote", "add", "origin", url, cwd=mirror)
+    size_before = directory_size(mirror / "objects")
+    run_git(
+        "fetch",
+        "--depth=1",
+        "--filter=blob:none",
+        "--no-tags",
+        "--quiet",
+        "origin",
+        f"+{ref}:{mirror_ref(ref)}",
+        cwd=mirror,
+    )
+    record_fetch_time(mirror, ref)
+    return max(directory_size(mirror / "objects") - size_before, 0)
+
+
+def fetch_missing_blobs(mirror: Path, commit: str) -> int:
+    """Download the file contents of `commit` missing from the mirror, all at once.
+
+    Reading them one by one from a blobless mirror would fetch each of them
+    separately. Servers refusing such a fetch leave them to be fetched
+    lazily. Return the number of bytes transferred.
+    """
+    missing = [
+        line[1:]
+        for line in run_git(
+            "rev-list", "--objects", "--missing=print", commit, cwd=mirror
+        ).splitlines()
+        if line.startswith("?")
+    ]
+    if not missing:
+        return 0
+    size_before = directory_size(mirror / "objects")
+    try:
+        run_git(
+            "-c",
+            "fetch.negotiationAlgorithm=noop",
+            "fetch",
+            "--no-tags",
+            "--no-write-fetch-head",
+            "--recurse-submodules=no",
+            "--filter=blob:none",
+            "--stdin",
+            "origin",
+            cwd=mirror,
+            stdin="\n".join(missing) + "\n",
+        )
+    except GitError:
+        return 0
+    return max(directory_size(mirror / "objects") - size_before, 0)
+
+
+def record_fetch_time(mirror: Path, ref: str):
+    """Record that `ref` has just been fetched into the mirror."""
+    fetch_times = _read_fetch_times(mirror)
+    fetch_times[ref] = time.time()
+    tmp_path = mirror / f"{FETCH_TIMES_FILE}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="UTF-8") as times_file:
+        json.dump(fetch_times, times_file)
+    os.replace(tmp_path, mirror / FETCH_TIMES_FILE)
+
+
+def seconds_since_fetch(mirror: Path, ref: str):
+    """Return how long ago `ref` was fetched into the mirror, None if never."""
+    fetch_time = _read_fetch_times(mirror).get(ref)
+    if fetch_time is None or not has_ref(mirror, ref):
+        return None
+    return time.time() - fetch_time
+
+
+def _read_fetch_times(mirror: Path) -> dict:
+    """Return the time each ref was last fetched into the mirror."""
+    try:
+        with open(mirror / FETCH_TIMES_FILE, encoding="UTF-8") as times_file:
+            return json.load(times_file)
+    except (OSError, ValueError):
+        return {}
+
+
+@contextmanager
+def mirror_lock(mirror: Path):
+    """Hold the lock on changes to `mirror` and its worktrees.
+
+    It is taken by one thread at a time, and by one process at a time
+    through a file lock next to the mirror, which may not exist yet.
+    """
+    mirror = Path(mirror).absolute()
+    with _MIRROR_LOCKS_LOCK:
+        lock = _MIRROR_LOCKS.setdefault(mirror, threading.Lock())
+    with lock:
+        mirror.parent.mkdir(parents=True, exist_ok=True)
+        with open(mirror.with_name(f"{mirror.name}.lock"), "ab") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+
+def fetched_commit(mirror: Path, ref: str) -> str:
+    """Return the commit `ref` was last fetched at."""
+    return run_git("rev-parse", mirror_ref(ref), cwd=mirror)
+
+
+def checkout_worktree(mirror: Path, worktree: Path, commit: str) -> int:
+    """Materialise `commit` of `mirror` as a clean `worktree`, with `mirror_lock` held.
+
+    The worktree is only touched again if it was changed since, to discard
+    the changes: other generations may be reading from it. The file contents
+    are downloaded at this point, only for this commit. Return the number of
+    bytes transferred.
+    """
+    size_before = directory_size(mirror / "objects")
+    if (worktree / ".git").exists():
+        status = run_git(
+            "--no-optional-locks",
+            "status",
+            "--porcelain",
+            "--ignored",
+            "--untracked-files=all",
+            cwd=worktree,
+        )
+        if status:
+            run_git("checkout", "--quiet", "--force", "--detach", commit, cwd=worktree)
+            run_git("clean", "--quiet", "--force", "-d", "-x", cwd=worktree)
+    else:
+        # Forget about worktrees whose directory was deleted by hand.
+        run_git("worktree", "prune", cwd=mirror)
+        worktree.parent.mkdir(parents=True, exist_ok=True)
+        run_git(
+            "worktree",
+            "add",
+            "--quiet",
+            "--force",
+            "--detach",
+            str(worktree),
+            commit,
+            cwd=mirror,
+        )
+    return max(directory_size(mirror / "objects") - size_before, 0)
+
+
+def has_ref(mirror: Path, ref: str) -> bool:
+    """Tell whether `ref` has already been fetched into the mirror."""
+    try:
+        run_git("rev-parse", "--verify", "--quiet", mirror_ref(ref), cwd=mirror)
+    except (GitError, FileNotFoundError):
+        return False
+    return True
+
+
+def has_commit(repo_dir: Path, commit: str) -> bool:
+    """Tell whether `commit` is available in the repo."""
+    try:
+        run_git("cat-file", "-e", f"{commit}^{{commit}}", cwd=repo_dir)
+    except GitError:
+        return False
+    return True
+
+
+def changed_paths(repo_dir: Path, commit: str) -> set:
+    """Return the files which changed between `commit` and the working tree.
+
+    Only the tree objects are compared, no file content is needed. The paths
+    are relative to `repo_dir`, which may be a subdirectory of the repo.
+    """
+    output = run_git(
+        "diff",
+        "--name-only",
+        "--relative",
+        "--no-renames",
+        commit,
+        "--",
+        ".",
+        cwd=repo_dir,
+    )
+    return set(output.splitlines())
+
+
+def export_tree(repo_dir: Path, commit: str, destination: Path):
+    """Write the files of `repo_dir` as they were at `commit` into `destination`.
+
+    The repo itself is left untouched, no worktree or checkout being involved.
+    """
+    prefix = run_git("rev-parse", "--show-prefix", cwd=repo_dir)
+    with subprocess.Popen(
+        ["git", "archive", "--format=tar", f"{commit}:{prefix}"],
+        cwd=repo_dir,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    ) as process:
+        with tarfile.open(fileobj=process.stdout, mode="r|") as archive:
+            if hasattr(tarfile, "data_filter"):
+                archive.extractall(destination, filter="data")
+            else:  # pragma: no cover
+                archive.extractall(destination)
+        stderr = process.stderr.read()
+    if process.returncode:
+        raise GitError(
+            subprocess.CalledProcessError(
+                process.returncode, process.args, stderr=stderr.decode()
+            )
+        )
+
+
+def merge_file(current: bytes, base: bytes, other: bytes, labels=()):
+    """Three-way merge the changes from `base` to `other` into `current`.
+
+    Return the merged content, with conflict markers if any, and the number
+    of conflicts.
+    """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        paths = []
+        for name, content in (("current", current), ("base", base), ("other", other)):
+            path = Path(tmpdir) / name
+            path.write_bytes(content)
+            paths.append(str(path))
+        label_args = [arg for label in labels for arg in ("-L", label)]
+        process = subprocess.run(
+            ["git", "merge-file", "--stdout", *label_args, *paths],
+            capture_output=True,
+            check=False,
+        )
+    if process.returncode < 0 or process.returncode > 127:
+        raise GitError(
+            subprocess.CalledProcessError(
+                process.returncode, process.args, stderr=process.stderr.decode()
+            )
+        )
+    return process.stdout, process.returncode
@@ -0,0 +1,561 @@
+"""Templates served straight from a directory, an archive or git objects.
+
+Template releases distributed as zip or tar archives, or pinned commits of
+a git repo, don't need to be extracted to disk to be rendered: their files
+are listed and read in place, and fed to Jinja through a dedicated loader.
+Directories are walked once, their files being read from where they are.
+"""
+
+import abc
+import fnmatch
+import mmap
+import os
+import re
+import subprocess
+import tarfile
+import threading
+import weakref
+import zipfile
+from contextlib import contextmanager
+from pathlib import Path, PurePosixPath
+from typing import NamedTuple
+
+from jinja2 import BaseLoader, FileSystemLoader, TemplateNotFound
+
+from pytemplator.constants import (
+    DEFAULT_IGNORE_PATTERNS,
+    IGNORE_FILE,
+    RESERVED_DIR_NAMES,
+)
+from pytemplator.git import run_git
+
+
+class IgnoreRules:
+    """Glob patterns of the template files left out, as in a `.pytemplatorignore` file.
+
+    One pattern per line, blank lines and lines starting with `#` being
+    skipped. A pattern without a slash matches a file or directory name at
+    any depth, one with a slash matches a path from the root of the
+    templates. A trailing slash only matches directories. Everything under
+    an ignored directory is ignored. DEFAULT_IGNORE_PATTERNS always apply.
+    """
+
+    def __init__(self, patterns=()):
+        """Compile the patterns, on top of the default ones."""
+        rules = {
+            (kind, dir_only): [] for kind in ("name", "path") for dir_only in (0, 1)
+        }
+        for pattern in (*DEFAULT_IGNORE_PATTERNS, *patterns):
+            pattern = pattern.strip()
+            if not pattern or pattern.startswith("#"):
+                continue
+            dir_only = int(pattern.endswith("/"))
+            pattern = pattern.rstrip("/")
+            kind = "path" if "/" in pattern else "name"
+            rules[kind, dir_only].append(fnmatch.translate(pattern.lstrip("/")))
+        self.rules = {
+            key: re.compile("|".join(regexes))
+            for key, regexes in rules.items()
+            if regexes
+        }
+
+    @classmethod
+    def from_text(cls, text):
+        """Return the rules of the content of an ignore file."""
+        return cls(text.splitlines())
+
+    @classmethod
+    def from_file(cls, path):
+        """Return the rules of the ignore file at `path`, the default ones if missing."""
+        try:
+            return cls.from_text(Path(path).read_text(encoding="UTF-8"))
+        except FileNotFoundError:
+            return cls()
+
+    def ignores(self, name, is_dir=False) -> bool:
+        """Tell whether the file, or directory, at the relative posix path `name` is ignored."""
+        basename = name.rsplit("/", 1)[-1]
+        for (kind, dir_only), regex in self.rules.items():
+            if dir_only and not is_dir:
+                continue
+            if regex.match(basename if kind == "name" else name):
+                return True
+        return False
+
+    def ignores_path(self, name) -> bool:
+        """Tell whether the file at `name`, or any of its parent directories, is ignored."""
+        parts = name.split("/")
+        return any(
+            self.ignores("/".join(parts[:depth]), is_dir=True)
+            for depth in range(1, len(parts))
+        ) or self.ignores(name)
+
+
+class TemplateEntry(NamedTuple):
+    """A template file on disk, `name` being the template of its output path."""
+
+    name: str
+    path: Path
+    stat: os.stat_result
+
+
+class TemplateDirectory(os.PathLike):
+    """Template files of a directory, listed in a single pass of `os.scandir`.
+
+    The files and directories matched by the `ignore` rules are skipped, an
+    ignored directory not being walked at all. Symlinks are followed. With
+    `template_root`, `path` is the root of a template without `templates`
+    folder: only the files within its directories are templates, bar the
+    reserved ones such as `hooks`.
+
+    The stat of each file is kept from the walk, and the directory stands
+    for its path wherever one is expected.
+    """
+
+    def __init__(self, path, ignore=None, template_root=False):
+        """Walk the directory lazily."""
+        self.path = Path(path)
+        self.ignore = ignore or IgnoreRules()
+        self.template_root = template_root
+        self._entries = None
+
+    def __fspath__(self):
+        """Return the path of the directory."""
+        return str(self.path)
+
+    def __str__(self):
+        """Return the path of the directory."""
+        return str(self.path)
+
+    @property
+    def entries(self):
+        """Return the TemplateEntry of every file, by name."""
+        if self._entries is None:
+            entries = {}
+            self._walk(self.path, "", entries)
+            self._entries = entries
+        return self._entries
+
+    def _walk(self, directory, prefix, entries):
+        """Add the entries of the files under `directory`, named from `prefix`."""
+        with os.scandir(directory) as scanned:
+            children = sorted(scanned, key=lambda child: child.name)
+        for child in children:
+            name = prefix + child.name
+            try:
+                is_dir = child.is_dir()
+            except OSError:
+                continue
+            if self.template_root and not prefix:
+                if not is_dir or child.name in RESERVED_DIR_NAMES:
+                    continue
+            if self.ignore.ignores(name, is_dir):
+                continue
+            if is_dir:
+                self._walk(child.path, f"{name}/", entries)
+            elif child.is_file():
+                entries[name] = TemplateEntry(name, Path(child.path), child.stat())
+
+    def list(self):
+        """Return the names of all the files, sorted."""
+        return sorted(self.entries)
+
+    def root_directories(self):
+        """Return the paths of the top directories holding template files."""
+        names = {name.split("/", 1)[0] for name in self.entries if "/" in name}
+        return [self.path / name for name in sorted(names)]
+
+    def stat(self, name):
+        """Return the stat of a file, as of the walk."""
+        return self.entries[name].stat
+
+    def loader(self):
+        """Return a Jinja loader for these files."""
+        return TemplateDirectoryLoader(self)
+
+
+class TemplateDirectoryLoader(FileSystemLoader):
+    """Jinja loader for a TemplateDirectory.
+
+    The files found by the walk are read straight from their path. Others,
+    such as ignored files included by a template, are searched for as usual.
+    """
+
+    def __init__(self, templates):
+        """Set the directory to load the templates from."""
+        super().__init__(str(templates.path), followlinks=True)
+        self.templates = templates
+
+    def get_source(self, environment, template):
+        """Return the source of a template, raise UnicodeDecodeError if binary."""
+        entry = self.templates.entries.get(template)
+        if entry is None:
+            return super().get_source(environment, template)
+        source = entry.path.read_text(encoding="UTF-8")
+        mtime = entry.stat.st_mtime
+
+        def uptodate():
+            try:
+                return os.path.getmtime(entry.path) == mtime
+            except OSError:
+                return False
+
+        return source, str(entry.path), uptodate
+
+    def list_templates(self):
+        """Return the names of all the templates."""
+        return self.templates.list()
+
+
+class TemplateFiles(abc.ABC):
+    """Base class of the template files served by relative posix path.
+
+    The subclasses implement `_list`, returning the mode of each file, and
+    `_read`. `prefix` restricts the files to those of a subdirectory.
+    """
+
+    def __init__(self, prefix=""):
+        """Set the subdirectory the files are taken from."""
+        self.prefix = f"{prefix.strip('/')}/" if prefix.strip("/") else ""
+        self._modes = None
+
+    @property
+    def modes(self):
+        """Return the mode of each file, by path relative to the prefix."""
+        if self._modes is None:
+            self._modes = {
+                name.removeprefix(self.prefix): mode
+                for name, mode in self._list().items()
+                if name.startswith(self.prefix)
+            }
+        return self._modes
+
+    def list(self):
+        """Return the paths of all the files, sorted."""
+        return sorted(self.modes)
+
+    def exists(self, name) -> bool:
+        """Tell whether there is a file at `name`."""
+        return name in self.modes
+
+    def is_dir(self, name) -> bool:
+        """Tell whether there is a directory at `name`."""
+        prefix = f"{name.strip('/')}/"
+        return any(path.startswith(prefix) for path in self.modes)
+
+    def read_bytes(self, name) -> bytes:
+        """Return the content of a file, raise FileNotFoundError if missing."""
+        if name not in self.modes:
+            raise FileNotFoundError(f"{self.origin(name)} not found")
+        return self._read(self.prefix + name)
+
+    def mode(self, name) -> int:
+        """Return the permission bits of a file."""
+        return self.modes[name] & 0o7777
+
+    def origin(self, name) -> str:
+        """Return where a file comes from, for error messages and tracebacks."""
+        return f"{self.prefix}{name}"
+
+    def subtree(self, prefix):
+        """Return the files of a subdirectory."""
+        subtree = self.__class__.__new__(self.__class__)
+        subtree.__dict__.update(self.__dict__)
+        TemplateFiles.__init__(subtree, self.prefix + prefix)
+        return subtree
+
+    def loader(self):
+        """Return a Jinja loader for these files."""
+        return TemplateFilesLoader(self)
+
+    @abc.abstractmethod
+    def _list(self) -> dict:
+        """Return the mode of every file, by full path."""
+
+    @abc.abstractmethod
+    def _read(self, path) -> bytes:
+        """Return the content of the file at the full `path`."""
+
+
+class TemplateFilesLoader(BaseLoader):
+    """Jinja loader for TemplateFiles."""
+
+    def __init__(self, files):
+        """Set the files to load the templates from."""
+        self.files = files
+
+    def get_source(self, environment, template):
+        """Return the source of a template, raise UnicodeDecodeError if binary."""
+        try:
+            data = self.files.read_bytes(template)
+        except FileNotFoundError as error:
+            raise TemplateNotFound(template) from error
+        return data.decode("UTF-8"), self.files.origin(template), lambda: True
+
+    def list_templates(self):
+        """Return the names of all the templates."""
+        return self.files.list()
+
+
+class ArchiveFiles(TemplateFiles):
+    """Files of a zip or tar archive, read without extracting it.
+
+    Zip archives are read member by member through their central directory,
+    uncompressed tarballs are memory-mapped, each file being sliced at its
+    offset. Compressed tarballs can't be read at random, so their files are
+    decompressed once and kept in memory.
+
+    Archives holding everything in a single top directory, as release
+    archives usually do, are served from that directory.
+    """
+
+    def __init__(self, path, prefix=""):
+        """Open the archive lazily."""
+        self.path = Path(path)
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._mmap = None
+        self._archive = None
+        self._members = None
+        self._offsets = None
+        self._root = None
+        super().__init__(prefix)
+
+    def __getstate__(self):
+        """Leave the open archive out when sent to another process."""
+        state = dict(self.__dict__)
+        state.update(
+            _lock=None, _mmap=None, _archive=None, _members=None, _offsets=None
+        )
+        return state
+
+    def __setstate__(self, state):
+        """Reopen the archive lazily."""
+        self.__dict__.update(state)
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def _open(self):
+        """Index the members of the archive.
+
+        A process forked since the archive got opened, e.g. a rendering
+        worker, opens it again rather than sharing the file position.
+        """
+        if self._pid != os.getpid():
+            self.__setstate__(self.__getstate__())
+        if self._members is not None:
+            return
+        with self._lock:
+            if self._members is not None:
+                return
+            if zipfile.is_zipfile(self.path):
+                # pylint: disable=consider-using-with
+                self._archive = zipfile.ZipFile(self.path)
+                members = {
+                    info.filename: (info.external_attr >> 16) or 0o644
+                    for info in self._archive.infolist()
+                    if not info.is_dir()
+                }
+            else:
+                members = self._index_tarball()
+            self._root = _common_root(members)
+            self._members = members
+
+    def _index_tarball(self):
+        """Index the files of a tarball, keeping their offset or content."""
+        members = {}
+        offsets = {}
+        with open(self.path, "rb") as archive_file:
+            self._mmap = mmap.mmap(archive_file.fileno(), 0, access=mmap.ACCESS_READ)
+        with tarfile.open(fileobj=self._mmap, mode="r:*") as archive:
+            compressed = archive.fileobj is not self._mmap
+            for member in archive:
+                if not member.isfile():
+                    continue
+                name = member.name[2:] if member.name.startswith("./") else member.name
+                members[name] = member.mode
+                if compressed:
+                    offsets[name] = archive.extractfile(member).read()
+                else:
+                    offsets[name] = (member.offset_data, member.size)
+        self._offsets = offsets
+        return members
+
+    def _list(self):
+        """Return the mode of every file, relative to the top directory."""
+        self._open()
+        return {
+            name.removeprefix(self._root): mode for name, mode in self._members.items()
+        }
+
+    def _read(self, path):
+        """Read a file, from its offset in the memory-mapped archive if possible."""
+        self._open()
+        name = self._root + path
+        if self._archive is not None:
+            return self._archive.read(name)
+        location = self._offsets[name]
+        if isinstance(location, bytes):
+            return location
+        start, size = location
+        end = start + size
+        return self._mmap[start:end]
+
+    def origin(self, name):
+        """Return the path of the file within the archive."""
+        return f"{self.path}/{self.prefix}{name}"
+
+
+class GitTreeFiles(TemplateFiles):
+    """Files of a commit, read from the git objects without any checkout.
+
+    The blobs are read through a single `git cat-file --batch` process.
+    """
+
+    def __init__(self, repo_dir, commit, prefix=""):
+        """List the files of the commit lazily."""
+        self.repo_dir = Path(repo_dir)
+        self.commit = commit
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._objects = None
+        self._process = None
+        super().__init__(prefix)
+
+    def __getstate__(self):
+        """Leave the git process out when sent to another process."""
+        state = dict(self.__dict__)
+        state.update(_lock=None, _process=None)
+        return state
+
+    def __setstate__(self, state):
+        """Start a new git process lazily."""
+        self.__dict__.update(state)
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def _list(self):
+        """Return the mode of every file of the commit."""
+        if self._objects is None:
+            output = run_git("ls-tree", "-r", "-z", self.commit, cwd=self.repo_dir)
+            objects = {}
+            for entry in output.split("\0"):
+                if not entry:
+                    continue
+                info, name = entry.split("\t", 1)
+                mode, kind, oid = info.split()
+                # Submodules and symlinks can't be served as files.
+                if kind == "blob" and mode != "120000":
+                    objects[name] = (int(mode, 8), oid)
+            self._objects = objects
+        return {name: mode for name, (mode, _) in self._objects.items()}
+
+    def _read(self, path):
+        """Read a blob through the `git cat-file --batch` process.
+
+        A process forked since the git process got started, e.g. a rendering
+        worker, starts its own rather than sharing its pipes.
+        """
+        if self._pid != os.getpid():
+            self.__setstate__(self.__getstate__())
+        self._list()
+        oid = self._objects[path][1]
+        with self._lock:
+            if self._process is None:
+                self._process = subprocess.Popen(  # pylint: disable=consider-using-with
+                    ["git", "cat-file", "--batch"],
+                    cwd=self.repo_dir,
+                    stdin=subprocess.PIPE,
+                    stdout=subprocess.PIPE,
+                )
+                weakref.finalize(self, _stop_process, self._process)
+            self._process.stdin.write(f"{oid}\n".encode())
+            self._process.stdin.flush()
+            header = self._process.stdout.readline().split()
+            if len(header) != 3:
+                raise FileNotFoundError(
+                    f"{self.origin(path)}: missing git object {oid}"
+                )
+            data = self._process.stdout.read(int(header[2]))
+            self._process.stdout.read(1)
+        return data
+
+    def origin(self, name):
+        """Return the path of the file at the commit."""
+        return f"{self.commit}:{self.prefix}{name}"
+
+
+def _stop_process(process):
+    """Stop a `git cat-file --batch` process."""
+    process.stdin.close()
+    process.wait()
+    process.stdout.close()
+
+
+def _common_root(names):
+    """Return the single top directory of all the `names`, with a slash, if any."""
+    roots = {PurePosixPath(name).parts[0] for name in names}
+    if len(roots) != 1 or any("/" not in name for name in names):
+        return ""
+    return f"{roots.pop()}/"
+
+
+def is_template_archive(path) -> bool:
+    """Tell whether `path` is a zip or tar archive."""
+    path = Path(path)
+    return path.is_file() and (zipfile.is_zipfile(path) or tarfile.is_tarfile(path))
+
+
+@contextmanager
+def open_template_files_tree(files):
+    """Yield the template files to render and their root directories.
+
+    This mirrors `utils.open_template_tree` for files off the filesystem,
+    the files matched by the `.pytemplatorignore` of the template included.
+    """
+    ignore = IgnoreRules()
+    if files.exists(IGNORE_FILE):
+        ignore = IgnoreRules.from_text(files.read_bytes(IGNORE_FILE).decode("UTF-8"))
+    if files.is_dir("templates"):
+        templates = _SelectedFiles(files.subtree("templates"), ignore)
+    else:
+        templates = _SelectedFiles(files, ignore, template_root=True)
+    root_directories = sorted(
+        {
+            PurePosixPath(name.split("/", 1)[0])
+            for name in templates.list()
+            if "/" in name
+        }
+    )
+    yield templates, root_directories
+
+
+class _SelectedFiles(TemplateFiles):
+    """View of the template files not ignored, see TemplateDirectory for `template_root`."""
+
+    def __init__(self, files, ignore, template_root=False):
+        """Wrap the files of the template."""
+        self.files = files
+        self.ignore = ignore
+        self.template_root = template_root
+        super().__init__()
+
+    def _list(self):
+        """Return the files not ignored."""
+        return {
+            name: mode
+            for name, mode in self.files.modes.items()
+            if not (
+                self.template_root
+                and ("/" not in name or name.split("/", 1)[0] in RESERVED_DIR_NAMES)
+            )
+            and not self.ignore.ignores_path(name)
+        }
+
+    def _read(self, path):
+        """Read the file from the wrapped files."""
+        return self.files.read_bytes(path)
+
+    def origin(self, name):
+        """Return where the file comes from."""
+        return self.files.origin(name)
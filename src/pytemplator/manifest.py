@@ -0,0 +1,133 @@
+"""Manifest of the files generated into a destination directory.
+
+It records the content hash of each generated file, so that generating the
+project again only writes the files whose content actually changes and only
+removes the files the template no longer produces. Everything else in the
+destination, such as build caches, is left untouched.
+"""
+
+import hashlib
+import json
+import os
+from pathlib import Path
+
+from loguru import logger
+
+from pytemplator.constants import CONFIG_FILE, MANIFEST_FILE
+
+
+def hash_bytes(data: bytes) -> str:
+    """Return the content hash of `data` as recorded in the manifest."""
+    return hashlib.sha256(data).hexdigest()
+
+
+def hash_file(path) -> str:
+    """Return the content hash of the file at `path`."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class Manifest:
+    """Content hashes of the files generated into `destination_dir`.
+
+    `previous` holds the hashes recorded by the last generation, if any,
+    `entries` those of the files generated by this one.
+    """
+
+    def __init__(self, destination_dir):
+        """Load the manifest of the previous generation, if any."""
+        self.destination_dir = Path(destination_dir)
+        self.path = self.destination_dir / MANIFEST_FILE
+        self.previous = {}
+        self.entries = {}
+        try:
+            with open(self.path, encoding="UTF-8") as manifest_file:
+                self.previous = json.load(manifest_file)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as error:
+            logger.warning(f"Ignoring the unreadable {self.path}: {error}")
+
+    def relative_path(self, path):
+        """Return the key of `path` in the manifest, None if out of its scope."""
+        try:
+            return Path(path).relative_to(self.destination_dir).as_posix()
+        except ValueError:
+            return None
+
+    def is_unchanged(self, path, digest, size) -> bool:
+        """Tell whether the file at `path` already has the content hashed as `digest`.
+
+        The size is compared first, so the file is only read when it may
+        be identical.
+        """
+        try:
+            if os.stat(path).st_size != size:
+                return False
+        except FileNotFoundError:
+            return False
+        return hash_file(path) == digest
+
+    def record(self, path, digest):
+        """Record that the file at `path` was generated with the hash `digest`."""
+        key = self.relative_path(path)
+        # The config file is rewritten by `pytemplate update` too, so it is
+        # never considered edited nor stale.
+        if key is not None and key != CONFIG_FILE:
+            self.entries[key] = digest
+
+    def forget(self, path):
+        """Forget about the file at `path`, e.g. after it got deleted."""
+        key = self.relative_path(path)
+        self.previous.pop(key, None)
+        self.entries.pop(key, None)
+
+    def remove_stale(self):
+        """Delete the files of the previous generation which are not generated anymore.
+
+        Files edited since they were generated are kept. Return the paths
+        of the deleted files.
+        """
+        removed = []
+        for key in sorted(self.previous.keys() - self.entries.keys()):
+            path = self.destination_dir / key
+            try:
+                edited = hash_file(path) != self.previous[key]
+            except FileNotFoundError:
+                continue
+            if edited:
+                logger.warning(f"{key} is not generated anymore but was edited, kept.")
+                continue
+            path.unlink()
+            remove_empty_parents(path, self.destination_dir)
+            removed.append(key)
+        return removed
+
+    def save(self, durable=False):
+        """Write the manifest of this generation next to the generated files.
+
+        With `durable`, it is flushed to disk before replacing the previous one.
+        """
+        tmp_path = self.path.with_name(f"{MANIFEST_FILE}.{os.getpid()}.tmp")
+        with open(tmp_path, "w", encoding="UTF-8") as manifest_file:
+            json.dump(self.entries, manifest_file, indent=2, sort_keys=True)
+            manifest_file.write("\n")
+            if durable:
+                manifest_file.flush()
+                os.fsync(manifest_file.fileno())
+        os.replace(tmp_path, self.path)
+        self.previous = dict(self.entries)
+
+
+def remove_empty_parents(path, root):
+    """Remove the directories left empty above `path`, up to `root`."""
+    for parent in Path(path).parents:
+        if parent == root:
+            return
+        try:
+            parent.rmdir()
+        except OSError:
+            return
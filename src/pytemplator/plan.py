@@ -0,0 +1,105 @@
+"""Plan of a generation: the files it would write, without writing anything.
+
+The template is rendered as usual, through the same compiled templates, but
+into a PlanSink keeping only the size and content hash of each file. These
+are compared with the destination directory and its manifest to tell which
+files would be created, modified or deleted.
+"""
+
+import hashlib
+import os
+from pathlib import Path
+from typing import NamedTuple
+
+from pytemplator.manifest import Manifest, hash_bytes, hash_file
+from pytemplator.sinks import Sink
+
+CREATED = "created"
+MODIFIED = "modified"
+UNCHANGED = "unchanged"
+
+
+class PlannedFile(NamedTuple):
+    """A file the generation would write."""
+
+    size: int
+    sha256: str
+    status: str = CREATED
+
+
+class Plan(NamedTuple):
+    """The files a generation would write into `destination_dir`, by relative path.
+
+    `deleted` lists the files of the previous generation, as recorded in the
+    manifest, which would be removed as they are not generated anymore.
+    """
+
+    destination_dir: Path
+    files: dict
+    deleted: list
+
+    def paths(self, status):
+        """Return the paths of the planned files with the given status."""
+        return sorted(
+            path for path, file in self.files.items() if file.status == status
+        )
+
+    def as_dict(self):
+        """Return the plan as a dictionary, ready to be dumped as JSON."""
+        return {
+            "destination_dir": str(self.destination_dir),
+            "files": {
+                path: file._asdict() for path, file in sorted(self.files.items())
+            },
+            "deleted": self.deleted,
+        }
+
+
+class PlanSink(Sink):
+    """Keep the size and content hash of the files instead of writing them."""
+
+    concurrent_writes = True
+
+    def __init__(self):
+        """Start with no files."""
+        self.files = {}
+
+    def write_bytes(self, path, data, mode=None):
+        """Hash the file content."""
+        self.files[path] = PlannedFile(len(data), hash_bytes(data))
+
+    def write_chunks(self, path, chunks):
+        """Hash the chunks as they are rendered, memory staying flat."""
+        digest, size = hashlib.sha256(), 0
+        for chunk in chunks:
+            data = chunk.encode("UTF-8")
+            digest.update(data)
+            size += len(data)
+        self.files[path] = PlannedFile(size, digest.hexdigest())
+
+    def copy_file(self, path, source):
+        """Hash the file at `source`."""
+        self.files[path] = PlannedFile(os.stat(source).st_size, hash_file(source))
+
+    def plan(self, destination_dir):
+        """Return the Plan of writing the files into `destination_dir`."""
+        destination_dir = Path(destination_dir)
+        manifest = Manifest(destination_dir)
+        files = {}
+        for path, file in self.files.items():
+            target = destination_dir / path
+            if not target.is_file():
+                status = CREATED
+            elif manifest.is_unchanged(target, file.sha256, file.size):
+                status = UNCHANGED
+            else:
+                status = MODIFIED
+            files[path] = file._replace(status=status)
+        deleted = [
+            path
+            for path, digest in sorted(manifest.previous.items())
+            if path not in files
+            and (destination_dir / path).is_file()
+            and hash_file(destination_dir / path) == digest
+        ]
+        return Plan(destination_dir, files, deleted)
@@ -0,0 +1,161 @@
+"""Timing events emitted along the generation, to find out what makes it slow.
+
+The Templator and `render_templates` report how long each phase of the
+generation takes (git, `initialize.py`, rendering, `finalize.py`...) and how
+long each file takes to compile, render and write, as TimingEvents sent to
+the hooks of a Timer. A hook is any callable taking the event.
+
+`TraceRecorder` is a hook keeping the events, to save them as a Chrome
+trace (to open in chrome://tracing or https://ui.perfetto.dev) and to tell
+which files are the slowest.
+"""
+
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+from typing import NamedTuple
+
+# Returned instead of a span when nobody listens, as it costs nothing.
+_NO_SPAN = nullcontext()
+
+
+class TimingEvent(NamedTuple):
+    """Something which took `duration` seconds, starting at `start`.
+
+    `start` is read from `time.perf_counter`. `category` is either "phase"
+    for the phases of the generation, "file" for the work done on a single
+    file, or "jinja" for template compilations. `thread` is the native id
+    of the thread, or the process id for the rendering processes.
+    """
+
+    name: str
+    category: str
+    start: float
+    duration: float
+    thread: int
+    args: dict
+
+
+class Timer:
+    """Send TimingEvents to the `hooks`, it does nothing without any."""
+
+    def __init__(self, hooks=None):
+        """Set the hooks to send the events to."""
+        self.hooks = list(hooks or [])
+
+    def add_hook(self, hook):
+        """Send the events to `hook` too."""
+        self.hooks.append(hook)
+
+    def span(self, name, category="phase", **args):
+        """Return a context manager timing its block as an event."""
+        if not self.hooks:
+            return _NO_SPAN
+        return self._span(name, category, args)
+
+    def timed(self, function, name, category="phase", **args):
+        """Return `function` timed as an event each time it is called."""
+        if not self.hooks:
+            return function
+
+        def timed_function(*func_args, **func_kwargs):
+            with self._span(name, category, args):
+                return function(*func_args, **func_kwargs)
+
+        return timed_function
+
+    @contextmanager
+    def _span(self, name, category, args):
+        """Time the block and emit its event, even if it fails."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.emit(
+                TimingEvent(
+                    name,
+                    category,
+                    start,
+                    time.perf_counter() - start,
+                    threading.get_native_id(),
+                    args,
+                )
+            )
+
+    def emit(self, event):
+        """Send an event to the hooks."""
+        for hook in self.hooks:
+            hook(event)
+
+
+class TraceRecorder:
+    """Hook keeping the events of a generation."""
+
+    def __init__(self):
+        """Start with no events."""
+        self.events = []
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        """Record an event, from any thread."""
+        with self._lock:
+            self.events.append(event)
+
+    def phases(self):
+        """Return the total duration of each phase, in seconds."""
+        totals = defaultdict(float)
+        for event in self.events:
+            if event.category == "phase":
+                totals[event.name] += event.duration
+        return dict(totals)
+
+    def slowest_files(self, count=10):
+        """Return the `count` slowest files, with their duration in seconds."""
+        totals = defaultdict(float)
+        for event in self.events:
+            if event.category == "file":
+                totals[event.args["path"]] += event.duration
+        return sorted(totals.items(), key=lambda item: item[1], reverse=True)[:count]
+
+    def chrome_trace(self):
+        """Return the events in the Chrome trace event format."""
+        origin = min((event.start for event in self.events), default=0)
+        return {
+            "traceEvents": [
+                {
+                    "name": event.name,
+                    "cat": event.category,
+                    "ph": "X",
+                    "ts": (event.start - origin) * 1e6,
+                    "dur": event.duration * 1e6,
+                    "pid": os.getpid(),
+                    "tid": event.thread,
+                    "args": {key: str(value) for key, value in event.args.items()},
+                }
+                for event in self.events
+            ],
+            "displayTimeUnit": "ms",
+        }
+
+    def save(self, path):
+        """Write the events as a Chrome trace file."""
+        with open(path, "w", encoding="UTF-8") as trace_file:
+            json.dump(self.chrome_trace(), trace_file)
+
+
+def timed_phase(method):
+    """Decorate a method to time it as a phase named after it.
+
+    The instance must have a `timer` attribute.
+    """
+
+    @wraps(method)
+    def timed_method(self, *args, **kwargs):
+        with self.timer.span(method.__name__):
+            return method(self, *args, **kwargs)
+
+    return timed_method
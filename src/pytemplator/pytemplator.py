@@ -1,30 +1,91 @@
 """Main module."""
 
-import os
-import subprocess
+import copy
+import hashlib
+import json
 import tempfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from functools import cached_property
 from pathlib import Path
+from typing import NamedTuple
 
-import yaml
 from loguru import logger
 
 from pytemplator import __version__
-from pytemplator.constants import GIT_REGEX, RESERVED_DIR_NAMES
+from pytemplator.cache import (
+    BytecodeCache,
+    FileTypeCache,
+    ModuleCache,
+    OutputCache,
+    prune_bytecode_cache,
+    prune_output_cache,
+)
+from pytemplator.constants import (
+    BYTECODE_CACHE_MAX_SIZE,
+    CONFIG_FILE,
+    GIT_REGEX,
+    OUTPUT_CACHE_MAX_AGE,
+    OUTPUT_CACHE_MAX_SIZE,
+)
 from pytemplator.exceptions import (
     BrokenTemplateError,
     InvalidInputError,
     UserCancellationError,
 )
+from pytemplator.git import (
+    GitError,
+    checkout_worktree,
+    fetch_into_mirror,
+    fetch_missing_blobs,
+    fetched_commit,
+    has_ref,
+    mirror_lock,
+    run_git,
+    seconds_since_fetch,
+)
+from pytemplator.loaders import (
+    ArchiveFiles,
+    GitTreeFiles,
+    is_template_archive,
+    open_template_files_tree,
+)
+from pytemplator.manifest import Manifest
+from pytemplator.plan import Plan, PlanSink
+from pytemplator.profiling import Timer, timed_phase
+from pytemplator.sinks import FileSystemSink, StagedFileSystemSink
 from pytemplator.utils import (
-    cd,
+    REFERENCED_KEYS,
+    TemplateCache,
+    TemplateIndex,
+    TemplateSelector,
+    check_if_new_dirs_can_be_created,
     generate_context_from_json,
-    import_module_from_path,
+    generate_context_from_questions,
     is_yes,
+    make_jinja_env,
+    open_template_tree,
     render_templates,
+    resolve_destination,
 )
 
 
+class RenderResult(NamedTuple):
+    """Outcome of the generation of one output by `Templator.render_many`.
+
+    `plan` holds the Plan of the output when only planned, see `plan_many`.
+    """
+
+    destination_dir: Path
+    error: Exception = None
+    plan: Plan = None
+
+    @property
+    def success(self):
+        """Tell whether the output was generated successfully."""
+        return self.error is None
+
+
 class Templator:  # pylint: disable=too-many-instance-attributes, too-many-arguments
     """Main class creating a project from a template."""
 
@@ -35,6 +96,13 @@ class Templator:  # pylint: disable=too-many-instance-attributes, too-many-argum
         checkout_branch: str = "main",
         destination_dir: str = None,
         no_input: bool = False,
+        jobs: int = 1,
+        offline: bool = False,
+        fetch_ttl: float = 0,
+        checkout: bool = True,
+        hooks=None,
+        durable: bool = False,
+        cache_outputs: bool = False,
     ):
         """Set up the attributes.
 
@@ -48,33 +116,110 @@ class Templator:  # pylint: disable=too-many-instance-attributes, too-many-argum
 
         We then call its initialize.py if it exists, otherwise we use
         the cookiecutter.json for context.
+
+        `jobs` sets how many files can be rendered concurrently.
+
+        A git template is not fetched again if it was less than `fetch_ttl`
+        seconds ago, nor at all when `offline`, as long as it is cached.
+
+        Without `checkout`, a git template is read straight from the objects
+        of its commit instead of being checked out. So is a local zip or tar
+        archive, never extracted. `template_dir` is then None and the files
+        are served by `template_files`.
+
+        The `hooks` are called with the TimingEvent of each phase of the
+        generation and of each file rendered, see `pytemplator.profiling`.
+
+        With `durable`, the generated files are flushed to disk before the
+        generation completes, see `StagedFileSystemSink`.
+
+        With `cache_outputs`, the rendered output of a git template is kept
+        in the base directory, keyed by commit and context, and generating
+        it again only links its files into the destination, see
+        `OutputCache`. `finalize.py` is still run every time, unless it sets
+        `CACHEABLE = True`, in which case the finalized output is cached.
         """
         self.base_dir = Path(base_dir) if base_dir else Path.home() / ".pytemplator"
         self.base_dir.mkdir(parents=True, exist_ok=True)
+        # git commands run from other directories, e.g. the mirror.
+        self.base_dir = self.base_dir.resolve(strict=True)
 
         self.destination_dir = Path(destination_dir) if destination_dir else Path.cwd()
         self.destination_dir = self.destination_dir.resolve(strict=True)
 
         self.checkout_branch = checkout_branch
         self.template_location = template_location
+        self.context = {"cookiecutter": {}, "pytemplator": {}}
+        self.no_input = no_input
+        self.jobs = jobs
+        self.bytes_fetched = 0
+        self.offline = offline
+        self.fetch_ttl = fetch_ttl
+        self.durable = durable
+        self.cache_outputs = cache_outputs
+        self.template_files = None
+        self.timer = Timer(hooks)
+        self._modules = {}
         if GIT_REGEX.match(template_location):
             template_name = (
                 template_location.replace(".git", "").strip("/").split("/")[-1]
             )
-            self.template_dir = self.base_dir / template_name
-            self.get_git_template(template_location)
-            self.prepare_template_dir()
+            # Different repos may share the same name.
+            template_name += (
+                "-" + hashlib.sha1(template_location.encode()).hexdigest()[:8]
+            )
+            self.mirror_dir = self.base_dir / "mirrors" / f"{template_name}.git"
+            # One worktree per commit, never changed once checked out.
+            self.worktrees_dir = self.base_dir / "worktrees" / template_name
+            self.template_dir = None
+            with mirror_lock(self.mirror_dir):
+                if not self.is_git_template_fresh():
+                    self.get_git_template(template_location)
+                if checkout:
+                    self.prepare_template_dir()
+                else:
+                    self.prepare_template_files()
         else:
+            self.mirror_dir = None
             self.template_dir = Path(template_location).resolve(strict=True)
-        self.context = {"cookiecutter": {}, "pytemplator": {}}
-        self.no_input = no_input
+            if is_template_archive(self.template_dir):
+                self.template_files = ArchiveFiles(self.template_dir)
+                self.template_dir = None
+
+    def is_git_template_fresh(self):
+        """Tell whether the cached git template can be used without fetching.
+
+        Raise BrokenTemplateError when offline with nothing cached.
+        """
+        age = seconds_since_fetch(self.mirror_dir, self.checkout_branch)
+        if self.offline:
+            if age is None:
+                raise BrokenTemplateError(
+                    "Running offline but the template has never been fetched."
+                )
+            return True
+        if age is not None and age < self.fetch_ttl:
+            logger.debug(f"Template fetched {age:.0f}s ago, not fetching it again.")
+            return True
+        return False
 
+    @timed_phase
     def get_git_template(self, url):
-        """Get the template project from a Git repository."""
+        """Fetch the template from a Git repository into the local mirror.
+
+        Only the commit at the tip of `checkout_branch` is fetched, without
+        history, other branches or any file content.
+        """
         try:
-            with cd(self.template_dir):
-                subprocess.run("git fetch -p", shell=True, check=True)
-        except subprocess.CalledProcessError as error:
+            fetched = fetch_into_mirror(self.mirror_dir, url, self.checkout_branch)
+        except GitError as error:
+            if "couldn't find remote ref" in error.stderr:
+                logger.error("The specified branch to checkout does not exist.")
+                raise InvalidInputError from error
+            if not has_ref(self.mirror_dir, self.checkout_branch):
+                raise BrokenTemplateError(
+                    f"The template could not be cloned from {url}"
+                ) from error
             if self.no_input:
                 logger.warning("Couldn't fetch repo, using cached version")
                 use_old_repo = "Y"
@@ -88,41 +233,51 @@ class Templator:  # pylint: disable=too-many-instance-attributes, too-many-argum
                 )
             if not is_yes(use_old_repo):
                 raise UserCancellationError from error
-        except FileNotFoundError:
-            try:
-                with cd(self.base_dir):
-                    subprocess.run(f"git clone {url}", shell=True, check=True)
-            except subprocess.CalledProcessError as error:
-                raise BrokenTemplateError(
-                    f"The template could not be cloned from {url}"
-                ) from error
+        else:
+            self.bytes_fetched += fetched
+            logger.debug(f"Fetched {fetched} bytes of git objects from {url}")
 
+    def fetched_commit(self):
+        """Return the commit of `checkout_branch` fetched into the mirror."""
+        try:
+            return fetched_commit(self.mirror_dir, self.checkout_branch)
+        except GitError as error:
+            raise BrokenTemplateError(
+                f"The template could not be read: {error}"
+            ) from error
+
+    @timed_phase
     def prepare_template_dir(self):
-        """Make sure the template directory is in the expected state."""
-        with cd(self.template_dir):
-            try:
-                subprocess.run(
-                    ["git", "checkout", self.checkout_branch],
-                    check=True,
-                    capture_output=True,
-                )
-            except subprocess.CalledProcessError:
-                # If the cached repo has been edited somehow, the index might
-                # be corrupted so we do a hard reset to unblock things.
-                try:
-                    subprocess.run(
-                        ["git", "reset", "--hard", f"origin/{self.checkout_branch}"],
-                        check=True,
-                        capture_output=True,
-                    )
-                    subprocess.run(
-                        ["git", "checkout", self.checkout_branch],
-                        check=True,
-                        capture_output=True,
-                    )
-                except subprocess.CalledProcessError as error:
-                    logger.error("The specified branch to checkout does not exist.")
-                    raise InvalidInputError from error
+        """Check out the fetched commit as a clean worktree of the mirror.
+
+        Each commit gets its own worktree, shared by the generations using
+        it. Any change made to it since a previous run is discarded.
+        """
+        commit = self.fetched_commit()
+        self.template_dir = self.worktrees_dir / commit
+        try:
+            fetched = checkout_worktree(self.mirror_dir, self.template_dir, commit)
+        except GitError as error:
+            raise BrokenTemplateError(
+                f"The template could not be checked out: {error}"
+            ) from error
+        self.bytes_fetched += fetched
+        logger.info(
+            f"Template ready in {self.template_dir} "
+            f"({self.bytes_fetched} bytes transferred)"
+        )
+
+    @timed_phase
+    def prepare_template_files(self):
+        """Serve the template files from the objects of the fetched commit."""
+        commit = self.fetched_commit()
+        self.bytes_fetched += fetch_missing_blobs(self.mirror_dir, commit)
+        self.template_dir = None
+        self.template_files = GitTreeFiles(self.mirror_dir, commit)
+        logger.info(
+            f"Template ready at commit {commit} "
+            f"({self.bytes_fetched} bytes transferred)"
+        )
 
     @cached_property
     def last_commit_hash(self):
@@ -135,22 +290,131 @@ class Templator:  # pylint: disable=too-many-instance-attributes, too-many-argum
         checkout logic, storing the commit for a git repo on the filesystem
         is something useful which doesn't lead to unexpected side-effects.
         """
-        with cd(self.template_dir):
-            try:
-                return subprocess.run(
-                    ["git", "rev-parse", "HEAD"],
-                    check=True,
-                    capture_output=True,
-                    text=True,
-                ).stdout.strip()
-            except subprocess.CalledProcessError:
-                return None
+        if self.template_files is not None:
+            return getattr(self.template_files, "commit", None)
+        try:
+            return run_git("rev-parse", "HEAD", cwd=self.template_dir)
+        except GitError:
+            return None
+
+    @cached_property
+    def file_types(self):
+        """Return the cache telling which template files are binary.
+
+        It is only persisted when the template commit is known.
+        """
+        commit = self.last_commit_hash
+        if not commit:
+            return FileTypeCache()
+        return FileTypeCache(self.base_dir / "cache" / "file_types" / f"{commit}.json")
+
+    @cached_property
+    def bytecode_cache(self):
+        """Return the Jinja bytecode cache for this version of the template.
+
+        It is keyed by the template commit when known, by the location of
+        the template otherwise.
+        """
+        key = self.last_commit_hash
+        if not key:
+            location = self.template_dir or self.template_files.path
+            key = hashlib.sha1(str(location).encode()).hexdigest()
+        return BytecodeCache(self.base_dir / "cache" / "bytecode" / key)
+
+    @cached_property
+    def output_cache(self):
+        """Return the cache of the rendered outputs."""
+        return OutputCache(self.base_dir / "cache" / "outputs")
+
+    def output_cache_key(self):
+        """Return the key of the output in the OutputCache, None if not to be cached.
+
+        Only git templates are cached, local ones may change at any time.
+        """
+        if not self.cache_outputs or self.mirror_dir is None:
+            return None
+        commit = self.last_commit_hash
+        if not commit:
+            return None
+        return OutputCache.key(commit, self.context)
+
+    def is_finalize_cacheable(self):
+        """Tell whether `finalize.py` can be skipped by caching its output.
+
+        A template tells so by setting `CACHEABLE = True` in `finalize.py`.
+        """
+        try:
+            return bool(getattr(self.template_module("finalize"), "CACHEABLE", False))
+        except FileNotFoundError:
+            return True
+
+    @cached_property
+    def module_cache(self):
+        """Return the cache of the imported template modules."""
+        return ModuleCache(self.base_dir / "cache" / "bytecode" / "modules")
+
+    def template_module(self, name):
+        """Return the `name`.py module of the template, imported only once.
+
+        Raise FileNotFoundError if the template doesn't have one.
+        """
+        if name not in self._modules:
+            if self.template_files is not None:
+                self._modules[name] = self.module_cache.import_source(
+                    name,
+                    self.template_files.read_bytes(f"{name}.py"),
+                    self.template_files.origin(f"{name}.py"),
+                )
+            else:
+                self._modules[name] = self.module_cache.import_file(
+                    name, self.template_dir / f"{name}.py"
+                )
+        return self._modules[name]
+
+    def has_template_file(self, name):
+        """Tell whether the template has a file at the relative path `name`."""
+        if self.template_files is not None:
+            return self.template_files.exists(name)
+        return (self.template_dir / name).exists()
+
+    def with_output(self, destination_dir, context):
+        """Return a copy of the Templator to render `context` into `destination_dir`.
+
+        The copy shares the template, its caches and imported modules. The
+        destination directory is kept if None.
+        """
+        templator = copy.copy(self)
+        if destination_dir is not None:
+            templator.destination_dir = Path(destination_dir)
+        context = dict(context)
+        context.update({"pytemplator": context, "cookiecutter": context})
+        templator.context = context
+        return templator
+
+    @cached_property
+    def referenced_keys(self):
+        """Return the context keys the paths and content of the template files refer to.
 
+        None if they may refer to any key, e.g. through `pytemplator[key]`.
+        """
+        with self.template_tree() as (templates, _):
+            return TemplateIndex(
+                templates, make_jinja_env(templates), self.file_types
+            ).keys()
+
+    @timed_phase
     def generate_context(self):
-        """Generate the context for the `initialize` part of the template."""
+        """Generate the context for the `initialize` part of the template.
+
+        The questions not asked whose key the template files never refer to
+        are skipped, see `Context.resolve`, unless `finalize.py` may need them.
+        """
+        if self.has_template_file("finalize.py"):
+            token = REFERENCED_KEYS.set(None)
+        else:
+            token = REFERENCED_KEYS.set(lambda: self.referenced_keys)
         try:
-            initializer = (self.template_dir / "initialize.py").resolve(strict=True)
-            initialize = import_module_from_path(initializer)
+            initialize = self.template_module("initialize")
             self.context = initialize.generate_context(self.no_input)
             # This allows the user to call the variables {{ cookiecutter.var }} or
             # {{ pytemplator.var }} in the template for convenience.
@@ -167,88 +431,346 @@ class Templator:  # pylint: disable=too-many-instance-attributes, too-many-argum
                 "Falling back to checking a cookiecutter.json definition file."
             )
             try:
-                self.context = generate_context_from_json(
-                    json_file=(self.template_dir / "cookiecutter.json").resolve(
-                        strict=True,
-                    ),
-                    context=self.context,
-                    no_input=self.no_input,
-                )
+                if self.template_files is not None:
+                    self.context = generate_context_from_questions(
+                        questions=json.loads(
+                            self.template_files.read_bytes("cookiecutter.json"),
+                            object_pairs_hook=OrderedDict,
+                        ),
+                        context=self.context,
+                        no_input=self.no_input,
+                    )
+                else:
+                    self.context = generate_context_from_json(
+                        json_file=(self.template_dir / "cookiecutter.json").resolve(
+                            strict=True,
+                        ),
+                        context=self.context,
+                        no_input=self.no_input,
+                    )
             except FileNotFoundError as error:
                 raise BrokenTemplateError(
                     "The template is missing a valid initialize.py/cookiecutter.json."
                 ) from error
+        finally:
+            REFERENCED_KEYS.reset(token)
 
-    def render(self):
-        """Copy the folder/files with their names properly templated, then render them."""
-        templates = self.template_dir / "templates"
-        try:
-            templates = templates.resolve(strict=True)
-            root_directories = [
-                Path(f.path) for f in os.scandir(templates) if f.is_dir()
-            ]
+    def template_tree(self):
+        """Return a context manager over the template tree, see `open_template_tree`."""
+        if self.template_files is not None:
+            return open_template_files_tree(self.template_files)
+        return open_template_tree(self.template_dir)
+
+    def render(self, sink=None):
+        """Copy the folder/files with their names properly templated, then render them.
+
+        The files are written to the destination directory, or to `sink`.
+        """
+        with self.template_tree() as (templates, root_directories):
+            self.render_tree(templates, root_directories, sink=sink)
+        self.save_caches()
+
+    def render_tree(self, templates, root_directories, template_cache=None, sink=None):
+        """Render the template tree into the destination, then finalize it.
+
+        The files are generated into a staging directory, `finalize.py` runs
+        there too, and they are only moved into the destination once all
+        done. Generating into an existing project only rewrites the files
+        whose content changed, as recorded in its manifest.
+
+        The files can be written to a `sink` off the filesystem instead, such
+        as an archive. As `finalize.py` works on files, a template having one
+        is then generated in a temporary directory first.
+        """
+        if sink is None:
+            key = self.output_cache_key()
+            with StagedFileSystemSink(
+                self.destination_dir,
+                Manifest(self.destination_dir),
+                full_tree=self.has_template_file("finalize.py"),
+                durable=self.durable,
+            ) as sink:
+                if key is None:
+                    self._render_tree(
+                        templates,
+                        root_directories,
+                        template_cache,
+                        sink,
+                        sink.staging_dir,
+                    )
+                else:
+                    self._render_cached_tree(
+                        key, templates, root_directories, template_cache, sink
+                    )
+                with self.timer.span("commit"):
+                    sink.commit()
+            return
+        if sink.directory is None and self.has_template_file("finalize.py"):
+            with tempfile.TemporaryDirectory() as output_dir:
+                templator = copy.copy(self)
+                templator.destination_dir = Path(output_dir)
+                templator.render_tree(
+                    templates,
+                    root_directories,
+                    template_cache,
+                    FileSystemSink(output_dir),
+                )
+                sink.add_directory(output_dir)
+            return
+        self._render_tree(
+            templates, root_directories, template_cache, sink, self.destination_dir
+        )
+
+    def _render_tree(  # pylint: disable=too-many-arguments
+        self, templates, root_directories, template_cache, sink, output_dir
+    ):
+        """Render the template tree into the `sink`, then finalize `output_dir`."""
+        with self.timer.span("render_templates"):
             render_templates(
                 destination_dir=self.destination_dir,
                 templates=templates,
                 root_directories=root_directories,
                 context=self.context,
                 no_input=self.no_input,
+                jobs=self.jobs,
+                file_types=self.file_types,
+                bytecode_cache=self.bytecode_cache,
+                template_cache=template_cache,
+                sink=sink,
+                timer=self.timer,
             )
-        except FileNotFoundError:
-            root_directories = [
-                Path(f.path)
-                for f in os.scandir(self.template_dir)
-                if f.is_dir() and f.name not in RESERVED_DIR_NAMES
-            ]
-            with tempfile.TemporaryDirectory() as templates:
-                templates = Path(templates)
-                for directory in root_directories:
-                    os.symlink(directory, templates / directory.name)
-                render_templates(
-                    destination_dir=self.destination_dir,
-                    templates=templates,
-                    root_directories=root_directories,
-                    context=self.context,
-                    no_input=self.no_input,
-                )
-        self.finalize()
-        self.add_pytemplator_yaml()
+        self.finalize(output_dir)
+        self.add_pytemplator_yaml(sink)
 
-    def finalize(self):
-        """Run the `finalize` part of the template."""
+    def _render_cached_tree(  # pylint: disable=too-many-arguments
+        self, key, templates, root_directories, template_cache, sink
+    ):
+        """Link the output cached under `key` into the `sink`, rendering it if missing.
+
+        `finalize.py` then runs on the files staged by the sink, unless its
+        output is cached as well.
+        """
+        template_cache = template_cache or TemplateCache(
+            make_jinja_env(templates, self.bytecode_cache), self.timer
+        )
+        selector = TemplateSelector(template_cache, self.context)
+        check_if_new_dirs_can_be_created(
+            directories=selector.included_directories(root_directories),
+            context=self.context,
+            destination_dir=self.destination_dir,
+            no_input=self.no_input,
+            template_cache=template_cache,
+            manifest=sink.manifest,
+        )
+        finalize_cached = self.is_finalize_cacheable()
+        files = self.output_cache.get(key)
+        if files is None:
+            with self.output_cache.store(key) as output_dir:
+                with self.timer.span("render_templates"):
+                    render_templates(
+                        destination_dir=output_dir,
+                        templates=templates,
+                        root_directories=[],
+                        context=self.context,
+                        no_input=self.no_input,
+                        jobs=self.jobs,
+                        file_types=self.file_types,
+                        bytecode_cache=self.bytecode_cache,
+                        template_cache=template_cache,
+                        sink=FileSystemSink(output_dir),
+                        timer=self.timer,
+                    )
+                if finalize_cached:
+                    self.finalize(output_dir)
+            files = self.output_cache.get(key)
+            if files is None:
+                raise BrokenTemplateError(f"The output {key} could not be cached.")
+        else:
+            logger.info(f"Reusing the output cached as {key}")
+        with self.timer.span("link_cached_output"):
+            files_dir = self.output_cache.files_dir(key)
+            for path, digest in files.items():
+                sink.link_file(path, files_dir / path, digest)
+        if not finalize_cached:
+            self.finalize(sink.staging_dir)
+        self.add_pytemplator_yaml(sink)
+
+    def plan(self):
+        """Return the Plan of rendering the template, without writing anything."""
+        with self.template_tree() as (templates, _):
+            plan = self.plan_tree(templates)
+        self.save_caches()
+        return plan
+
+    def plan_tree(self, templates, template_cache=None):
+        """Return the Plan of rendering the template tree into the destination.
+
+        The files are rendered as for `render_tree` but only hashed, and
+        compared with those in the destination directory. `finalize.py`
+        works on written files, so it is not run.
+        """
+        sink = PlanSink()
+        with self.timer.span("render_templates"):
+            render_templates(
+                destination_dir=self.destination_dir,
+                templates=templates,
+                root_directories=[],
+                context=self.context,
+                no_input=self.no_input,
+                jobs=self.jobs,
+                file_types=self.file_types,
+                bytecode_cache=self.bytecode_cache,
+                template_cache=template_cache,
+                sink=sink,
+                timer=self.timer,
+            )
+        self.add_pytemplator_yaml(sink)
+        return sink.plan(self.destination_dir)
+
+    def plan_many(self, contexts, destination_root):
+        """Return the Plan of rendering the template once for each of the `contexts`.
+
+        This is the counterpart of `render_many`, the compiled templates
+        being shared across the contexts. Return a RenderResult per context,
+        in order, holding either its plan or the error raised.
+        """
+        destination_root = Path(destination_root)
+        results = []
+        with self.template_tree() as (templates, _):
+            template_cache = TemplateCache(
+                make_jinja_env(templates, self.bytecode_cache), self.timer
+            )
+            for index, context in enumerate(contexts):
+                context = dict(context)
+                destination = str(context.pop("_destination", index))
+                destination_dir = destination_root / destination
+                try:
+                    destination_dir = resolve_destination(destination_root, destination)
+                    plan = self.with_output(destination_dir, context).plan_tree(
+                        templates, template_cache
+                    )
+                except Exception as error:  # pylint: disable=broad-except
+                    logger.error(f"Failed to plan {destination_dir}: {error!r}")
+                    results.append(RenderResult(destination_dir, error))
+                    continue
+                results.append(RenderResult(destination_dir, None, plan))
+        self.save_caches()
+        return results
+
+    def render_many(self, contexts, destination_root):
+        """Render the template once for each of the `contexts`.
+
+        Each output goes in its own subdirectory of `destination_root`, named
+        after the `_destination` key of its context, or its index otherwise.
+        A `_destination` outside of `destination_root` fails its output.
+        The outputs are generated by `jobs` threads, sharing the template
+        tree and its compiled templates.
+
+        Return a RenderResult per context, in order. A failed output doesn't
+        prevent the others from being generated.
+        """
+        destination_root = Path(destination_root).resolve(strict=True)
+        # Resolved once and for all before being shared across the threads.
+        _ = self.file_types, self.bytecode_cache
+        # Several outputs prompting the user at once would be confusing.
+        jobs = self.jobs if self.no_input else 1
+
+        def generate(index, context, templates, root_directories, template_cache):
+            context = dict(context)
+            destination = str(context.pop("_destination", index))
+            destination_dir = destination_root / destination
+            try:
+                destination_dir = resolve_destination(destination_root, destination)
+                destination_dir.mkdir(parents=True, exist_ok=True)
+                templator = self.with_output(destination_dir, context)
+                templator.jobs = 1
+                templator.render_tree(templates, root_directories, template_cache)
+            except Exception as error:  # pylint: disable=broad-except
+                logger.error(f"Failed to generate {destination_dir}: {error!r}")
+                return RenderResult(destination_dir, error)
+            logger.info(f"Generated {destination_dir}")
+            return RenderResult(destination_dir, None)
+
+        with self.template_tree() as (templates, root_directories):
+            template_cache = TemplateCache(
+                make_jinja_env(templates, self.bytecode_cache), self.timer
+            )
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                futures = [
+                    executor.submit(
+                        generate,
+                        index,
+                        context,
+                        templates,
+                        root_directories,
+                        template_cache,
+                    )
+                    for index, context in enumerate(contexts)
+                ]
+                results = [future.result() for future in futures]
+        self.save_caches()
+        return results
+
+    @timed_phase
+    def save_caches(self):
+        """Persist what was learnt about the template for the next runs."""
+        self.file_types.save()
+        # Parallel renders fill the cache from their own processes.
+        if self.bytecode_cache.has_new_entries or self.jobs > 1:
+            prune_bytecode_cache(
+                self.base_dir / "cache" / "bytecode", BYTECODE_CACHE_MAX_SIZE
+            )
+            self.bytecode_cache.has_new_entries = False
+        if self.output_cache.has_new_entries:
+            prune_output_cache(
+                self.output_cache.directory,
+                OUTPUT_CACHE_MAX_SIZE,
+                OUTPUT_CACHE_MAX_AGE,
+            )
+            self.output_cache.has_new_entries = False
+
+    @timed_phase
+    def finalize(self, output_dir=None):
+        """Run the `finalize` part of the template.
+
+        It works on `output_dir`, the destination directory by default.
+        """
 
         try:
-            finalizer = (self.template_dir / "finalize.py").resolve(strict=True)
-            final_script = import_module_from_path(finalizer)
-            final_script.finalize(context=self.context, output_dir=self.destination_dir)
+            final_script = self.template_module("finalize")
+            final_script.finalize(
+                context=self.context, output_dir=output_dir or self.destination_dir
+            )
         except FileNotFoundError:
             return
 
-    def add_pytemplator_yaml(self):
+    @timed_phase
+    def add_pytemplator_yaml(self, sink=None):
         """Add a `.pytemplator.yml` config file.
 
         This allows for future automated boilerplate update to follow
         the latest version of the template.
         """
-        with open(
-            self.destination_dir / ".pytemplator.yml", "w", encoding="UTF-8"
-        ) as conf_file:
-            conf_file.write(
-                "# This is an automated file generated by the PyTemplator package.\n"
-                "# It is used to update the boilerplate to follow the latest\n"
-                "# version of the template.\n\n"
-            )
-            context = dict(self.context)
-            context.pop("pytemplator", None)
-            context.pop("cookiecutter", None)
-            yaml.dump(
-                {
-                    "pytemplator_version": __version__,
-                    "template_location": self.template_location,
-                    "checkout_branch": self.checkout_branch,
-                    "template_commit": self.last_commit_hash,
-                    "context": context,
-                },
-                conf_file,
-            )
-            conf_file.write("\n")
+        # Only imported when needed, to keep the startup time of the CLI low.
+        import yaml  # pylint: disable=import-outside-toplevel
+
+        sink = sink or FileSystemSink(self.destination_dir)
+        context = dict(self.context)
+        context.pop("pytemplator", None)
+        context.pop("cookiecutter", None)
+        config = yaml.dump(
+            {
+                "pytemplator_version": __version__,
+                "template_location": self.template_location,
+                "checkout_branch": self.checkout_branch,
+                "template_commit": self.last_commit_hash,
+                "context": context,
+            }
+        )
+        sink.write_text(
+            CONFIG_FILE,
+            "# This is an automated file generated by the PyTemplator package.\n"
+            "# It is used to update the boilerplate to follow the latest\n"
+            "# version of the template.\n\n"
+            f"{config}\n",
+        )
@@ -0,0 +1,461 @@
+"""Long-running generation server keeping the templates warm in memory.
+
+Each version of a template is loaded once: its files are snapshotted, its
+`initialize.py` and `finalize.py` imported and its Jinja environment kept
+along with the compiled templates. Requests then only pay for rendering.
+
+The server speaks HTTP, over TCP or a Unix socket:
+
+- `POST /render` generates a project from a JSON body with the keys
+  `template` (location, required), `branch` (defaults to main), `context`
+  (generated by the template when missing) and either `destination`, a
+  directory relative to the destination root of the server, or `archive`
+  to get the project streamed back as a gzipped tarball, or a zip archive
+  if set to "zip".
+- `GET /templates` lists the loaded templates.
+
+As rendering runs the `initialize.py` of the template requested, requests
+sent by web pages, which carry an `Origin` header, are refused, and a POST
+body must be of type `application/json`, which a page can't send to another
+origin without the server agreeing to it. The server can also require a
+bearer token and restrict the templates to glob patterns of locations.
+"""
+
+import hmac
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from socketserver import ThreadingMixIn, UnixStreamServer
+
+from loguru import logger
+
+from pytemplator import __version__
+from pytemplator.exceptions import (
+    BrokenTemplateError,
+    InvalidInputError,
+    NoInputOptionNotHandledByTemplateError,
+)
+from pytemplator.git import export_tree
+from pytemplator.pytemplator import Templator
+from pytemplator.sinks import open_archive_sink
+from pytemplator.utils import (
+    TemplateCache,
+    compile_glob_patterns,
+    make_jinja_env,
+    resolve_destination,
+)
+
+
+class WarmTemplate:  # pylint: disable=too-many-instance-attributes
+    """A version of a template loaded in memory, ready to be rendered."""
+
+    def __init__(self, templator, snapshots_dir):
+        """Load the template of a freshly prepared Templator."""
+        self.templator = templator
+        self.commit = templator.last_commit_hash
+        self.loaded_at = time.time()
+        # How many requests are rendering it, it is only closed once unused.
+        self.users = 0
+        self.retired = False
+        self._exit_stack = ExitStack()
+        # Resolved while the commit can still be read from the template dir.
+        _ = templator.file_types, templator.bytecode_cache
+        if templator.template_dir is not None and templator.mirror_dir is not None:
+            # The worktree is checked out again when the branch moves on,
+            # the requests in flight keep rendering from this snapshot.
+            snapshots_dir.mkdir(parents=True, exist_ok=True)
+            snapshot = Path(
+                self._exit_stack.enter_context(
+                    tempfile.TemporaryDirectory(dir=snapshots_dir)
+                )
+            )
+            export_tree(templator.template_dir, self.commit, snapshot)
+            templator.template_dir = snapshot
+        self.templates, self.root_directories = self._exit_stack.enter_context(
+            templator.template_tree()
+        )
+        self.template_cache = TemplateCache(
+            make_jinja_env(self.templates, templator.bytecode_cache), templator.timer
+        )
+        for name in ("initialize", "finalize"):
+            try:
+                templator.template_module(name)
+            except FileNotFoundError:
+                continue
+
+    def render(self, destination_dir, context=None, sink=None):
+        """Render the template into `destination_dir`, or `sink` if given.
+
+        The context is generated by the template without input if not given.
+        """
+        templator = self.templator.with_output(destination_dir, context or {})
+        if context is None:
+            templator.context = {"cookiecutter": {}, "pytemplator": {}}
+            templator.generate_context()
+        templator.render_tree(
+            self.templates, self.root_directories, self.template_cache, sink
+        )
+        return templator
+
+    def close(self):
+        """Persist the caches and delete the snapshot."""
+        self.templator.save_caches()
+        self._exit_stack.close()
+
+
+class TemplatePool:
+    """The templates loaded by the server, keyed by location and commit.
+
+    The branch of a git template is fetched again once its loaded version
+    is older than `fetch_ttl` seconds. A new commit is loaded alongside the
+    previous one, which is only closed once the requests using it are done.
+    """
+
+    def __init__(self, base_dir=None, fetch_ttl=60, offline=False):
+        """Set up an empty pool."""
+        self.base_dir = base_dir
+        self.fetch_ttl = fetch_ttl
+        self.offline = offline
+        self._lock = threading.Lock()
+        self._refresh_locks = {}
+        # (location, branch) -> WarmTemplate of the commit last fetched
+        self._heads = {}
+        # (location, commit) -> WarmTemplate
+        self._templates = {}
+
+    @contextmanager
+    def use(self, location, branch="main"):
+        """Yield the WarmTemplate of the latest commit of the branch."""
+        key = (location, branch)
+        with self._lock:
+            refresh_lock = self._refresh_locks.setdefault(key, threading.Lock())
+        with refresh_lock:
+            head = self._heads.get(key)
+            if head is None or time.time() - head.loaded_at >= self.fetch_ttl:
+                self._load(location, branch)
+            with self._lock:
+                template = self._heads[key]
+                template.users += 1
+        try:
+            yield template
+        finally:
+            with self._lock:
+                template.users -= 1
+                unused = template.retired and not template.users
+            if unused:
+                template.close()
+
+    def _load(self, location, branch):
+        """Fetch the branch and load its commit, unless already loaded."""
+        templator = Templator(
+            base_dir=self.base_dir,
+            template_location=location,
+            checkout_branch=branch,
+            no_input=True,
+            offline=self.offline,
+            fetch_ttl=self.fetch_ttl,
+        )
+        commit = templator.last_commit_hash
+        with self._lock:
+            # Without a commit, the template is loaded again from disk.
+            template = self._templates.get((location, commit)) if commit else None
+        if template is None:
+            template = WarmTemplate(
+                templator, Path(templator.base_dir) / "server_snapshots"
+            )
+            logger.info(f"Loaded {location}@{branch} ({commit or 'local'})")
+        template.loaded_at = time.time()
+        with self._lock:
+            previous = self._heads.get((location, branch))
+            self._heads[(location, branch)] = template
+            self._templates[(location, commit)] = template
+            unused = False
+            if previous is not None and previous not in self._heads.values():
+                previous.retired = True
+                if self._templates.get((location, previous.commit)) is previous:
+                    del self._templates[(location, previous.commit)]
+                unused = not previous.users
+        if unused:
+            previous.close()
+
+    def describe(self):
+        """Return the location, branch and commit of the loaded templates."""
+        with self._lock:
+            return [
+                {
+                    "template": location,
+                    "branch": branch,
+                    "commit": template.commit,
+                    "loaded_at": template.loaded_at,
+                }
+                for (location, branch), template in self._heads.items()
+            ]
+
+    def close(self):
+        """Close all the loaded templates."""
+        with self._lock:
+            templates = set(self._templates.values()) | set(self._heads.values())
+            self._templates.clear()
+            self._heads.clear()
+        for template in templates:
+            template.close()
+
+
+class ChunkedResponse:
+    """Writable file object streaming the body of a response in chunks.
+
+    The headers are only sent along with the first chunk, so that an error
+    raised before anything got written can still be reported.
+    """
+
+    def __init__(self, handler, content_type="application/octet-stream"):
+        """Set the request handler to respond through."""
+        self.handler = handler
+        self.content_type = content_type
+        self.started = False
+
+    def write(self, data):
+        """Send a chunk of the body."""
+        if not data:
+            return 0
+        self._start()
+        self.handler.wfile.write(f"{len(data):x}\r\n".encode())
+        self.handler.wfile.write(data)
+        self.handler.wfile.write(b"\r\n")
+        return len(data)
+
+    def flush(self):
+        """Flush what was sent so far."""
+        self.handler.wfile.flush()
+
+    def finish(self):
+        """Send the end of the body."""
+        self._start()
+        self.handler.wfile.write(b"0\r\n\r\n")
+
+    def _start(self):
+        """Send the headers of the response, once."""
+        if self.started:
+            return
+        self.started = True
+        self.handler.send_response(HTTPStatus.OK)
+        self.handler.send_header("Content-Type", self.content_type)
+        self.handler.send_header("Transfer-Encoding", "chunked")
+        self.handler.end_headers()
+
+
+class GenerationRequestHandler(BaseHTTPRequestHandler):
+    """Handle the requests of the generation server."""
+
+    server_version = f"pytemplator/{__version__}"
+    protocol_version = "HTTP/1.1"
+
+    def refusal(self):
+        """Return the status and reason to refuse the request with, None if allowed."""
+        if self.headers.get("Origin") is not None:
+            return HTTPStatus.FORBIDDEN, "Requests from web pages are not allowed."
+        token = self.server.token
+        if token and not hmac.compare_digest(
+            self.headers.get("Authorization", "").encode(), f"Bearer {token}".encode()
+        ):
+            return HTTPStatus.UNAUTHORIZED, "Missing or invalid bearer token."
+        if (
+            self.command == "POST"
+            and self.headers.get_content_type() != "application/json"
+        ):
+            return (
+                HTTPStatus.UNSUPPORTED_MEDIA_TYPE,
+                "The body must be of type application/json.",
+            )
+        return None
+
+    def refuse(self):
+        """Refuse the request if not allowed, return whether it was."""
+        refusal = self.refusal()
+        if refusal is None:
+            return False
+        status, reason = refusal
+        # The body may not have been read.
+        self.close_connection = True
+        self.send_json(status, {"error": reason})
+        return True
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """List the loaded templates."""
+        if self.refuse():
+            return
+        if self.path != "/templates":
+            self.send_json(HTTPStatus.NOT_FOUND, {"error": f"Unknown path {self.path}"})
+            return
+        self.send_json(HTTPStatus.OK, {"templates": self.server.pool.describe()})
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        """Generate a project."""
+        if self.refuse():
+            return
+        if self.path != "/render":
+            self.send_json(HTTPStatus.NOT_FOUND, {"error": f"Unknown path {self.path}"})
+            return
+        response = ChunkedResponse(self)
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length) or b"{}")
+            result = self.server.render(request, response)
+        except (
+            ValueError,
+            FileNotFoundError,
+            InvalidInputError,
+            BrokenTemplateError,
+            NoInputOptionNotHandledByTemplateError,
+        ) as error:
+            self.send_error_json(response, HTTPStatus.BAD_REQUEST, error)
+        except Exception as error:  # pylint: disable=broad-except
+            logger.exception("Failed to handle a generation request.")
+            self.send_error_json(response, HTTPStatus.INTERNAL_SERVER_ERROR, error)
+        else:
+            if result is None:
+                response.finish()
+            else:
+                self.send_json(HTTPStatus.OK, result)
+
+    def send_error_json(self, response, status, error):
+        """Report an error, unless the response is already being streamed."""
+        if response.started:
+            # Too late for a status, the client gets a truncated response.
+            logger.error(f"Failed to stream a generated archive: {error!r}")
+            self.close_connection = True
+            return
+        self.send_json(status, {"error": repr(error)})
+
+    def send_json(self, status, content):
+        """Send a JSON response."""
+        self.send_body(status, "application/json", json.dumps(content).encode())
+
+    def send_body(self, status, content_type, body):
+        """Send a response with the given body."""
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        """Log the requests through loguru, Unix sockets having no client address."""
+        logger.debug(f"{self.command} {self.path}: {format % args}")
+
+
+class GenerationServerMixin:
+    """Render the projects requested to a server."""
+
+    def setup_generation(
+        self, pool, destination_root, token=None, allowed_templates=None
+    ):
+        """Set the pool of templates and the directory the outputs go under.
+
+        With a `token`, requests must carry it as a bearer token. With
+        `allowed_templates`, glob patterns, only the template locations
+        matching one of them can be rendered.
+        """
+        self.pool = pool
+        self.destination_root = Path(destination_root).resolve(strict=True)
+        self.token = token
+        self.is_allowed_template = (
+            compile_glob_patterns(list(allowed_templates))
+            if allowed_templates
+            else lambda location: True
+        )
+
+    def render(self, request, response):
+        """Render the project described by a request.
+
+        Return the description of the generated project, or None if it was
+        streamed to the ChunkedResponse `response` as an archive.
+        """
+        if not isinstance(request, dict) or not isinstance(
+            request.get("template"), str
+        ):
+            raise InvalidInputError("The request must give the `template` location.")
+        if not self.is_allowed_template(request["template"]):
+            raise InvalidInputError(
+                f"The template {request['template']} is not allowed on this server."
+            )
+        context = request.get("context")
+        if context is not None and not isinstance(context, dict):
+            raise InvalidInputError("The `context` must be an object.")
+        with self.pool.use(
+            request["template"], request.get("branch") or "main"
+        ) as template:
+            if request.get("archive"):
+                is_zip = request["archive"] == "zip"
+                response.content_type = (
+                    "application/zip" if is_zip else "application/gzip"
+                )
+                # Not closed on error, which would stream the end of the archive.
+                sink = open_archive_sink(response, ".zip" if is_zip else ".tar.gz")
+                template.render(None, context, sink)
+                sink.close()
+                return None
+            destination = self.destination_for(request.get("destination"))
+            templator = template.render(destination, context)
+        return {"destination": str(destination), "commit": templator.last_commit_hash}
+
+    def destination_for(self, destination):
+        """Return the directory to render into, which must be under the root."""
+        if not isinstance(destination, str):
+            raise InvalidInputError(
+                "The request must give a `destination` or `archive`."
+            )
+        path = resolve_destination(self.destination_root, destination)
+        path.mkdir(parents=True, exist_ok=True)
+        return path
+
+
+class GenerationServer(GenerationServerMixin, ThreadingHTTPServer):
+    """Generation server listening on a TCP port."""
+
+    daemon_threads = True
+
+    def __init__(self, address, pool, destination_root, **kwargs):
+        """Bind the server to the (host, port) address, see `setup_generation`."""
+        super().__init__(address, GenerationRequestHandler)
+        self.setup_generation(pool, destination_root, **kwargs)
+
+
+class UnixGenerationServer(GenerationServerMixin, ThreadingMixIn, UnixStreamServer):
+    """Generation server listening on a Unix socket."""
+
+    daemon_threads = True
+
+    def __init__(self, path, pool, destination_root, **kwargs):
+        """Bind the server to the socket at `path`, replacing a stale one."""
+        if os.path.exists(path) and _is_stale_socket(path):
+            os.unlink(path)
+        super().__init__(str(path), GenerationRequestHandler)
+        self.setup_generation(pool, destination_root, **kwargs)
+
+    def server_close(self):
+        """Remove the socket file along with the server."""
+        super().server_close()
+        try:
+            os.unlink(self.server_address)
+        except OSError:
+            pass
+
+
+def _is_stale_socket(path):
+    """Tell whether nothing is listening on the Unix socket at `path`."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        try:
+            client.connect(str(path))
+        except ConnectionRefusedError:
+            return True
+        except OSError:
+            return False
+    return False
@@ -0,0 +1,545 @@
+"""Sinks receiving the generated files.
+
+The generated files are written to a sink, by their path relative to the
+root of the output: a directory on the filesystem, a dictionary in memory
+or an archive streamed to any writable file object, e.g. a socket.
+"""
+
+import abc
+import ctypes
+import functools
+import hashlib
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import time
+import zipfile
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+from loguru import logger
+
+from pytemplator.constants import (
+    FICLONE,
+    STAGING_DIR_PREFIX,
+    STREAMING_BUFFER_SIZE,
+    STREAMING_THRESHOLD,
+)
+from pytemplator.manifest import hash_bytes, hash_file, remove_empty_parents
+
+
+def copy_file(source, destination):
+    """Copy a file byte for byte, preserving its mode bits.
+
+    The data never goes through Python: we try a reflink first, sharing the
+    blocks on filesystems supporting it (Btrfs, XFS...), then an in-kernel
+    `copy_file_range`, and finally `shutil.copyfile` which uses `sendfile`.
+    """
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    with open(source, "rb") as src, open(destination, "wb") as dst:
+        copied = _reflink(src, dst) or _copy_file_range(src, dst)
+    if not copied:
+        shutil.copyfile(source, destination)
+    shutil.copymode(source, destination)
+
+
+def link_file(source, destination):
+    """Make `destination` share the content of the file at `source`, without copying it.
+
+    A reflink is tried first, then a hardlink, and a copy as a last resort.
+    Unlike a reflink, a hardlink shares the file itself: editing either of
+    them in place edits both.
+    """
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    with open(source, "rb") as src, open(destination, "wb") as dst:
+        cloned = _reflink(src, dst)
+    if cloned:
+        shutil.copymode(source, destination)
+        return
+    destination.unlink()
+    try:
+        os.link(source, destination)
+    except OSError:
+        copy_file(source, destination)
+
+
+def _reflink(src, dst):
+    """Clone `src` into `dst`, return whether the filesystem allowed it."""
+    if fcntl is None:
+        return False
+    try:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    except OSError:
+        return False
+    return True
+
+
+def _copy_file_range(src, dst):
+    """Copy `src` into `dst` in the kernel, return whether it succeeded."""
+    if not hasattr(os, "copy_file_range"):
+        return False
+    size = os.fstat(src.fileno()).st_size
+    copied = 0
+    try:
+        while copied < size:
+            sent = os.copy_file_range(src.fileno(), dst.fileno(), size - copied)
+            if not sent:
+                break
+            copied += sent
+    except OSError:
+        # Not supported, e.g. across devices on older kernels.
+        return False
+    return copied == size
+
+
+class Sink(abc.ABC):
+    """Base class of the sinks, receiving the generated files by relative path.
+
+    Sinks are context managers, closed on exit.
+    """
+
+    # Whether files can be written from several threads at once.
+    concurrent_writes = False
+    # The directory the files end up in, None if not on the filesystem.
+    directory = None
+
+    @abc.abstractmethod
+    def write_bytes(self, path: str, data: bytes, mode=None):
+        """Write a file with the given content, and mode bits if not the default."""
+
+    def write_text(self, path: str, content: str):
+        """Write a file with the given text content."""
+        self.write_bytes(path, content.encode("UTF-8"))
+
+    def write_chunks(self, path: str, chunks):
+        """Write a file from an iterator over chunks of its text content."""
+        self.write_text(path, "".join(chunks))
+
+    def copy_file(self, path: str, source):
+        """Write a copy of the file at `source`."""
+        self.write_bytes(path, Path(source).read_bytes())
+
+    def link_file(self, path: str, source, digest: str):
+        """Write the file at `source`, whose content hash is `digest`, sharing its content.
+
+        The file at `source` must never change, see `link_file`.
+        """
+        self.copy_file(path, source)
+
+    def add_directory(self, directory):
+        """Write a copy of all the files under `directory`."""
+        directory = Path(directory)
+        for root, _, files in sorted(os.walk(directory)):
+            for name in sorted(files):
+                source = Path(root) / name
+                self.copy_file(source.relative_to(directory).as_posix(), source)
+
+    def finish(self):
+        """Called once all the generated files have been written."""
+
+    def close(self):
+        """Release the resources of the sink."""
+
+    def __enter__(self):
+        """Return the sink itself."""
+        return self
+
+    def __exit__(self, *exc_info):
+        """Close the sink."""
+        self.close()
+
+
+class FileSystemSink(Sink):
+    """Write the files under a directory.
+
+    With a `manifest`, the files whose content is unchanged are left
+    untouched and the stale ones are removed when finishing.
+    """
+
+    concurrent_writes = True
+    # Whether the files can be hardlinked, see `link_file`.
+    hardlinks = True
+
+    def __init__(self, directory, manifest=None):
+        """Set the directory to write into."""
+        self.directory = Path(directory)
+        self.manifest = manifest
+
+    def write_bytes(self, path, data, mode=None):
+        """Write a file, creating its parents if needed."""
+        if self.manifest is not None and self._is_unchanged(
+            path, hash_bytes(data), len(data)
+        ):
+            self._keep(path)
+            return
+        output = self._output_path(path)
+        output.parent.mkdir(parents=True, exist_ok=True)
+        output.write_bytes(data)
+        if mode is not None:
+            output.chmod(mode)
+
+    def write_chunks(self, path, chunks):
+        """Stream the chunks to the file, memory staying flat."""
+        output = self._output_path(path)
+        output.parent.mkdir(parents=True, exist_ok=True)
+        if self.manifest is None:
+            with open(
+                output, "w", encoding="UTF-8", buffering=STREAMING_BUFFER_SIZE
+            ) as templated_file:
+                templated_file.writelines(chunks)
+            return
+        # Hashed as it is written aside, then only moved in place if it changed.
+        tmp_path = output.with_name(f".{output.name}.{os.getpid()}.tmp")
+        digest = hashlib.sha256()
+        try:
+            with open(
+                tmp_path, "wb", buffering=STREAMING_BUFFER_SIZE
+            ) as templated_file:
+                for chunk in chunks:
+                    data = chunk.encode("UTF-8")
+                    digest.update(data)
+                    templated_file.write(data)
+                size = templated_file.tell()
+            if self._is_unchanged(path, digest.hexdigest(), size):
+                tmp_path.unlink()
+                self._keep(path)
+            else:
+                os.replace(tmp_path, output)
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            raise
+
+    def copy_file(self, path, source):
+        """Copy the file, see `copy_file`."""
+        if self.manifest is not None and self._is_unchanged(
+            path, hash_file(source), os.stat(source).st_size
+        ):
+            self._keep(path)
+            return
+        copy_file(source, self._output_path(path))
+
+    def link_file(self, path, source, digest):
+        """Link the file, or copy it if it can't be hardlinked, see `link_file`."""
+        if self.manifest is not None and self._is_unchanged(
+            path, digest, os.stat(source).st_size
+        ):
+            self._keep(path)
+            return
+        if self.hardlinks:
+            link_file(source, self._output_path(path))
+        else:
+            copy_file(source, self._output_path(path))
+
+    def finish(self):
+        """Remove the stale files and save the manifest."""
+        if self.manifest is None:
+            return
+        for removed in self.manifest.remove_stale():
+            logger.info(f"Removed {removed}, not generated anymore.")
+        self.manifest.save()
+
+    def _is_unchanged(self, path, digest, size):
+        """Record the file in the manifest, tell whether it already has this content."""
+        target = self.directory / path
+        self.manifest.record(target, digest)
+        return self.manifest.is_unchanged(target, digest, size)
+
+    def _output_path(self, path):
+        """Return where to write the file at `path`."""
+        return self.directory / path
+
+    def _keep(self, path):
+        """Called for each file left untouched as its content is unchanged."""
+
+
+class StagedFileSystemSink(FileSystemSink):
+    """Write the files under a directory, but only once they are all generated.
+
+    The files are written into a staging directory, created within
+    `directory` so that it is on the same filesystem, and only moved into
+    place by `commit`: the directories new to `directory` with a single
+    rename each, the files of the existing ones with a rename per file.
+    Until then, `directory` is left untouched, so a generation failing or
+    interrupted halfway never leaves a half-generated project behind. The
+    staging directory is deleted when the sink is closed, or by the next
+    generation if the process died.
+
+    Unchanged files are not written, unless `full_tree` is set, in which
+    case they are copied so that the staging directory holds the whole
+    output, e.g. for `finalize.py` to work on. The files it deletes are
+    then deleted from `directory` as well. Files are never hardlinked in that
+    case, as `finalize.py` could edit them in place.
+
+    With `durable`, the data is flushed to disk before the files are moved,
+    and the directories they are moved into once they all are, so that the
+    output survives a power loss. This costs a sync and an fsync per
+    directory, rather than an fsync per file.
+    """
+
+    def __init__(self, directory, manifest=None, full_tree=False, durable=False):
+        """Create the staging directory."""
+        super().__init__(directory, manifest)
+        self.full_tree = full_tree
+        self.durable = durable
+        self.hardlinks = not full_tree
+        remove_abandoned_staging_dirs(self.directory)
+        self.staging_dir = Path(
+            tempfile.mkdtemp(
+                prefix=f"{STAGING_DIR_PREFIX}{os.getpid()}-", dir=self.directory
+            )
+        )
+        self._kept = set()
+
+    def finish(self):
+        """Wait for `commit` to move the files into place."""
+
+    def commit(self):
+        """Move the staged files into place, remove the stale ones and save the manifest."""
+        if self.durable:
+            # Flushes every staged file at once.
+            sync_filesystem(self.staging_dir)
+        if self.full_tree and self.manifest is not None:
+            self._remove_deleted_files()
+        moved_into = self._move_tree()
+        if self.manifest is not None:
+            for removed in self.manifest.remove_stale():
+                logger.info(f"Removed {removed}, not generated anymore.")
+                moved_into.add((self.directory / removed).parent)
+            self.manifest.save(durable=self.durable)
+            moved_into.add(self.directory)
+        if self.durable:
+            for directory in sorted(moved_into):
+                # Its stale files may have left it empty, and so removed.
+                while not directory.is_dir():
+                    directory = directory.parent
+                fsync_directory(directory)
+        self.close()
+
+    def close(self):
+        """Delete the staging directory and whatever was not committed."""
+        shutil.rmtree(self.staging_dir, ignore_errors=True)
+
+    def _output_path(self, path):
+        """Return where to stage the file at `path`."""
+        return self.staging_dir / path
+
+    def _keep(self, path):
+        """Copy the unchanged file too if the whole output is staged."""
+        if self.full_tree:
+            copy_file(self.directory / path, self.staging_dir / path)
+            self._kept.add(Path(path).as_posix())
+
+    def _is_kept(self, staged_path):
+        """Tell whether the staged file is a copy of an unchanged file, left as is."""
+        key = staged_path.relative_to(self.staging_dir).as_posix()
+        return (
+            key in self._kept and hash_file(staged_path) == self.manifest.entries[key]
+        )
+
+    def _remove_deleted_files(self):
+        """Delete the generated files which were deleted from the staging directory."""
+        for key in sorted(self.manifest.entries):
+            if (self.staging_dir / key).exists():
+                continue
+            target = self.directory / key
+            target.unlink(missing_ok=True)
+            remove_empty_parents(target, self.directory)
+            self.manifest.forget(target)
+
+    def _move_tree(self):
+        """Move the staged files into place, return the directories moved into."""
+        moved_into = set()
+        for root, dirs, files in os.walk(self.staging_dir):
+            root = Path(root)
+            into = self.directory / root.relative_to(self.staging_dir)
+            for name in list(dirs):
+                if not os.path.lexists(into / name):
+                    os.rename(root / name, into / name)
+                    dirs.remove(name)
+                    moved_into.add(into)
+            for name in files:
+                if not self._is_kept(root / name):
+                    os.replace(root / name, into / name)
+                    moved_into.add(into)
+        return moved_into
+
+
+def remove_abandoned_staging_dirs(directory):
+    """Delete the staging directories left in `directory` by dead processes."""
+    for entry in os.scandir(directory):
+        if not entry.name.startswith(STAGING_DIR_PREFIX):
+            continue
+        pid = entry.name.removeprefix(STAGING_DIR_PREFIX).split("-", 1)[0]
+        if pid.isdigit() and not _is_running(int(pid)):
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+
+def _is_running(pid):
+    """Tell whether a process with this id is running."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Running, as another user.
+        pass
+    return True
+
+
+def sync_filesystem(directory):
+    """Flush the filesystem holding `directory` to disk, see syncfs(2).
+
+    Only that filesystem is flushed, unlike with `os.sync`, which is still
+    the fallback where syncfs isn't available.
+    """
+    syncfs = _libc_syncfs()
+    if syncfs is None:
+        os.sync()
+        return
+    descriptor = os.open(directory, os.O_RDONLY)
+    try:
+        if syncfs(descriptor) != 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), str(directory))
+    finally:
+        os.close(descriptor)
+
+
+@functools.lru_cache(maxsize=None)
+def _libc_syncfs():
+    """Return the syncfs function of the C library, None if missing."""
+    try:
+        return getattr(ctypes.CDLL(None, use_errno=True), "syncfs", None)
+    except (OSError, TypeError):
+        return None
+
+
+def fsync_directory(directory):
+    """Flush the entries of `directory` to disk, e.g. after files were renamed in it."""
+    descriptor = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+
+class MemorySink(Sink):
+    """Keep the files in memory, in the `files` dictionary of their content."""
+
+    concurrent_writes = True
+
+    def __init__(self):
+        """Start with no files."""
+        self.files = {}
+
+    def write_bytes(self, path, data, mode=None):
+        """Keep the file content."""
+        self.files[path] = data
+
+
+class TarSink(Sink):
+    """Stream the files into a tarball written to `fileobj`.
+
+    The archive is compressed with gzip by default, see `tarfile` for the
+    other `compression` methods. `fileobj` doesn't need to be seekable.
+    """
+
+    def __init__(self, fileobj, compression="gz"):
+        """Start the archive."""
+        self._archive = tarfile.open(
+            fileobj=fileobj, mode=f"w|{compression}", format=tarfile.PAX_FORMAT
+        )
+        self._mtime = time.time()
+
+    def _add(self, path, fileobj, size, mode=0o644):
+        """Add a file to the archive."""
+        info = tarfile.TarInfo(path)
+        info.size = size
+        info.mode = mode
+        info.mtime = self._mtime
+        self._archive.addfile(info, fileobj)
+
+    def write_bytes(self, path, data, mode=None):
+        """Add a file with the given content."""
+        self._add(path, io.BytesIO(data), len(data), mode or 0o644)
+
+    def write_chunks(self, path, chunks):
+        """Add a file from chunks, spooled to disk past STREAMING_THRESHOLD.
+
+        The size of each file is written before its content, so the chunks
+        have to be gathered first.
+        """
+        with tempfile.SpooledTemporaryFile(max_size=STREAMING_THRESHOLD) as buffer:
+            for chunk in chunks:
+                buffer.write(chunk.encode("UTF-8"))
+            size = buffer.tell()
+            buffer.seek(0)
+            self._add(path, buffer, size)
+
+    def copy_file(self, path, source):
+        """Add a copy of the file at `source`, with its mode bits."""
+        stat = os.stat(source)
+        with open(source, "rb") as source_file:
+            self._add(path, source_file, stat.st_size, stat.st_mode & 0o7777)
+
+    def close(self):
+        """Write the end of the archive."""
+        self._archive.close()
+
+
+class ZipSink(Sink):
+    """Stream the files into a zip archive written to `fileobj`.
+
+    `fileobj` doesn't need to be seekable.
+    """
+
+    def __init__(self, fileobj, compression=zipfile.ZIP_DEFLATED):
+        """Start the archive."""
+        self._archive = zipfile.ZipFile(fileobj, "w", compression=compression)
+        self._date_time = time.localtime()[:6]
+
+    def _info(self, path, mode=0o644):
+        """Return the ZipInfo of a file."""
+        info = zipfile.ZipInfo(path, date_time=self._date_time)
+        info.compress_type = self._archive.compression
+        info.external_attr = (0o100000 | mode) << 16
+        return info
+
+    def write_bytes(self, path, data, mode=None):
+        """Add a file with the given content."""
+        self._archive.writestr(self._info(path, mode or 0o644), data)
+
+    def write_chunks(self, path, chunks):
+        """Add a file from chunks, compressed as they come."""
+        with self._archive.open(self._info(path), "w", force_zip64=True) as entry:
+            for chunk in chunks:
+                entry.write(chunk.encode("UTF-8"))
+
+    def copy_file(self, path, source):
+        """Add a copy of the file at `source`, with its mode bits."""
+        mode = os.stat(source).st_mode & 0o7777
+        with open(source, "rb") as source_file, self._archive.open(
+            self._info(path, mode), "w", force_zip64=True
+        ) as entry:
+            shutil.copyfileobj(source_file, entry, STREAMING_BUFFER_SIZE)
+
+    def close(self):
+        """Write the end of the archive."""
+        self._archive.close()
+
+
+def open_archive_sink(fileobj, name):
+    """Return the sink writing an archive in the format told by its `name`.
+
+    Zip archives are used for names ending in `.zip`, gzipped tarballs
+    otherwise.
+    """
+    if str(name).endswith(".zip"):
+        return ZipSink(fileobj)
+    return TarSink(fileobj)
@@ -0,0 +1,308 @@
+"""Update a generated project to a newer version of its template.
+
+The `.pytemplator.yml` file of a generated project records the template
+commit and context it was generated from. Only the template files which
+changed since that commit, or which depend on context keys being changed,
+are rendered again, both as they were and as they are now. The difference
+is then merged into the project, preserving the local edits.
+"""
+
+import tempfile
+from pathlib import Path
+from typing import NamedTuple
+
+import yaml
+from jinja2 import Environment, TemplateSyntaxError
+from loguru import logger
+
+from pytemplator.cache import is_binary_file
+from pytemplator.constants import CONTEXT_ALIASES
+from pytemplator.exceptions import BrokenTemplateError
+from pytemplator.git import (
+    changed_paths,
+    export_tree,
+    fetch_into_mirror,
+    has_commit,
+    merge_file,
+    mirror_lock,
+)
+from pytemplator.manifest import Manifest, hash_file, remove_empty_parents
+from pytemplator.pytemplator import Templator
+from pytemplator.utils import (
+    TemplateCache,
+    TemplateSelector,
+    compile_glob_patterns,
+    find_include_if_variables,
+    find_template_variables,
+    make_jinja_env,
+    open_template_tree,
+)
+
+
+class UpdateReport(NamedTuple):
+    """Paths of the project files touched, or not, by an update."""
+
+    updated: list
+    merged: list
+    conflicts: list
+    deleted: list
+    skipped: list
+
+
+def read_pytemplator_yaml(project_dir):
+    """Return the configuration recorded in the `.pytemplator.yml` of a project."""
+    try:
+        with open(
+            Path(project_dir) / ".pytemplator.yml", encoding="UTF-8"
+        ) as conf_file:
+            return yaml.safe_load(conf_file) or {}
+    except FileNotFoundError as error:
+        raise BrokenTemplateError(
+            f"{project_dir} has no .pytemplator.yml, was it generated by pytemplator?"
+        ) from error
+
+
+def update_project(  # pylint: disable=too-many-locals
+    project_dir,
+    base_dir=None,
+    checkout_branch=None,
+    context_overrides=None,
+    **templator_kwargs,
+):
+    """Update the project in `project_dir` to the latest version of its template.
+
+    `context_overrides` are merged into the context recorded for the
+    project. Extra keyword arguments are passed on to the Templator.
+    Return an UpdateReport.
+    """
+    project_dir = Path(project_dir).resolve(strict=True)
+    config = read_pytemplator_yaml(project_dir)
+    old_commit = config.get("template_commit")
+    if not old_commit:
+        raise BrokenTemplateError(
+            "The .pytemplator.yml doesn't record which template commit "
+            "the project was generated from."
+        )
+    templator = Templator(
+        base_dir=base_dir,
+        template_location=config["template_location"],
+        checkout_branch=checkout_branch or config.get("checkout_branch") or "main",
+        destination_dir=project_dir,
+        **templator_kwargs,
+    )
+    if templator.template_dir is None:
+        raise BrokenTemplateError("Only checked out templates can be updated from.")
+    if not has_commit(templator.template_dir, old_commit):
+        if templator.mirror_dir is None:
+            raise BrokenTemplateError(f"The template commit {old_commit} is unknown.")
+        with mirror_lock(templator.mirror_dir):
+            fetch_into_mirror(
+                templator.mirror_dir, templator.template_location, old_commit
+            )
+
+    old_context = config.get("context") or {}
+    new_context = {**old_context, **(context_overrides or {})}
+    changed_keys = {
+        key
+        for key in old_context.keys() | new_context.keys()
+        if old_context.get(key) != new_context.get(key)
+    }
+    changed = changed_paths(templator.template_dir, old_commit)
+
+    toggled = _toggled_subtrees(old_context, new_context, changed_keys)
+    # Their content is never rendered, with either context.
+    copied = compile_glob_patterns(
+        [
+            *old_context.get("_copy_without_render", []),
+            *new_context.get("_copy_without_render", []),
+        ]
+    )
+
+    with tempfile.TemporaryDirectory() as old_tree:
+        export_tree(templator.template_dir, old_commit, Path(old_tree))
+        with open_template_tree(old_tree) as (templates, _):
+            names = _changed_names(
+                old_tree, templates, changed, changed_keys, toggled, copied
+            )
+            old_outputs = _render_outputs(templates, names, old_context)
+    with templator.template_tree() as (templates, _):
+        names = _changed_names(
+            templator.template_dir, templates, changed, changed_keys, toggled, copied
+        )
+        new_outputs = _render_outputs(templates, names, new_context)
+
+    report = _merge_outputs(project_dir, old_outputs, new_outputs)
+    _update_manifest(project_dir, report)
+    templator.context = _with_aliases(new_context)
+    templator.add_pytemplator_yaml()
+    return report
+
+
+def _with_aliases(context):
+    """Return the context also available under its aliases, as for rendering."""
+    context = dict(context)
+    context.update({alias: context for alias in CONTEXT_ALIASES})
+    return context
+
+
+def _toggled_subtrees(old_context, new_context, changed_keys):
+    """Return a matcher of the template paths `_include_if` may include differently.
+
+    These are those matched by a rule which changed, or whose expression
+    refers to one of the `changed_keys`.
+    """
+    old_rules = old_context.get("_include_if") or {}
+    new_rules = new_context.get("_include_if") or {}
+    jinja_env = Environment()
+    patterns = []
+    for pattern in old_rules.keys() | new_rules.keys():
+        expression = new_rules.get(pattern)
+        if expression != old_rules.get(pattern) or find_include_if_variables(
+            jinja_env, {pattern: expression}
+        ) & (changed_keys | CONTEXT_ALIASES):
+            patterns.append(pattern)
+    return compile_glob_patterns(patterns)
+
+
+def _changed_names(  # pylint: disable=too-many-arguments
+    template_dir, templates, changed, changed_keys, toggled, copied
+):
+    """Return the names of the template files to render again.
+
+    These are the files whose source changed, whose path or content refers
+    to one of the `changed_keys`, or which are in a `toggled` subtree. Only
+    the path of the `copied` files counts, unless `_copy_without_render`
+    itself changed.
+    """
+    template_dir = Path(template_dir)
+    jinja_env = make_jinja_env(templates)
+    prefix = "templates/" if (template_dir / "templates").is_dir() else ""
+    names = set()
+    for name in jinja_env.list_templates():
+        parts = name.split("/")
+        if prefix + name in changed:
+            names.add(name)
+        elif any(
+            toggled("/".join(parts[:depth])) for depth in range(1, len(parts) + 1)
+        ):
+            names.add(name)
+        elif copied(name) and "_copy_without_render" in changed_keys:
+            names.add(name)
+        elif changed_keys and _depends_on(
+            jinja_env, templates, name, changed_keys, content=not copied(name)
+        ):
+            names.add(name)
+    return names
+
+
+def _depends_on(  # pylint: disable=too-many-arguments
+    jinja_env, templates, name, keys, content=True
+):
+    """Tell whether the path, or the `content`, of a template file refers to `keys`.
+
+    A file whose content isn't valid Jinja may refer to any key.
+    """
+    variables = find_template_variables(jinja_env, name)
+    if content and not is_binary_file(Path(templates) / name):
+        try:
+            source, _, _ = jinja_env.loader.get_source(jinja_env, name)
+            variables |= find_template_variables(jinja_env, source)
+        except UnicodeDecodeError:
+            pass
+        except TemplateSyntaxError:
+            return True
+    return bool(variables & (keys | CONTEXT_ALIASES))
+
+
+def _render_outputs(templates, names, context):
+    """Render the given template files, keyed by their rendered path."""
+    context = _with_aliases(context)
+    template_cache = TemplateCache(make_jinja_env(templates))
+    loader = template_cache.jinja_env.loader
+    copy_as_is = compile_glob_patterns(context.get("_copy_without_render", []))
+    selector = TemplateSelector(template_cache, context)
+    outputs = {}
+    for name in names:
+        path = selector.render_path(name)
+        if path is None:
+            continue
+        source = Path(templates) / name
+        if copy_as_is(name) or copy_as_is(path) or is_binary_file(source):
+            outputs[path] = source.read_bytes()
+            continue
+        try:
+            text, filename, _ = loader.get_source(template_cache.jinja_env, name)
+        except UnicodeDecodeError:
+            outputs[path] = source.read_bytes()
+            continue
+        outputs[path] = template_cache.render(
+            text, context, name=name, filename=filename
+        ).encode("UTF-8")
+    return outputs
+
+
+def _merge_outputs(project_dir, old_outputs, new_outputs):
+    """Apply the changes between the old and new outputs to the project."""
+    report = UpdateReport([], [], [], [], [])
+    for path in sorted(old_outputs.keys() | new_outputs.keys()):
+        base, new = old_outputs.get(path), new_outputs.get(path)
+        if base == new:
+            continue
+        target = project_dir / path
+        current = target.read_bytes() if target.is_file() else None
+        if current == new:
+            continue
+        if new is None:
+            if current == base:
+                target.unlink()
+                remove_empty_parents(target, project_dir)
+                report.deleted.append(path)
+            else:
+                logger.warning(f"{path} was removed from the template but kept.")
+                report.skipped.append(path)
+        elif current is None and base is not None:
+            logger.warning(f"{path} was changed in the template but deleted locally.")
+            report.skipped.append(path)
+        elif current is None or current == base:
+            target.parent.mkdir(parents=True, exist_ok=True)
+            target.write_bytes(new)
+            report.updated.append(path)
+        else:
+            _merge_file(project_dir, path, (current, base or b"", new), report)
+    return report
+
+
+def _merge_file(project_dir, path, versions, report):
+    """Three-way merge the template changes into a locally edited file.
+
+    `versions` holds the current content of the file, and its old and new
+    content as rendered from the template.
+    """
+    current, base, new = versions
+    try:
+        for content in (current, base, new):
+            content.decode("UTF-8")
+    except UnicodeDecodeError:
+        logger.warning(f"{path} is binary and was edited locally, not updated.")
+        report.conflicts.append(path)
+        return
+    merged, conflicts = merge_file(
+        current, base, new, labels=("project", "template (old)", "template (new)")
+    )
+    (project_dir / path).write_bytes(merged)
+    if conflicts:
+        logger.warning(f"{path} has {conflicts} conflict(s) to resolve.")
+        report.conflicts.append(path)
+    else:
+        report.merged.append(path)
+
+
+def _update_manifest(project_dir, report):
+    """Record the files written by the update in the manifest of the project."""
+    manifest = Manifest(project_dir)
+    manifest.entries = dict(manifest.previous)
+    for path in report.updated + report.merged:
+        manifest.record(project_dir / path, hash_file(project_dir / path))
+    for path in report.deleted:
+        manifest.forget(project_dir / path)
+    manifest.save()
@@ -1,38 +1,40 @@
 """Utility functions for the Templator."""
 
-import glob
-import importlib
+import contextvars
+import fnmatch
 import json
-import os
+import pickle
+import re
 import shutil
+import threading
+import time
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
+from functools import partial
+from itertools import chain
 from pathlib import Path
 
-from jinja2 import Environment, FileSystemLoader, Template
+from jinja2 import Environment, Template, TemplateSyntaxError, meta, nodes
 from loguru import logger
 
-from pytemplator.constants import YES_SET
+from pytemplator.cache import FileTypeCache, is_binary_bytes
+from pytemplator.constants import (
+    CONTEXT_ALIASES,
+    IGNORE_FILE,
+    JINJA_MARKERS,
+    STREAMING_THRESHOLD,
+    YES_SET,
+)
 from pytemplator.exceptions import (
+    BrokenTemplateError,
+    InvalidInputError,
     NoInputOptionNotHandledByTemplateError,
     UserCancellationError,
 )
-
-
-@contextmanager
-def cd(new_dir):  # pylint: disable=invalid-name
-    """Cd into the directory.
-
-    Used as context manager to avoid side-effects if
-    something goes wrong.
-    See SO #24176022
-    """
-    previous_dir = os.getcwd()
-    os.chdir(os.path.expanduser(new_dir))
-    try:
-        yield
-    finally:
-        os.chdir(previous_dir)
+from pytemplator.loaders import IgnoreRules, TemplateDirectory, TemplateFiles
+from pytemplator.profiling import Timer, TimingEvent
+from pytemplator.sinks import FileSystemSink
 
 
 def is_yes(reply):
@@ -42,19 +44,6 @@ def is_yes(reply):
     return reply.lower() in YES_SET
 
 
-def import_module_from_path(path):
-    """Import and execute a module in a safer way.
-
-    Recipe taken from importlib doc at
-    https://docs.python.org/3/library/importlib.html
-    """
-    path = Path(path).resolve(strict=True)
-    spec = importlib.util.spec_from_file_location(path.stem, path)
-    module = importlib.util.module_from_spec(spec)
-    spec.loader.exec_module(module)
-    return module
-
-
 def generate_context_from_json(json_file, context, no_input):
     """Generate the context from a json file.
 
@@ -62,48 +51,323 @@ def generate_context_from_json(json_file, context, no_input):
     """
     with open(json_file, encoding="UTF-8") as file:
         questions = json.load(file, object_pairs_hook=OrderedDict)
+    return generate_context_from_questions(questions, context, no_input)
+
+
+def generate_context_from_questions(questions, context, no_input):
+    """Generate the context from the loaded content of a cookiecutter.json file.
+
+    As with cookiecutter, the keys starting with an underscore are settings
+    kept as they are, without asking, and only string values are rendered.
+    """
     for key, value in questions.items():
         question = key.replace("-", " ").replace("_", " ")
-        default_value = Template(str(value)).render(context)
-        if no_input:
-            answer = default_value
+        if key.startswith("_"):
+            answer = value
+        elif isinstance(value, str):
+            answer = Template(value).render(context)
         else:
-            answer = input(f"{question} [{default_value}] ") or default_value
+            answer = value
+        if not no_input and not key.startswith("_"):
+            answer = input(f"{question} [{answer}] ") or answer
         context["pytemplator"][key] = context["cookiecutter"][key] = context[
             key
         ] = answer
     return context
 
 
-def check_if_new_dirs_can_be_created(
-    directories, context, destination_dir, no_input: bool
+def has_jinja_markers(source: str) -> bool:
+    """Tell whether a string contains any Jinja syntax to render."""
+    return any(marker in source for marker in JINJA_MARKERS)
+
+
+class TemplateCache:
+    """Compiled templates shared across a run, keyed by their source string.
+
+    Compiling is by far the most expensive step of the rendering, while
+    templated paths repeat the same segments (e.g. `{{ project_slug }}`)
+    and many files share the same content (licence headers, empty
+    `__init__.py`...). Sources without any Jinja marker are returned
+    as-is without ever reaching Jinja.
+
+    The compilations are timed by `timer`, if given.
+    """
+
+    def __init__(self, jinja_env=None, timer=None):
+        """Set up the cache for the given environment."""
+        self.jinja_env = jinja_env or Environment(keep_trailing_newline=True)
+        self.timer = timer or Timer()
+        self._templates = {}
+
+    def get(self, source, name=None, filename=None):
+        """Return the compiled template for `source`, compiling it if needed.
+
+        Named templates go through the bytecode cache of the environment,
+        if it has one, so that they are compiled only once across runs.
+        """
+        try:
+            return self._templates[source]
+        except KeyError:
+            pass
+        template = self.jinja_env.template_class.from_code(
+            self.jinja_env,
+            self._compile(source, name, filename),
+            self.jinja_env.make_globals(None),
+        )
+        self._templates[source] = template
+        return template
+
+    def _compile(self, source, name, filename):
+        """Compile `source` into code, using the bytecode cache if possible."""
+        with self.timer.span("compile", "jinja", template=name or source):
+            bytecode_cache = self.jinja_env.bytecode_cache
+            if bytecode_cache is None or name is None:
+                return self.jinja_env.compile(source, name, filename)
+            bucket = bytecode_cache.get_bucket(self.jinja_env, name, filename, source)
+            if bucket.code is None:
+                bucket.code = self.jinja_env.compile(source, name, filename)
+                bytecode_cache.set_bucket(bucket)
+            return bucket.code
+
+    def render(self, source, context, name=None, filename=None):
+        """Render `source`, skipping Jinja entirely when it is plain text.
+
+        Carriage returns are left to Jinja as it normalises newlines.
+        """
+        if not has_jinja_markers(source) and "\r" not in source:
+            return source
+        return self.get(source, name=name, filename=filename).render(context)
+
+    def generate(self, source, context, name=None, filename=None):
+        """Render `source` lazily, as an iterator over chunks of text."""
+        if not has_jinja_markers(source) and "\r" not in source:
+            return iter((source,))
+        return self.get(source, name=name, filename=filename).generate(context)
+
+    def render_path(self, path, context):
+        """Render a templated relative path, segment by segment.
+
+        Segments are much more repetitive than full paths, so they make for
+        a better cache key. If a Jinja tag happens to span a `/` we fall
+        back to rendering the path as a whole.
+        """
+        path = str(path)
+        if not has_jinja_markers(path):
+            return path
+        segments = path.split("/")
+        if all(_has_balanced_tags(segment) for segment in segments):
+            return "/".join(self.render(segment, context) for segment in segments)
+        return self.render(path, context)
+
+
+def _has_balanced_tags(source):
+    """Check that all Jinja tags opened in `source` are closed in it too."""
+    return source.count("{{") == source.count("}}") and source.count(
+        "{%"
+    ) == source.count("%}")
+
+
+def find_template_variables(jinja_env, source):
+    """Return the context keys a template source refers to.
+
+    The keys accessed through the `pytemplator` and `cookiecutter` aliases
+    (e.g. `{{ pytemplator.name }}`) are included. If an alias is used in any
+    other way, it is kept in the result as the template may then depend on
+    any key.
+    """
+    ast = jinja_env.parse(source)
+    variables = meta.find_undeclared_variables(ast)
+    aliases = CONTEXT_ALIASES & variables
+    if not aliases:
+        return variables
+    alias_uses = [node for node in ast.find_all(nodes.Name) if node.name in aliases]
+    static_uses = set()
+    for node in ast.find_all((nodes.Getattr, nodes.Getitem)):
+        if not isinstance(node.node, nodes.Name) or node.node.name not in aliases:
+            continue
+        if isinstance(node, nodes.Getattr):
+            variables.add(node.attr)
+        elif isinstance(node.arg, nodes.Const):
+            variables.add(node.arg.value)
+        else:
+            continue
+        static_uses.add(id(node.node))
+    if all(id(node) in static_uses for node in alias_uses):
+        variables -= aliases
+    return variables
+
+
+class TemplateIndex:
+    """Which context keys each template file refers to, in its path or content.
+
+    The templates are only parsed, never rendered. Binary files are indexed
+    by path only. An alias such as `pytemplator` among the keys of a file
+    means it may refer to any key, see `find_template_variables`. So does a
+    file whose content isn't valid Jinja, e.g. one copied without rendering.
+    """
+
+    def __init__(self, templates, jinja_env, file_types=None):
+        """Parse the path and content of every template file."""
+        file_types = file_types or FileTypeCache()
+        self.files = {}
+        for name in jinja_env.list_templates():
+            keys = find_template_variables(jinja_env, name)
+            if not is_binary_template(templates, name, file_types):
+                source, _, _ = jinja_env.loader.get_source(jinja_env, name)
+                try:
+                    keys |= find_template_variables(jinja_env, source)
+                except TemplateSyntaxError:
+                    keys |= CONTEXT_ALIASES
+            self.files[name] = keys
+
+    def keys(self):
+        """Return the keys any of the files refers to, None if possibly any."""
+        keys = set().union(*self.files.values())
+        return None if keys & CONTEXT_ALIASES else keys
+
+
+class TemplateSelector:
+    """Tell which template files to render for a context, and where.
+
+    Whole subtrees are left out, before any of their paths is rendered:
+
+    - as told by the `_include_if` context key, mapping glob patterns to
+      Jinja expressions, e.g. `{"{{ name }}/docs": "with_docs"}`. Every
+      directory and file whose template path matches a pattern is only
+      included if its expression holds for the context.
+    - when the name of a directory renders empty, e.g. for a directory
+      named `{% if with_docker %}docker{% endif %}`. So are files.
+    """
+
+    def __init__(self, template_cache, context):
+        """Compile the `_include_if` rules of the context."""
+        self.template_cache = template_cache
+        self.context = context
+        self.rules = [
+            (
+                compile_glob_patterns([pattern]),
+                template_cache.jinja_env.compile_expression(expression),
+            )
+            for pattern, expression in context.get("_include_if", {}).items()
+        ]
+        self._included = {}
+
+    def is_included(self, name) -> bool:
+        """Tell whether the rules include the template at `name` and its parents."""
+        parent, _, _ = name.rpartition("/")
+        if parent and not self.is_included(parent):
+            return False
+        if name not in self._included:
+            self._included[name] = all(
+                expression(**self.context)
+                for matches, expression in self.rules
+                if matches(name)
+            )
+        return self._included[name]
+
+    def included_directories(self, directories):
+        """Return the root `directories` of the template which are not left out."""
+        return [
+            directory
+            for directory in directories
+            if self.render_path(Path(directory).name) is not None
+        ]
+
+    def render_path(self, name):
+        """Return the rendered path of the template at `name`, None if left out."""
+        if self.rules and not self.is_included(name):
+            return None
+        path = self.template_cache.render_path(name, self.context)
+        if "" in path.split("/"):
+            return None
+        return path
+
+
+def find_include_if_variables(jinja_env, include_if):
+    """Return the context keys the expressions of `_include_if` rules refer to."""
+    return set().union(
+        *(
+            find_template_variables(jinja_env, f"{{{{ {expression} }}}}")
+            for expression in include_if.values()
+        )
+    )
+
+
+def resolve_destination(destination_root, destination):
+    """Return the path of `destination`, relative to `destination_root`.
+
+    Raise InvalidInputError if it is outside of `destination_root`, e.g.
+    an absolute path or one going up with `..`.
+    """
+    destination_root = Path(destination_root).resolve()
+    path = (destination_root / destination).resolve()
+    if not path.is_relative_to(destination_root):
+        raise InvalidInputError(f"{destination} is outside of {destination_root}.")
+    return path
+
+
+def load_contexts(path):
+    """Load a list of contexts from a JSON Lines or a YAML file.
+
+    The YAML file can either hold a list of contexts or one per document.
+    """
+    import yaml  # pylint: disable=import-outside-toplevel
+
+    path = Path(path)
+    with open(path, encoding="UTF-8") as contexts_file:
+        if path.suffix == ".jsonl":
+            return [json.loads(line) for line in contexts_file if line.strip()]
+        documents = [
+            document
+            for document in yaml.safe_load_all(contexts_file)
+            if document is not None
+        ]
+    if len(documents) == 1 and isinstance(documents[0], list):
+        return documents[0]
+    return documents
+
+
+def check_if_new_dirs_can_be_created(  # pylint: disable=too-many-arguments
+    directories,
+    context,
+    destination_dir,
+    no_input: bool,
+    template_cache=None,
+    manifest=None,
 ):
     """Check if any of the templated directories already exist.
 
-    If so, offer the user to overwrite them.
+    If so, offer the user to overwrite them. Those holding files recorded
+    by the previous generation in the `manifest` are updated in place, the
+    files it doesn't track being kept. The others are deleted.
     """
-    existing_target_dirs = []
+    template_cache = template_cache or TemplateCache()
+    tracked_dirs, existing_target_dirs = [], []
     for directory in directories:
-        new_dir_name = Template(directory.name).render(context)
+        new_dir_name = template_cache.render_path(directory.name, context)
         new_dir_path = destination_dir / new_dir_name
-        if new_dir_path.exists():
+        if not new_dir_path.exists():
+            continue
+        if manifest is not None and any(
+            key.startswith(f"{new_dir_name}/") for key in manifest.previous
+        ):
+            tracked_dirs.append(new_dir_path)
+        else:
             existing_target_dirs.append(new_dir_path)
-    if not existing_target_dirs:
+    if not tracked_dirs and not existing_target_dirs:
         return True
-    if no_input:
-        logger.warning(
-            "\nThe following directories already existed and have been overwritten:\n\t{}".format(
-                "\n\t".join(str(dir) for dir in existing_target_dirs)
-            )
-        )
-        overwrite = True
-    else:
-        logger.warning(
-            "\nThe following directories already exist:\n\t{}".format(
-                "\n\t".join(str(dir) for dir in existing_target_dirs)
+    tense = "already existed and have been" if no_input else "already exist and will be"
+    for dirs, action in (
+        (tracked_dirs, "updated in place, keeping their untracked files"),
+        (existing_target_dirs, "overwritten"),
+    ):
+        if dirs:
+            logger.warning(
+                "\nThe following directories {} {}:\n\t{}".format(
+                    tense, action, "\n\t".join(str(dir) for dir in dirs)
+                )
             )
-        )
-        overwrite = input("Overwrite those directories [Y]/N ") or True
+    overwrite = True if no_input else input("Proceed [Y]/N ") or True
     if is_yes(overwrite):
         for directory in existing_target_dirs:
             shutil.rmtree(directory)
@@ -111,31 +375,367 @@ def check_if_new_dirs_can_be_created(
     raise UserCancellationError
 
 
-def render_templates(templates, root_directories, context, destination_dir, no_input):
-    """Render the templated directories/files into the current location."""
-    with cd(destination_dir):
+@contextmanager
+def open_template_tree(template_dir):
+    """Yield the TemplateDirectory of the templates and its root directories.
+
+    Templates without a `templates` folder are served from the root
+    directories of the template itself. The files matched by its
+    `.pytemplatorignore` are left out either way.
+    """
+    template_dir = Path(template_dir)
+    ignore = IgnoreRules.from_file(template_dir / IGNORE_FILE)
+    templates = template_dir / "templates"
+    if templates.is_dir():
+        templates = TemplateDirectory(templates.resolve(strict=True), ignore)
+    else:
+        templates = TemplateDirectory(template_dir, ignore, template_root=True)
+    yield templates, templates.root_directories()
+
+
+def make_jinja_env(templates, bytecode_cache=None):
+    """Return the Jinja environment loading the files under `templates`.
+
+    `templates` is a TemplateDirectory or TemplateFiles, read in place, or
+    the path of a directory.
+    """
+    if not isinstance(templates, (TemplateDirectory, TemplateFiles)):
+        templates = TemplateDirectory(templates)
+    return Environment(
+        loader=templates.loader(),
+        keep_trailing_newline=True,
+        bytecode_cache=bytecode_cache,
+    )
+
+
+def _generate_template_file(template_cache, template, context):
+    """Return an iterator over the rendered content of a template file.
+
+    Raise UnicodeDecodeError for binary files.
+    """
+    jinja_env = template_cache.jinja_env
+    source, filename, _ = jinja_env.loader.get_source(jinja_env, template)
+    return template_cache.generate(source, context, name=template, filename=filename)
+
+
+def _read_up_to(chunks, size):
+    """Consume chunks of text until at least `size` characters are read."""
+    head, read = [], 0
+    for chunk in chunks:
+        head.append(chunk)
+        read += len(chunk)
+        if read >= size:
+            break
+    return "".join(head)
+
+
+def render_template_file(template_cache, template, context):
+    """Render both the path and the content of a single template file.
+
+    The content is None for binary files and for outputs too large to be
+    held in memory. These should be handled by `stream_template_file`.
+    """
+    new_file = template_cache.render_path(template, context)
+    try:
+        chunks = _generate_template_file(template_cache, template, context)
+    except UnicodeDecodeError:
+        return new_file, None
+    content = _read_up_to(chunks, STREAMING_THRESHOLD)
+    if len(content) >= STREAMING_THRESHOLD:
+        return new_file, None
+    return new_file, content
+
+
+def copy_template_file(sink, path, templates, template):
+    """Copy a template file as-is into the `sink`, at `path`."""
+    if isinstance(templates, TemplateFiles):
+        sink.write_bytes(path, templates.read_bytes(template), templates.mode(template))
+    else:
+        sink.copy_file(path, Path(templates) / template)
+
+
+def is_binary_template(templates, template, file_types) -> bool:
+    """Tell whether a template file is binary, through the `file_types` cache if on disk."""
+    if isinstance(templates, TemplateFiles):
+        return is_binary_bytes(templates.read_bytes(template))
+    if isinstance(templates, TemplateDirectory):
+        entry = templates.entries[template]
+        return file_types.is_binary(template, entry.path, entry.stat)
+    return file_types.is_binary(template, Path(templates) / template)
+
+
+def stream_template_file(  # pylint: disable=too-many-arguments
+    template_cache, template, context, sink, path, templates
+):
+    """Render a template file straight into the `sink`, at `path`.
+
+    The output is buffered up to STREAMING_THRESHOLD characters, past which
+    it is streamed to the sink chunk by chunk, so that memory stays flat
+    whatever the size of the output. Binary files are copied as-is.
+    """
+    try:
+        chunks = _generate_template_file(template_cache, template, context)
+    except UnicodeDecodeError:
+        # Binary data found past the sniffed prefix of the file.
+        copy_template_file(sink, path, templates, template)
+        return
+    # Small files are fully rendered before being written, so a rendering
+    # error doesn't leave a truncated file behind.
+    head = _read_up_to(chunks, STREAMING_THRESHOLD)
+    if len(head) < STREAMING_THRESHOLD:
+        sink.write_text(path, head)
+    else:
+        sink.write_chunks(path, chain([head], chunks))
+
+
+_WORKER_STATE = {}
+
+
+def _init_render_worker(templates, context, bytecode_cache):
+    """Set up the template cache and context of a rendering process."""
+    _WORKER_STATE["template_cache"] = TemplateCache(
+        make_jinja_env(templates, bytecode_cache)
+    )
+    _WORKER_STATE["context"] = context
+
+
+def _render_in_worker(template):
+    """Render a template file within a rendering process."""
+    return _timed_render(
+        _WORKER_STATE["template_cache"], template, _WORKER_STATE["context"]
+    )
+
+
+def _timed_render(template_cache, template, context):
+    """Render a template file, also returning when and where it was rendered."""
+    start = time.perf_counter()
+    rendered = render_template_file(template_cache, template, context)
+    return rendered, start, time.perf_counter() - start, threading.get_native_id()
+
+
+def render_in_parallel(  # pylint: disable=too-many-arguments
+    templates, names, template_cache, context, jobs, timer=None
+):
+    """Yield the rendered files in order, rendering them in a pool of workers.
+
+    Jinja rendering is CPU-bound, so processes are used whenever the context
+    can be pickled to send it to them. Otherwise we fall back to threads.
+    The rendering of each file is reported to the `timer`, if given.
+    """
+    timer = timer or Timer()
+    try:
+        pickle.dumps(context)
+    except (pickle.PicklingError, TypeError, AttributeError):
+        logger.debug("The context cannot be pickled, rendering in threads.")
+        executor = ThreadPoolExecutor(max_workers=jobs)
+        render = partial(_timed_render, template_cache, context=context)
+    else:
+        # Imported here as multiprocessing is slow to import.
+        # pylint: disable=import-outside-toplevel
+        from concurrent.futures import ProcessPoolExecutor
+
+        executor = ProcessPoolExecutor(
+            max_workers=jobs,
+            initializer=_init_render_worker,
+            initargs=(templates, context, template_cache.jinja_env.bytecode_cache),
+        )
+        render = _render_in_worker
+    try:
+        # Results come back in order, so the first error raised is always
+        # that of the first broken template, however the work got scheduled.
+        results = executor.map(
+            render, names, chunksize=max(1, len(names) // (4 * jobs))
+        )
+        for template, (rendered, start, duration, thread) in zip(names, results):
+            if timer.hooks:
+                timer.emit(
+                    TimingEvent(
+                        "render",
+                        "file",
+                        start,
+                        duration,
+                        thread,
+                        {"path": rendered[0], "template": template},
+                    )
+                )
+            yield rendered
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+
+def compile_glob_patterns(patterns):
+    """Compile glob patterns into a single matcher for relative paths.
+
+    This is much cheaper than globbing the filesystem once per pattern,
+    each path being matched in a single regex call.
+
+    Raise BrokenTemplateError if `patterns` is a single string, whose
+    characters would otherwise each be taken for a pattern.
+    """
+    if isinstance(patterns, str):
+        raise BrokenTemplateError(
+            f"Expected a list of glob patterns, got the string {patterns!r}."
+        )
+    if not patterns:
+        return lambda path: False
+    regex = re.compile("|".join(fnmatch.translate(pattern) for pattern in patterns))
+    return lambda path: regex.match(str(path)) is not None
+
+
+def render_templates(  # pylint: disable=too-many-arguments, too-many-locals
+    templates,
+    root_directories,
+    context,
+    destination_dir,
+    no_input,
+    jobs=1,
+    file_types=None,
+    bytecode_cache=None,
+    template_cache=None,
+    manifest=None,
+    sink=None,
+    timer=None,
+):
+    """Render the templated directories/files into the destination directory.
+
+    The files left out by the `_include_if` rules of the context, or whose
+    path has an empty directory or file name, are skipped, see TemplateSelector.
+
+    Files matching the glob patterns of `_copy_without_render` in the context,
+    either by their template path or their rendered one, are copied as-is.
+    So are binary files, as told by the `file_types` cache, without ever
+    being decoded. `templates` is either a directory or TemplateFiles.
+
+    The templates are compiled through `bytecode_cache` if provided. A
+    `template_cache` for `templates` can also be shared across several calls.
+
+    With `jobs` greater than 1, files are rendered concurrently and written
+    by a pool of threads. The output is identical to the serial one.
+
+    Existing directories are deleted beforehand, unless a `manifest` is
+    given: only the files whose content changed are then written, and the
+    files of the previous generation not generated anymore are removed.
+    The manifest is saved once everything got written.
+
+    The files can be written to another `sink` than the destination
+    directory, such as an archive, which is left open for more files.
+
+    How long each file takes to be copied, rendered and written is reported
+    to the `timer`, if given.
+    """
+    timer = timer or Timer()
+    template_cache = template_cache or TemplateCache(
+        make_jinja_env(templates, bytecode_cache), timer
+    )
+    file_types = file_types or FileTypeCache()
+    sink = sink or FileSystemSink(destination_dir, manifest)
+    selector = TemplateSelector(template_cache, context)
+    if sink.directory is not None:
         check_if_new_dirs_can_be_created(
-            directories=root_directories,
+            directories=selector.included_directories(root_directories),
             context=context,
-            destination_dir=destination_dir,
+            destination_dir=sink.directory,
             no_input=no_input,
+            template_cache=template_cache,
+            manifest=getattr(sink, "manifest", None),
         )
-        jinja_env = Environment(
-            loader=FileSystemLoader(str(templates), followlinks=True),
-            keep_trailing_newline=True,
-        )
-        to_copy_as_is = []
-        for pattern in context.get("_copy_without_render", []):
-            to_copy_as_is.extend(glob.glob(pattern, recursive=True))
+    copy_as_is = compile_glob_patterns(context.get("_copy_without_render", []))
+    to_copy, to_render = [], []
+    for template in template_cache.jinja_env.list_templates():
+        new_file = selector.render_path(template)
+        if new_file is None:
+            continue
+        if (
+            copy_as_is(template)
+            or copy_as_is(new_file)
+            or is_binary_template(templates, template, file_types)
+        ):
+            to_copy.append((new_file, template))
+        else:
+            to_render.append(template)
+
+    if jobs <= 1:
+        for new_file, template in to_copy:
+            with timer.span("copy", "file", path=new_file, template=template):
+                copy_template_file(sink, new_file, templates, template)
+        for template in to_render:
+            new_file = template_cache.render_path(template, context)
+            with timer.span("render", "file", path=new_file, template=template):
+                stream_template_file(
+                    template_cache,
+                    template,
+                    context,
+                    sink,
+                    path=new_file,
+                    templates=templates,
+                )
+        with timer.span("finish_output"):
+            sink.finish()
+        return
+
+    # Sinks which can't be written concurrently get the files in order.
+    with ThreadPoolExecutor(
+        max_workers=jobs if sink.concurrent_writes else 1
+    ) as writer:
+        writes = [
+            writer.submit(
+                timer.timed(
+                    copy_template_file, "copy", "file", path=new_file, template=template
+                ),
+                sink,
+                new_file,
+                templates,
+                template,
+            )
+            for new_file, template in to_copy
+        ]
+        try:
+            rendered = render_in_parallel(
+                templates, to_render, template_cache, context, jobs, timer
+            )
+            for (new_file, content), template in zip(rendered, to_render):
+                if content is None:
+                    write = writer.submit(
+                        timer.timed(
+                            stream_template_file,
+                            "render",
+                            "file",
+                            path=new_file,
+                            template=template,
+                        ),
+                        template_cache,
+                        template,
+                        context,
+                        sink,
+                        path=new_file,
+                        templates=templates,
+                    )
+                else:
+                    write = writer.submit(
+                        timer.timed(
+                            sink.write_text,
+                            "write",
+                            "file",
+                            path=new_file,
+                            template=template,
+                        ),
+                        new_file,
+                        content,
+                    )
+                writes.append(write)
+        finally:
+            # Writes only ever precede a rendering error, so re-raising
+            # the first failed write keeps errors in the serial order.
+            for write in writes:
+                write.result()
+    sink.finish()
 
-        for template in jinja_env.list_templates():
-            new_file = Path(Template(template).render(context))
-            # pylint: disable=no-member
-            new_file.parents[0].mkdir(parents=True, exist_ok=True)
-            template = jinja_env.get_template(template)
-            content = template.render(context)
-            with open(new_file, "w", encoding="UTF-8") as templated_file:
-                templated_file.write(content)
+
+# Returned by `Question` before its defaults get evaluated.
+_UNSET = object()
+# Callable returning the context keys the templates refer to, None if unknown,
+# set while `initialize.py` runs by `Templator.generate_context`.
+REFERENCED_KEYS = contextvars.ContextVar("REFERENCED_KEYS", default=None)
 
 
 class Question:
@@ -153,6 +753,24 @@ class Question:
         self.validators = validators or []
         self.validation_errors = []
         self.answer = None
+        self._default = _UNSET
+        self._no_input_default = _UNSET
+
+    def default_value(self):
+        """Return the default answer, a callable default being called only once."""
+        if self._default is _UNSET:
+            self._default = self.default() if callable(self.default) else self.default
+        return self._default
+
+    def no_input_default_value(self):
+        """Return the default answer without input, called only once if callable."""
+        if self._no_input_default is _UNSET:
+            self._no_input_default = (
+                self.no_input_default()
+                if callable(self.no_input_default)
+                else self.no_input_default
+            )
+        return self._no_input_default
 
     def resolve(self, no_input):
         """Fill the `answer` attribute, prompting the user if required."""
@@ -160,7 +778,7 @@ class Question:
             return
 
         if self.ask is False:
-            self.answer = self.default() if callable(self.default) else self.default
+            self.answer = self.default_value()
             return
 
         while self.answer is None or not self.is_valid():
@@ -171,20 +789,14 @@ class Question:
                 )
             if no_input:
                 if self.no_input_default is not None:
-                    self.answer = (
-                        self.no_input_default()
-                        if callable(self.no_input_default)
-                        else self.no_input_default
-                    )
+                    self.answer = self.no_input_default_value()
                 elif self.default is not None:
-                    self.answer = (
-                        self.default() if callable(self.default) else self.default
-                    )
+                    self.answer = self.default_value()
                 else:
                     raise NoInputOptionNotHandledByTemplateError
             else:
                 if self.default is not None:
-                    default = self.default() if callable(self.default) else self.default
+                    default = self.default_value()
                     self.answer = input(f"{self.ask} [{default}] ") or default
                 else:
                     self.answer = input(f"{self.ask} ")
@@ -198,22 +810,98 @@ class Question:
 
 
 class Context:
-    """Utility class handling the context passed to the Jinja2 engine."""
+    """Utility class handling the context passed to the Jinja2 engine.
+
+    The questions are resolved in order, except that a default reading
+    another key, e.g. `lambda: context["name"].lower()`, resolves the
+    question of that key first. Which keys each default read is kept in
+    `dependencies`.
+
+    With `skip_unreferenced`, the questions not asked which no template
+    refers to are skipped, see `resolve`: their keys are then missing from
+    `as_dict()`, so `initialize.py` must not read them after resolving.
+    The keys read by the `_include_if` rules are only known if these are
+    the answer of a question too.
+    """
 
-    def __init__(self, questions=None):
+    def __init__(self, questions=None, skip_unreferenced=False):
         """Set a private dict representing the context."""
         self._dict = {}
         self.questions = questions or []
+        self.skip_unreferenced = skip_unreferenced
+        self.dependencies = {}
+        self._pending = {}
+        self._resolving = []
+        self._no_input = False
 
     def __getitem__(self, key):
-        """Access the private dict."""
+        """Access the private dict, resolving the question of `key` if still pending."""
+        if self._resolving:
+            self.dependencies[self._resolving[-1]].add(key)
+        if key not in self._dict and key in self._pending:
+            self._resolve_question(self._pending[key])
         return self._dict[key]
 
     def resolve(self, no_input: bool):
-        """Resolve the questions and populate the context dict."""
+        """Resolve the questions and populate the context dict.
+
+        With `skip_unreferenced`, a question not to be asked, whose default
+        is a callable, is skipped if none of the templates refers to its
+        key, as told by `REFERENCED_KEYS`, nor any `_include_if` rule or
+        other default. Its default, possibly costly, is then never called.
+        Keys starting with an underscore are settings of pytemplator and
+        never skipped.
+        """
+        self._no_input = no_input
+        self._pending = {question.key: question for question in self.questions}
         for question in self.questions:
-            question.resolve(no_input)
-            self._dict[question.key] = question.answer
+            if question.key not in self._pending:
+                # Already resolved as another default referred to it.
+                continue
+            if self._is_unreferenced(question):
+                logger.debug(f"Skipping {question.key}, no template refers to it.")
+                continue
+            self._resolve_question(question)
+
+    def _resolve_question(self, question):
+        """Resolve a question, and the ones its defaults refer to."""
+        if question.key in self._resolving:
+            raise BrokenTemplateError(
+                "The defaults of these questions refer to each other: "
+                + " -> ".join(self._resolving + [question.key])
+            )
+        self._resolving.append(question.key)
+        self.dependencies.setdefault(question.key, set())
+        try:
+            question.resolve(self._no_input)
+        finally:
+            self._resolving.pop()
+        self._pending.pop(question.key, None)
+        self._dict[question.key] = question.answer
+
+    def _is_unreferenced(self, question):
+        """Tell whether the question can be skipped as no template needs its answer."""
+        if (
+            not self.skip_unreferenced
+            or question.ask is not False
+            or not callable(question.default)
+            or question.key.startswith("_")
+        ):
+            return False
+        referenced_keys = REFERENCED_KEYS.get()
+        if referenced_keys is None:
+            return False
+        keys = referenced_keys()
+        if keys is None or question.key in keys:
+            return False
+        return question.key not in self._include_if_keys()
+
+    def _include_if_keys(self):
+        """Return the keys the `_include_if` rules read, resolving their question first."""
+        if "_include_if" in self._pending:
+            self._resolve_question(self._pending["_include_if"])
+        include_if = self._dict.get("_include_if") or {}
+        return find_include_if_variables(Environment(), include_if)
 
     def as_dict(self):
         """Return the context as dictionary."""
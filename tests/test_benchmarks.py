@@ -0,0 +1,23 @@
+"""Testcases for the benchmarks harness."""
+
+from unittest import TestCase
+
+from benchmarks.run import PHASES, benchmark, compare
+from benchmarks.synthetic import TemplateShape
+
+
+class BenchmarkTestCase(TestCase):
+    """TestCase for the benchmarks of the render pipeline."""
+
+    def test_benchmark_times_every_phase(self):
+        """Test a tiny synthetic git template is generated with every phase timed."""
+        shape = TemplateShape(files=20, file_size=256, context_size=5)
+        results = benchmark(shape, repeat=2, git=True)
+        self.assertEqual(len(results["runs"]), 2)
+        self.assertEqual(results["shape"]["files"], 20)
+        for phase in PHASES:
+            self.assertIn(phase, results["runs"][0])
+            self.assertGreater(results["summary"][phase]["median"], 0)
+        report = compare(results, results).splitlines()
+        self.assertEqual(len(report), len(results["summary"]) + 1)
+        self.assertTrue(all(line.endswith("1.00") for line in report[1:]))
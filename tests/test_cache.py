@@ -0,0 +1,271 @@
+"""Testcases for pytemplator.cache module."""
+
+import json
+import os
+import shutil
+import sys
+import time
+from unittest import mock
+
+from pytemplator import cache, pytemplator
+from pytemplator.cache import (
+    BytecodeCache,
+    FileTypeCache,
+    ModuleCache,
+    is_binary_file,
+    prune_bytecode_cache,
+    prune_output_cache,
+)
+from pytemplator.pytemplator import Templator
+from pytemplator.utils import TemplateCache, make_jinja_env
+from tests.utils import TmpdirTestCase, git, make_git_repo
+
+
+class IsBinaryFileTestCase(TmpdirTestCase):
+    """TestCase for the function is_binary_file."""
+
+    def test_text_file(self):
+        """Test UTF-8 text isn't binary, even if a character is cut."""
+        text_file = self.tmpdir / "text"
+        text_file.write_bytes("é".encode() * 4096 + b"{{ x }}")
+        self.assertFalse(is_binary_file(text_file))
+
+    def test_binary_files(self):
+        """Test files with NUL bytes or invalid UTF-8 are binary."""
+        png = self.tmpdir / "image.png"
+        png.write_bytes(b"\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR")
+        latin1 = self.tmpdir / "latin1.txt"
+        latin1.write_bytes("café".encode("latin-1"))
+        self.assertTrue(is_binary_file(png))
+        self.assertTrue(is_binary_file(latin1))
+
+
+class FileTypeCacheTestCase(TmpdirTestCase):
+    """TestCase for the FileTypeCache."""
+
+    def test_results_are_persisted(self):
+        """Test a saved cache doesn't sniff the files again."""
+        binary = self.tmpdir / "binary"
+        binary.write_bytes(b"\x00")
+        cache_path = self.tmpdir / "cache" / "commit.json"
+        file_types = FileTypeCache(cache_path)
+        self.assertTrue(file_types.is_binary("binary", binary))
+        file_types.save()
+        with mock.patch.object(cache, "is_binary_file") as mocked_sniff:
+            self.assertTrue(FileTypeCache(cache_path).is_binary("binary", binary))
+        mocked_sniff.assert_not_called()
+
+    def test_edited_files_are_sniffed_again(self):
+        """Test a file whose size changed is sniffed again."""
+        edited = self.tmpdir / "edited"
+        edited.write_bytes(b"\x00")
+        cache_path = self.tmpdir / "commit.json"
+        file_types = FileTypeCache(cache_path)
+        self.assertTrue(file_types.is_binary("edited", edited))
+        file_types.save()
+        edited.write_text("Now some text")
+        self.assertFalse(FileTypeCache(cache_path).is_binary("edited", edited))
+
+
+class BytecodeCacheTestCase(TmpdirTestCase):
+    """TestCase for the BytecodeCache and its pruning."""
+
+    def test_templates_are_compiled_once_across_runs(self):
+        """Test a new environment loads the bytecode instead of compiling."""
+        directory = self.tmpdir / "bytecode" / "commit"
+        for run in range(2):
+            jinja_env = make_jinja_env(self.tmpdir, BytecodeCache(directory))
+            with mock.patch.object(
+                jinja_env, "compile", wraps=jinja_env.compile
+            ) as mocked_compile:
+                template = TemplateCache(jinja_env).get("{{ x }}!", name="file")
+            self.assertEqual(template.render(x=42), "42!")
+            self.assertEqual(mocked_compile.call_count, 1 - run)
+
+    def test_prune_evicts_least_recently_used(self):
+        """Test the oldest entries are evicted first until the size fits."""
+        directory = self.tmpdir / "bytecode"
+        for index in range(4):
+            entry = directory / f"commit_{index}" / "entry.cache"
+            entry.parent.mkdir(parents=True)
+            entry.write_bytes(b"0" * 100)
+            os.utime(entry, (1000 + index, 1000 + index))
+        self.assertEqual(prune_bytecode_cache(directory, max_size=250), 200)
+        self.assertEqual(
+            sorted(path.name for path in directory.iterdir()),
+            ["commit_2", "commit_3"],
+        )
+
+
+class OutputCacheTestCase(TmpdirTestCase):
+    """TestCase for generating a git template again from its cached output."""
+
+    def make_template(self, finalize=None, initialize=False):
+        """Commit a template in a git repo, return its location."""
+        source = self.tmpdir / "source"
+        shutil.rmtree(source, ignore_errors=True)
+        shutil.rmtree(self.tmpdir / "repo", ignore_errors=True)
+        (source / "templates" / "{{ name }}").mkdir(parents=True)
+        (source / "templates" / "{{ name }}" / "file.txt").write_text("Hi {{ name }}")
+        if initialize:
+            (source / "initialize.py").write_text(
+                "def generate_context(no_input):\n    return {'name': 'project'}\n"
+            )
+        else:
+            (source / "cookiecutter.json").write_text(json.dumps({"name": "project"}))
+        if finalize is not None:
+            (source / "finalize.py").write_text(finalize)
+        return f"file://{make_git_repo(source, self.tmpdir / 'repo')}"
+
+    def render(self, location, output):
+        """Generate the template into the `output` directory, return whether it rendered."""
+        output_dir = self.tmpdir / output
+        output_dir.mkdir(exist_ok=True)
+        templator = Templator(
+            base_dir=self.tmpdir / "base",
+            template_location=location,
+            destination_dir=output_dir,
+            no_input=True,
+            cache_outputs=True,
+        )
+        templator.generate_context()
+        with mock.patch.object(
+            pytemplator, "render_templates", wraps=pytemplator.render_templates
+        ) as render_templates:
+            templator.render()
+        return render_templates.called
+
+    def test_cached_output_is_reused(self):
+        """Test the output is rendered once, unless its cached files get edited."""
+        location = self.make_template()
+        self.assertTrue(self.render(location, "first"))
+        self.assertFalse(self.render(location, "second"))
+        second_file = self.tmpdir / "second" / "project" / "file.txt"
+        self.assertEqual(second_file.read_text(), "Hi project")
+        self.assertTrue((self.tmpdir / "second" / ".pytemplator.yml").exists())
+
+        # Edited in place, the cached file may have been edited as well.
+        with open(second_file, "a", encoding="UTF-8") as edited:
+            edited.write(" edited")
+        self.assertTrue(self.render(location, "third"))
+        self.assertEqual(
+            (self.tmpdir / "third" / "project" / "file.txt").read_text(), "Hi project"
+        )
+
+    def test_initialize_context(self):
+        """Test the context of `initialize.py`, holding its own aliases, is a valid key."""
+        location = self.make_template(initialize=True)
+        self.assertTrue(self.render(location, "first"))
+        self.assertFalse(self.render(location, "second"))
+        self.assertEqual(
+            (self.tmpdir / "second" / "project" / "file.txt").read_text(), "Hi project"
+        )
+
+    def test_excluded_directories_are_not_checked(self):
+        """Test no confirmation is asked about root directories left out."""
+        location = self.make_template()
+        repo = self.tmpdir / "repo"
+        (repo / "templates" / "{{ extra }}").mkdir()
+        (repo / "templates" / "{{ extra }}" / "file.txt").write_text("Extra")
+        (repo / "cookiecutter.json").write_text(
+            json.dumps({"name": "project", "extra": ""})
+        )
+        git("add", "--all", cwd=repo)
+        git("commit", "--quiet", "--message=Extra", cwd=repo)
+        for output in ("first", "second"):
+            (self.tmpdir / output).mkdir()
+            templator = Templator(
+                base_dir=self.tmpdir / "base",
+                template_location=location,
+                destination_dir=self.tmpdir / output,
+                no_input=True,
+                cache_outputs=True,
+            )
+            templator.generate_context()
+            templator.no_input = False
+            with mock.patch("builtins.input", side_effect=AssertionError):
+                templator.render()
+            self.assertEqual(
+                sorted(path.name for path in (self.tmpdir / output).iterdir()),
+                [".pytemplator-manifest.json", ".pytemplator.yml", "project"],
+            )
+
+    def test_finalize(self):
+        """Test finalize.py still runs on a cached output, unless cacheable."""
+        finalize = (
+            "def finalize(context, output_dir):\n"
+            "    (output_dir / 'project' / 'file.txt').write_text('Finalized')\n"
+        )
+        for cacheable in (False, True):
+            with self.subTest(cacheable=cacheable):
+                shutil.rmtree(self.tmpdir / "base", ignore_errors=True)
+                location = self.make_template(finalize + f"\nCACHEABLE = {cacheable}\n")
+                with mock.patch.object(
+                    Templator, "finalize", autospec=True, side_effect=Templator.finalize
+                ) as finalize_phase:
+                    self.render(location, "first")
+                    self.render(location, "second")
+                self.assertEqual(finalize_phase.call_count, 1 if cacheable else 2)
+                for output in ("first", "second"):
+                    self.assertEqual(
+                        (self.tmpdir / output / "project" / "file.txt").read_text(),
+                        "Finalized",
+                    )
+
+    def test_prune(self):
+        """Test the expired entries are evicted, then the least recently used."""
+        directory = self.tmpdir / "outputs"
+        now = time.time()
+        for index, age in enumerate((1000, 30, 20, 10)):
+            entry = directory / f"entry_{index}"
+            entry.mkdir(parents=True)
+            (entry / "entry.json").write_text(json.dumps({"files": {}, "size": 100}))
+            os.utime(entry, (now - age, now - age))
+        self.assertEqual(prune_output_cache(directory, max_size=250, max_age=500), 200)
+        self.assertEqual(
+            sorted(path.name for path in directory.iterdir()), ["entry_2", "entry_3"]
+        )
+
+
+class ModuleCacheTestCase(TmpdirTestCase):
+    """TestCase for importing template modules once."""
+
+    def setUp(self):
+        """Write an initialize.py in two templates."""
+        super().setUp()
+        self.paths = []
+        for template in ("first", "second"):
+            path = self.tmpdir / template / "initialize.py"
+            path.parent.mkdir()
+            path.write_text(f"NAME = {template!r}\n")
+            self.paths.append(path)
+        self.directory = self.tmpdir / "modules"
+
+    def test_modules_are_imported_once(self):
+        """Test a module is shared until its file changes, templates never collide."""
+        first = ModuleCache(self.directory).import_file("initialize", self.paths[0])
+        self.assertIs(
+            ModuleCache(self.directory).import_file("initialize", self.paths[0]), first
+        )
+        second = ModuleCache(self.directory).import_file("initialize", self.paths[1])
+        self.assertEqual((first.NAME, second.NAME), ("first", "second"))
+        self.assertIs(sys.modules[first.__name__], first)
+        self.assertIs(sys.modules[second.__name__], second)
+
+        self.paths[0].write_text("NAME = 'edited'\n")
+        os.utime(self.paths[0], ns=(1, 1))
+        edited = ModuleCache(self.directory).import_file("initialize", self.paths[0])
+        self.assertEqual(edited.NAME, "edited")
+
+    def test_code_is_compiled_once_across_processes(self):
+        """Test the compiled code is loaded from the directory."""
+        for run in range(2):
+            # As if in a new process.
+            with mock.patch.dict(cache._MODULES, clear=True), mock.patch(
+                "pytemplator.cache.compile", create=True, wraps=compile
+            ) as mocked_compile:
+                module = ModuleCache(self.directory).import_source(
+                    "finalize", b"def finalize(context, output_dir):\n    pass\n", "x"
+                )
+            self.assertTrue(callable(module.finalize))
+            self.assertEqual(mocked_compile.call_count, 1 - run)
@@ -0,0 +1,131 @@
+"""Testcases for pytemplator.cli module."""
+
+import argparse
+import json
+import pstats
+import shutil
+import subprocess
+import sys
+import zipfile
+
+from pytemplator.cli import main, strtobool
+from tests.utils import TmpdirTestCase
+
+
+class CacheCommandTestCase(TmpdirTestCase):
+    """TestCase for the `pytemplate cache` command."""
+
+    def test_cache_prune(self):
+        """Test the bytecode cache is emptied with a max size of 0."""
+        entry = self.tmpdir / "cache" / "bytecode" / "commit" / "entry.cache"
+        entry.parent.mkdir(parents=True)
+        entry.write_bytes(b"0" * 100)
+        self.assertEqual(
+            main(["cache", "-b", str(self.tmpdir), "prune", "--max-size", "0"]), 0
+        )
+        self.assertFalse(entry.exists())
+
+
+class ContextsOptionTestCase(TmpdirTestCase):
+    """TestCase for the `--contexts` option."""
+
+    def test_contexts_from_json_lines(self):
+        """Test an output is generated per context, failing if any fails."""
+        template = self.tmpdir / "template"
+        shutil.copytree(self.fixture_dir / "test_template_4", template)
+        contexts = self.tmpdir / "contexts.jsonl"
+        contexts.write_text(
+            "\n".join(
+                json.dumps(
+                    {
+                        "_destination": name,
+                        "main_file_name": "test2",
+                        "main_folder_name": name,
+                        "second_file": "file2",
+                        "nested_folder": "nested",
+                    }
+                )
+                for name in ("service_a", "service_b")
+            )
+        )
+        args = ["-b", str(self.tmpdir), "-d", str(self.tmpdir / "out"), "--no-input"]
+        (self.tmpdir / "out").mkdir()
+        self.assertEqual(main([*args, "--contexts", str(contexts), str(template)]), 0)
+        for name in ("service_a", "service_b"):
+            self.assertTrue((self.tmpdir / "out" / name / f"{name}_2").is_dir())
+
+        contexts.write_text(json.dumps({"_copy_without_render": 42}))
+        self.assertEqual(main([*args, "--contexts", str(contexts), str(template)]), 1)
+
+
+class ArchiveOptionTestCase(TmpdirTestCase):
+    """TestCase for the `--archive` option."""
+
+    def test_zip_archive(self):
+        """Test the project is written into the archive only."""
+        template = self.tmpdir / "template"
+        shutil.copytree(self.fixture_dir / "test_template_4", template)
+        (self.tmpdir / "out").mkdir()
+        archive = self.tmpdir / "project.zip"
+        args = ["-b", str(self.tmpdir), "-d", str(self.tmpdir / "out"), "--no-input"]
+        self.assertEqual(main([*args, "--archive", str(archive), str(template)]), 0)
+        with zipfile.ZipFile(archive) as project:
+            self.assertIn(".pytemplator.yml", project.namelist())
+            self.assertIn("Directory_2/file2", project.namelist())
+        self.assertEqual(list((self.tmpdir / "out").iterdir()), [])
+
+
+class StartupTestCase(TmpdirTestCase):
+    """TestCase holding the line on the startup time of the CLI."""
+
+    @staticmethod
+    def imported_modules(code):
+        """Return the modules imported by running `code`, as told by `-X importtime`."""
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", code],
+            check=True,
+            capture_output=True,
+            text=True,
+        )
+        return {
+            line.rsplit("|", 1)[-1].strip()
+            for line in result.stderr.splitlines()
+            if line.startswith("import time:")
+        }
+
+    def test_lazy_imports(self):
+        """Test the heavy dependencies are only imported by the commands using them."""
+        modules = self.imported_modules("import pytemplator.cli")
+        for heavy in ("distutils", "jinja2", "loguru", "yaml", "http.server"):
+            self.assertNotIn(heavy, modules)
+        modules = self.imported_modules("import pytemplator.pytemplator")
+        for heavy in ("distutils", "yaml", "http.server", "concurrent.futures.process"):
+            self.assertNotIn(heavy, modules)
+
+    def test_boolean_flags(self):
+        """Test boolean flags accept the values distutils.util.strtobool did."""
+        self.assertTrue(strtobool("Yes"))
+        self.assertTrue(strtobool("1"))
+        self.assertFalse(strtobool("off"))
+        with self.assertRaises(argparse.ArgumentTypeError):
+            strtobool("maybe")
+
+
+class ProfileOptionTestCase(TmpdirTestCase):
+    """TestCase for the `--profile` and `--cprofile` options."""
+
+    def test_profile(self):
+        """Test a Chrome trace and cProfile statistics are saved."""
+        template = self.tmpdir / "template"
+        shutil.copytree(self.fixture_dir / "test_template_1", template)
+        (self.tmpdir / "out").mkdir()
+        trace, stats = self.tmpdir / "trace.json", self.tmpdir / "stats.prof"
+        args = ["-b", str(self.tmpdir), "-d", str(self.tmpdir / "out"), "--no-input"]
+        args += ["--profile", str(trace), "--cprofile", str(stats), str(template)]
+        self.assertEqual(main(args), 0)
+        names = {
+            event["name"] for event in json.loads(trace.read_text())["traceEvents"]
+        }
+        self.assertLessEqual({"generate_context", "render_templates", "render"}, names)
+        functions = {name for _, _, name in pstats.Stats(str(stats)).stats}
+        self.assertIn("render_templates", functions)
@@ -0,0 +1,255 @@
+"""Testcases for pytemplator.loaders module."""
+
+import shutil
+import tarfile
+import zipfile
+
+from pytemplator.constants import MANIFEST_FILE
+from pytemplator.loaders import (
+    ArchiveFiles,
+    GitTreeFiles,
+    IgnoreRules,
+    TemplateDirectory,
+    is_template_archive,
+    open_template_files_tree,
+)
+from pytemplator.pytemplator import Templator
+from pytemplator.utils import open_template_tree
+from tests.utils import TmpdirTestCase, are_identical_dirs, git, make_git_repo
+
+
+class ArchiveTemplateTestCase(TmpdirTestCase):
+    """TestCase for templates read straight from archives."""
+
+    def render(self, location, name, **kwargs):
+        """Render the template at `location` into the output directory `name`."""
+        output_dir = self.tmpdir / name
+        output_dir.mkdir()
+        templator = Templator(
+            base_dir=self.tmpdir / "base",
+            template_location=str(location),
+            destination_dir=output_dir,
+            no_input=True,
+            **kwargs,
+        )
+        templator.generate_context()
+        templator.render()
+        # These record where the template came from.
+        (output_dir / ".pytemplator.yml").unlink()
+        (output_dir / MANIFEST_FILE).unlink()
+        return templator, output_dir
+
+    def make_archives(self, number, extra_files=0):
+        """Return the fixture template, and as a zip, a tarball and a gzipped tarball.
+
+        The template gets `extra_files` more files to render.
+        """
+        template = self.tmpdir / f"test_template_{number}"
+        shutil.copytree(self.fixture_dir / f"test_template_{number}", template)
+        if extra_files:
+            (template / "templates" / "extra").mkdir()
+        for index in range(extra_files):
+            (template / "templates" / "extra" / f"file_{index}.txt").write_text(
+                f"{index} {{{{ user }}}}\n" * 100
+            )
+        zip_path = self.tmpdir / f"template_{number}.zip"
+        with zipfile.ZipFile(zip_path, "w") as archive:
+            for path in sorted(template.rglob("*")):
+                archive.write(path, path.relative_to(self.tmpdir))
+        archives = [zip_path]
+        for mode, suffix in (("w", "tar"), ("w:gz", "tar.gz")):
+            archives.append(self.tmpdir / f"template_{number}.{suffix}")
+            with tarfile.open(archives[-1], mode) as archive:
+                archive.add(template, template.name)
+        return template, archives
+
+    def test_archives_render_like_directories(self):
+        """Test zip and tar templates are rendered as their extracted version."""
+        for number in (1, 2, 3):
+            template, archives = self.make_archives(number)
+            _, expected = self.render(template, f"expected_{number}")
+            for archive in archives:
+                with self.subTest(archive=archive.name):
+                    self.assertTrue(is_template_archive(archive))
+                    templator, output_dir = self.render(
+                        archive, f"output_{archive.name}"
+                    )
+                    self.assertIsNone(templator.template_dir)
+                    self.assertTrue(are_identical_dirs(output_dir, expected))
+
+    def test_archives_render_in_processes(self):
+        """Test each rendering process reads the archive on its own."""
+        template, archives = self.make_archives(1, extra_files=200)
+        _, expected = self.render(template, "expected")
+        for archive in archives:
+            with self.subTest(archive=archive.name):
+                _, output_dir = self.render(archive, f"output_{archive.name}", jobs=4)
+                self.assertTrue(are_identical_dirs(output_dir, expected))
+
+    def test_archive_files(self):
+        """Test the files are read in place, with their mode bits."""
+        template, archives = self.make_archives(1)
+        script = template / "templates" / "run.sh"
+        script.write_text("#!/bin/sh\n")
+        script.chmod(0o755)
+        with tarfile.open(archives[1], "w") as archive:
+            archive.add(template, template.name)
+        files = ArchiveFiles(archives[1])
+        self.assertIn("initialize.py", files.list())
+        templates = files.subtree("templates")
+        self.assertEqual(templates.read_bytes("run.sh"), b"#!/bin/sh\n")
+        self.assertEqual(templates.mode("run.sh"), 0o755)
+        with self.assertRaises(FileNotFoundError):
+            files.read_bytes("missing")
+        self.assertFalse(is_template_archive(template / "initialize.py"))
+
+
+class GitTreeTemplateTestCase(TmpdirTestCase):
+    """TestCase for git templates read from the objects of a commit."""
+
+    def test_render_without_checkout(self):
+        """Test the commit is rendered without any worktree being checked out."""
+        repo = make_git_repo(self.fixture_dir / "test_template_2", self.tmpdir / "repo")
+        outputs = []
+        for checkout in (True, False):
+            output_dir = self.tmpdir / f"output_{checkout}"
+            output_dir.mkdir()
+            templator = Templator(
+                base_dir=self.tmpdir / f"base_{checkout}",
+                template_location=f"file://{repo}",
+                destination_dir=output_dir,
+                no_input=True,
+                checkout=checkout,
+            )
+            templator.generate_context()
+            templator.render()
+            outputs.append(output_dir)
+        self.assertIsNone(templator.template_dir)
+        self.assertFalse((self.tmpdir / f"base_{checkout}" / "worktrees").exists())
+        self.assertEqual(templator.last_commit_hash, git("rev-parse", "HEAD", cwd=repo))
+        self.assertTrue(are_identical_dirs(*outputs))
+
+    def test_render_without_checkout_in_processes(self):
+        """Test each rendering process starts its own git process."""
+        repo = make_git_repo(self.fixture_dir / "test_template_2", self.tmpdir / "repo")
+        outputs = []
+        for jobs in (1, 2):
+            output_dir = self.tmpdir / f"output_{jobs}"
+            output_dir.mkdir()
+            templator = Templator(
+                base_dir=self.tmpdir / "base",
+                template_location=f"file://{repo}",
+                destination_dir=output_dir,
+                no_input=True,
+                checkout=False,
+                jobs=jobs,
+            )
+            templator.generate_context()
+            templator.render()
+            outputs.append(output_dir)
+        self.assertTrue(are_identical_dirs(*outputs))
+
+    def test_git_tree_files(self):
+        """Test the files of a commit are listed and read, bar the symlinks."""
+        repo = make_git_repo(self.fixture_dir / "test_template_1", self.tmpdir / "repo")
+        commit = git("rev-parse", "HEAD", cwd=repo)
+        (repo / "link").symlink_to("README.rst")
+        git("add", "--all", cwd=repo)
+        git("commit", "--quiet", "--message=Link", cwd=repo)
+        files = GitTreeFiles(repo, commit)
+        self.assertEqual(
+            files.read_bytes("README.rst"), (repo / "README.rst").read_bytes()
+        )
+        files = GitTreeFiles(repo, "HEAD")
+        self.assertIn("README.rst", files.list())
+        self.assertNotIn("link", files.list())
+        self.assertEqual(files.origin("README.rst"), "HEAD:README.rst")
+
+
+class TemplateDirectoryTestCase(TmpdirTestCase):
+    """TestCase for template directories walked with their ignore rules."""
+
+    def setUp(self):
+        """Write a template without templates folder, with files to ignore."""
+        super().setUp()
+        self.template = self.tmpdir / "template"
+        project = self.template / "{{ name }}"
+        for directory in ("hooks", "build", "docs", "__pycache__"):
+            (project / directory).mkdir(parents=True)
+        (self.template / "hooks").mkdir()
+        (self.template / "hooks" / "pre_gen.py").write_text("")
+        (self.template / "cookiecutter.json").write_text('{"name": "project"}')
+        (self.template / ".pytemplatorignore").write_text(
+            "# Local files\nbuild/\n*.log\n{{ name }}/docs/draft.md\n"
+        )
+        for name in (
+            "README.md",
+            "hooks/useTheme.js",
+            "build/out.txt",
+            "docs/index.md",
+            "docs/draft.md",
+            "__pycache__/module.cpython-311.pyc",
+            "debug.log",
+            ".DS_Store",
+            "README.md~",
+            ".README.md.swp",
+        ):
+            (project / name).write_text(name)
+        self.expected = [
+            "{{ name }}/README.md",
+            "{{ name }}/docs/index.md",
+            "{{ name }}/hooks/useTheme.js",
+        ]
+
+    def test_ignore_rules(self):
+        """Test names match at any depth, paths from the root, and dirs only with a slash."""
+        rules = IgnoreRules.from_text("*.log\n/docs/draft.md\nbuild/\n")
+        self.assertTrue(rules.ignores("a/b/debug.log"))
+        self.assertTrue(rules.ignores("docs/draft.md"))
+        self.assertFalse(rules.ignores("src/docs/draft.md"))
+        self.assertTrue(rules.ignores("src/build", is_dir=True))
+        self.assertFalse(rules.ignores("src/build"))
+        self.assertTrue(rules.ignores_path("src/build/out.txt"))
+        self.assertTrue(rules.ignores_path("src/__pycache__/module.pyc"))
+        self.assertFalse(rules.ignores_path("src/module.py"))
+
+    def test_template_directory(self):
+        """Test the files are listed in place, with their stat, bar the ignored ones."""
+        with open_template_tree(self.template) as (templates, root_directories):
+            self.assertIsInstance(templates, TemplateDirectory)
+            self.assertEqual(templates.path, self.template)
+            self.assertEqual(templates.list(), self.expected)
+            self.assertEqual(root_directories, [self.template / "{{ name }}"])
+            readme = templates.entries["{{ name }}/README.md"]
+            self.assertEqual(readme.path, self.template / "{{ name }}" / "README.md")
+            self.assertEqual(readme.stat.st_size, len("README.md"))
+
+    def test_archives_ignore_the_same_files(self):
+        """Test the ignore rules apply to templates read from archives."""
+        archive = self.tmpdir / "template.zip"
+        with zipfile.ZipFile(archive, "w") as zip_file:
+            for path in sorted(self.template.rglob("*")):
+                zip_file.write(path, path.relative_to(self.tmpdir))
+        with open_template_files_tree(ArchiveFiles(archive)) as (templates, _):
+            self.assertEqual(templates.list(), self.expected)
+
+    def test_render(self):
+        """Test only the files not ignored are generated."""
+        output_dir = self.tmpdir / "output"
+        output_dir.mkdir()
+        templator = Templator(
+            base_dir=self.tmpdir / "base",
+            template_location=str(self.template),
+            destination_dir=output_dir,
+            no_input=True,
+        )
+        templator.generate_context()
+        templator.render()
+        self.assertEqual(
+            sorted(
+                str(path.relative_to(output_dir / "project"))
+                for path in (output_dir / "project").rglob("*")
+                if path.is_file()
+            ),
+            ["README.md", "docs/index.md", "hooks/useTheme.js"],
+        )
@@ -0,0 +1,93 @@
+"""Testcases for pytemplator.manifest module."""
+
+import json
+import os
+from unittest import mock
+
+from pytemplator import utils
+from pytemplator.constants import MANIFEST_FILE
+from pytemplator.manifest import Manifest, hash_bytes
+from pytemplator.utils import render_templates
+from tests.utils import TmpdirTestCase
+
+OLD_MTIME_NS = 1_000_000_000_000_000_000
+
+
+class RegenerationTestCase(TmpdirTestCase):
+    """TestCase for rendering again into a directory with a manifest."""
+
+    def setUp(self):
+        """Write a template and generate it a first time."""
+        super().setUp()
+        self.templates = self.tmpdir / "templates"
+        (self.templates / "{{ name }}" / "static").mkdir(parents=True)
+        (self.templates / "{{ name }}" / "same.txt").write_text("Same {{ name }}")
+        (self.templates / "{{ name }}" / "changed.txt").write_text("{{ version }}")
+        (self.templates / "{{ name }}" / "static" / "logo.png").write_bytes(b"\x00")
+        (self.templates / "{{ name }}" / "large.txt").write_text(
+            "{% for i in range(100) %}{{ version }}{% endfor %}"
+        )
+        (self.templates / "{{ name }}" / "stale.txt").write_text("Stale")
+        (self.templates / "{{ name }}" / "edited.txt").write_text("Edited")
+        self.output_dir = self.tmpdir / "output"
+        self.output_dir.mkdir()
+        self.render(version=1)
+        self.project = self.output_dir / "project"
+
+    @mock.patch.object(utils, "STREAMING_THRESHOLD", 16)
+    def render(self, version, jobs=1):
+        """Render the template into the output directory."""
+        render_templates(
+            templates=self.templates,
+            root_directories=[self.templates / "{{ name }}"],
+            context={"name": "project", "version": version},
+            destination_dir=self.output_dir,
+            no_input=True,
+            jobs=jobs,
+            manifest=Manifest(self.output_dir),
+        )
+
+    def test_manifest_records_hashes(self):
+        """Test the manifest holds the hash of each generated file."""
+        with open(self.output_dir / MANIFEST_FILE, encoding="UTF-8") as manifest:
+            entries = json.load(manifest)
+        self.assertEqual(len(entries), 6)
+        self.assertEqual(entries["project/same.txt"], hash_bytes(b"Same project"))
+        self.assertEqual(entries["project/static/logo.png"], hash_bytes(b"\x00"))
+
+    def test_only_changed_files_are_written(self):
+        """Test unchanged files are left untouched and stale ones removed."""
+        (self.project / "node_modules").mkdir()
+        (self.project / "node_modules" / "cache").write_text("Not generated")
+        for jobs in (1, 2):
+            with self.subTest(jobs=jobs):
+                for path in self.project.rglob("*"):
+                    os.utime(path, ns=(OLD_MTIME_NS, OLD_MTIME_NS))
+                self.render(version=jobs + 1, jobs=jobs)
+                self.assertEqual(
+                    {
+                        path.name
+                        for path in self.project.rglob("*")
+                        if path.is_file() and path.stat().st_mtime_ns != OLD_MTIME_NS
+                    },
+                    {"changed.txt", "large.txt"},
+                )
+                self.assertEqual(
+                    (self.project / "changed.txt").read_text(), str(jobs + 1)
+                )
+                self.assertEqual(
+                    (self.project / "large.txt").read_text(), str(jobs + 1) * 100
+                )
+                self.assertTrue((self.project / "node_modules" / "cache").exists())
+
+    def test_stale_files_are_removed(self):
+        """Test files not generated anymore are removed, unless edited."""
+        (self.templates / "{{ name }}" / "stale.txt").unlink()
+        (self.templates / "{{ name }}" / "edited.txt").unlink()
+        (self.templates / "{{ name }}" / "static" / "logo.png").unlink()
+        (self.project / "edited.txt").write_text("Local changes")
+        self.render(version=1)
+        self.assertFalse((self.project / "stale.txt").exists())
+        self.assertFalse((self.project / "static").exists())
+        self.assertEqual((self.project / "edited.txt").read_text(), "Local changes")
+        self.assertNotIn("project/stale.txt", Manifest(self.output_dir).previous)
@@ -0,0 +1,107 @@
+"""Testcases for pytemplator.plan module."""
+
+import json
+from unittest import mock
+
+from pytemplator import utils
+from pytemplator.cli import main
+from pytemplator.manifest import hash_bytes
+from pytemplator.plan import CREATED, MODIFIED, UNCHANGED
+from pytemplator.pytemplator import Templator
+from tests.utils import TmpdirTestCase
+
+
+class PlanTestCase(TmpdirTestCase):
+    """TestCase for planning a generation without writing anything."""
+
+    def setUp(self):
+        """Write a template and a Templator for it."""
+        super().setUp()
+        self.template = self.tmpdir / "template"
+        project = self.template / "templates" / "{{ name }}"
+        (project / "static").mkdir(parents=True)
+        (self.template / "cookiecutter.json").write_text(
+            json.dumps({"name": "project", "version": "1"})
+        )
+        (project / "same.txt").write_text("Same {{ name }}")
+        (project / "changed.txt").write_text("{{ version }}")
+        (project / "static" / "logo.png").write_bytes(b"\x00")
+        (project / "large.txt").write_text(
+            "{% for i in range(100) %}{{ version }}{% endfor %}"
+        )
+        (project / "stale.txt").write_text("Stale")
+        self.output_dir = self.tmpdir / "output"
+        self.output_dir.mkdir()
+        self.templator = Templator(
+            base_dir=self.tmpdir / "base",
+            template_location=str(self.template),
+            destination_dir=self.output_dir,
+            no_input=True,
+        )
+        self.templator.generate_context()
+
+    def snapshot(self):
+        """Return the content of every file in the output directory."""
+        return {
+            path: path.read_bytes()
+            for path in self.output_dir.rglob("*")
+            if path.is_file()
+        }
+
+    @mock.patch.object(utils, "STREAMING_THRESHOLD", 16)
+    def test_plan(self):
+        """Test the plan tells what would be created, modified and deleted."""
+        plan = self.templator.plan()
+        self.assertEqual(self.snapshot(), {})
+        self.assertEqual(plan.paths(MODIFIED) + plan.paths(UNCHANGED), [])
+        self.assertIn("project/static/logo.png", plan.paths(CREATED))
+        self.assertEqual(plan.files["project/large.txt"].sha256, hash_bytes(b"1" * 100))
+        self.assertEqual(plan.files["project/large.txt"].size, 100)
+
+        self.templator.render()
+        (self.template / "templates" / "{{ name }}" / "stale.txt").unlink()
+        before = self.snapshot()
+        for jobs in (1, 2):
+            with self.subTest(jobs=jobs):
+                templator = self.templator.with_output(
+                    None, {"name": "project", "version": "2"}
+                )
+                templator.jobs = jobs
+                plan = templator.plan()
+                self.assertEqual(self.snapshot(), before)
+                self.assertEqual(
+                    plan.paths(MODIFIED),
+                    [".pytemplator.yml", "project/changed.txt", "project/large.txt"],
+                )
+                self.assertEqual(
+                    plan.paths(UNCHANGED),
+                    ["project/same.txt", "project/static/logo.png"],
+                )
+                self.assertEqual(plan.deleted, ["project/stale.txt"])
+
+    def test_plan_many_from_cli(self):
+        """Test a plan is printed per context, failing if any fails."""
+        contexts = self.tmpdir / "contexts.jsonl"
+        contexts.write_text(
+            "\n".join(
+                json.dumps({"_destination": name, "name": name, "version": "1"})
+                for name in ("service_a", "service_b")
+            )
+        )
+        args = ["-b", str(self.tmpdir), "-d", str(self.output_dir), "--no-input"]
+        with mock.patch("sys.stdout") as stdout:
+            code = main(
+                [*args, "--plan", "--contexts", str(contexts), str(self.template)]
+            )
+        self.assertEqual(code, 0)
+        plans = json.loads(
+            "".join(call.args[0] for call in stdout.write.call_args_list)
+        )
+        files = ["changed.txt", "large.txt", "same.txt", "stale.txt", "static/logo.png"]
+        for plan, name in zip(plans, ("service_a", "service_b")):
+            self.assertEqual(plan["destination_dir"], str(self.output_dir / name))
+            self.assertEqual(
+                sorted(plan["files"]),
+                [".pytemplator.yml", *(f"{name}/{file}" for file in files)],
+            )
+        self.assertEqual(self.snapshot(), {})
@@ -0,0 +1,71 @@
+"""Testcases for pytemplator.profiling module."""
+
+import shutil
+
+from pytemplator.profiling import Timer, TraceRecorder
+from pytemplator.pytemplator import Templator
+from tests.utils import TmpdirTestCase
+
+
+class ProfilingTestCase(TmpdirTestCase):
+    """TestCase for the timing events of a generation."""
+
+    def generate(self, jobs):
+        """Generate the second fixture template, return the recorded events."""
+        template = self.tmpdir / "template"
+        if not template.exists():
+            shutil.copytree(self.fixture_dir / "test_template_2", template)
+        output_dir = self.tmpdir / f"output_{jobs}"
+        output_dir.mkdir()
+        recorder = TraceRecorder()
+        templator = Templator(
+            base_dir=self.tmpdir / "base",
+            template_location=str(template),
+            destination_dir=output_dir,
+            no_input=True,
+            jobs=jobs,
+            hooks=[recorder],
+        )
+        templator.generate_context()
+        templator.render()
+        return recorder
+
+    def test_phases_and_files_are_timed(self):
+        """Test every phase and every rendered file emit an event, in both modes."""
+        for jobs in (1, 2):
+            with self.subTest(jobs=jobs):
+                recorder = self.generate(jobs)
+                self.assertLessEqual(
+                    {
+                        "generate_context",
+                        "render_templates",
+                        "finalize",
+                        "add_pytemplator_yaml",
+                        "save_caches",
+                    },
+                    recorder.phases().keys(),
+                )
+                paths = [path for path, _ in recorder.slowest_files(count=100)]
+                self.assertIn("Directory/test1", paths)
+                self.assertIn("Directory_2/file2", paths)
+                durations = [duration for _, duration in recorder.slowest_files()]
+                self.assertEqual(durations, sorted(durations, reverse=True))
+        self.assertTrue(
+            any(event.category == "jinja" for event in self.generate(3).events)
+        )
+
+    def test_chrome_trace(self):
+        """Test the events are exported as complete Chrome trace events."""
+        recorder = self.generate(1)
+        trace = recorder.chrome_trace()["traceEvents"]
+        self.assertEqual(len(trace), len(recorder.events))
+        self.assertTrue(all(event["ph"] == "X" for event in trace))
+        self.assertEqual(min(event["ts"] for event in trace), 0)
+
+    def test_timer_without_hooks(self):
+        """Test nothing gets timed without hooks."""
+        timer = Timer()
+        function = len
+        self.assertIs(timer.timed(function, "len"), function)
+        with timer.span("nothing"):
+            pass
@@ -1,15 +1,19 @@
 #!/usr/bin/env python
 
 """Tests for `pytemplator` package."""
+import os
 import shutil
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from unittest.mock import patch
 
 from jinja2 import Template
 
 from pytemplator import __version__
+from pytemplator.exceptions import BrokenTemplateError, InvalidInputError
+from pytemplator.git import run_git
 from pytemplator.pytemplator import Templator
-from tests.utils import TmpdirTestCase, are_identical_dirs
+from tests.utils import TmpdirTestCase, are_identical_dirs, git, make_git_repo
 
 
 class PytemplatorFullScaleTestCase(TmpdirTestCase):
@@ -107,6 +111,171 @@ class PytemplatorFullScaleTestCase(TmpdirTestCase):
         )
 
 
+class PytemplatorConcurrencyTestCase(TmpdirTestCase):
+    """TestCase for several Templators running in the same process."""
+
+    @patch("os.chdir", side_effect=AssertionError("The cwd is process-global"))
+    def test_concurrent_templators(self, _):
+        """Test concurrent generations don't interfere with one another."""
+        numbers = [1, 2, 3, 4] * 8
+
+        def generate(index, number):
+            output_dir = self.tmpdir / "outputs" / str(index)
+            output_dir.mkdir(parents=True)
+            templator = Templator(
+                base_dir=self.tmpdir / "base",
+                template_location=str(self.tmpdir / f"test_template_{number}"),
+                destination_dir=output_dir,
+                no_input=True,
+            )
+            templator.generate_context()
+            templator.render()
+            (output_dir / ".pytemplator.yml").unlink()
+            return output_dir
+
+        for number in set(numbers):
+            shutil.copytree(
+                self.fixture_dir / f"test_template_{number}",
+                self.tmpdir / f"test_template_{number}",
+            )
+            shutil.copytree(
+                self.fixture_dir / f"expected_test_template_{number}_result",
+                self.tmpdir / "expected" / str(number),
+                ignore=shutil.ignore_patterns(".pytemplator.yml"),
+            )
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            output_dirs = list(executor.map(generate, range(len(numbers)), numbers))
+        for output_dir, number in zip(output_dirs, numbers):
+            self.assertTrue(
+                are_identical_dirs(output_dir, self.tmpdir / "expected" / str(number))
+            )
+
+    @patch("os.chdir", side_effect=AssertionError("The cwd is process-global"))
+    def test_concurrent_git_templators(self, _):
+        """Test concurrent generations of a git template share its mirror safely."""
+        repo = make_git_repo(self.fixture_dir / "test_template_2", self.tmpdir / "repo")
+        expected = self.tmpdir / "expected"
+        shutil.copytree(
+            self.fixture_dir / "expected_test_template_2_result",
+            expected,
+            ignore=shutil.ignore_patterns(".pytemplator.yml"),
+        )
+
+        def generate(index):
+            output_dir = self.tmpdir / "outputs" / str(index)
+            output_dir.mkdir(parents=True)
+            templator = Templator(
+                base_dir=self.tmpdir / "base",
+                template_location=f"file://{repo}",
+                destination_dir=output_dir,
+                no_input=True,
+                fetch_ttl=0,
+            )
+            templator.generate_context()
+            templator.render()
+            (output_dir / ".pytemplator.yml").unlink()
+            return output_dir
+
+        # Cold cache first, then fetching again into the existing mirror.
+        for run in range(2):
+            with ThreadPoolExecutor(max_workers=16) as executor:
+                output_dirs = list(
+                    executor.map(generate, range(run * 16, run * 16 + 16))
+                )
+            for output_dir in output_dirs:
+                self.assertTrue(are_identical_dirs(output_dir, expected))
+
+
+class PytemplatorRenderManyTestCase(TmpdirTestCase):
+    """TestCase for the batch generation of Templator.render_many."""
+
+    def test_render_many(self):
+        """Test each context gets its output, failures being reported."""
+        template = self.tmpdir / "template"
+        shutil.copytree(self.fixture_dir / "test_template_2", template)
+        output_dir = self.tmpdir / "output_dir"
+        output_dir.mkdir()
+        templator = Templator(
+            base_dir=self.tmpdir,
+            template_location=str(template),
+            destination_dir=output_dir,
+            no_input=True,
+            jobs=2,
+        )
+        context = {
+            "main_file_name": "test2",
+            "main_folder_name": "Directory",
+            "second_file": "file2",
+            "user": "John Doe",
+            "nested_folder": "My_Nested_Folder",
+            "remove_test1_file": True,
+        }
+        results = templator.render_many(
+            [
+                dict(context, _destination="first"),
+                dict(context, second_file="other_file"),
+                dict(context, _copy_without_render=42),
+            ],
+            output_dir,
+        )
+        self.assertEqual(
+            [result.destination_dir for result in results],
+            [output_dir / "first", output_dir / "1", output_dir / "2"],
+        )
+        self.assertEqual([result.success for result in results], [True, True, False])
+        self.assertIsInstance(results[2].error, TypeError)
+        expected = self.tmpdir / "expected"
+        shutil.copytree(
+            self.fixture_dir / "expected_test_template_2_result",
+            expected,
+            ignore=shutil.ignore_patterns(".pytemplator.yml"),
+        )
+        (output_dir / "first" / ".pytemplator.yml").unlink()
+        self.assertTrue(are_identical_dirs(output_dir / "first", expected))
+        self.assertIn(
+            "other_file",
+            (output_dir / "1" / "Directory_2" / "other_file").read_text(),
+        )
+
+    def test_destinations_outside_of_the_root(self):
+        """Test a `_destination` escaping the destination root fails alone."""
+        template = self.tmpdir / "template"
+        shutil.copytree(self.fixture_dir / "test_template_2", template)
+        output_dir = self.tmpdir / "output_dir"
+        output_dir.mkdir()
+        templator = Templator(
+            base_dir=self.tmpdir,
+            template_location=str(template),
+            destination_dir=output_dir,
+            no_input=True,
+        )
+        context = {
+            "main_file_name": "test2",
+            "main_folder_name": "Directory",
+            "second_file": "file2",
+            "user": "John Doe",
+            "nested_folder": "My_Nested_Folder",
+            "remove_test1_file": True,
+        }
+        contexts = [
+            dict(context, _destination=str(self.tmpdir / "escaped")),
+            dict(context, _destination="../sibling"),
+            dict(context, _destination="nested/../inside"),
+        ]
+        for method in (templator.plan_many, templator.render_many):
+            with self.subTest(method=method.__name__):
+                results = method(contexts, output_dir)
+                self.assertEqual(
+                    [result.success for result in results], [False, False, True]
+                )
+                self.assertIsInstance(results[0].error, InvalidInputError)
+                self.assertIsInstance(results[1].error, InvalidInputError)
+                self.assertEqual(results[2].destination_dir, output_dir / "inside")
+        self.assertFalse((self.tmpdir / "escaped").exists())
+        self.assertFalse((self.tmpdir / "sibling").exists())
+        self.assertTrue((output_dir / "inside" / "Directory_2").is_dir())
+
+
 @patch.object(Templator, "get_git_template")
 @patch.object(Templator, "prepare_template_dir")
 class PytemplatorInitTestCase(TmpdirTestCase):
@@ -141,3 +310,103 @@ class PytemplatorInitTestCase(TmpdirTestCase):
         )
         mocked_get_git.assert_not_called()
         mocked_prepare_dir.assert_not_called()
+
+
+class PytemplatorGitTestCase(TmpdirTestCase):
+    """TestCase for templates fetched from a git repo."""
+
+    def setUp(self):
+        """Create a git repo with a template and some history."""
+        super().setUp()
+        self.repo = make_git_repo(
+            self.fixture_dir / "test_template_1", self.tmpdir / "repo"
+        )
+        (self.repo / "README.rst").write_text("Some history")
+        git("commit", "--all", "--quiet", "--message=Second commit", cwd=self.repo)
+        git("checkout", "--quiet", "-b", "dev", cwd=self.repo)
+        (self.repo / "templates" / "dev_only").write_text("{{ user }}")
+        git("add", "--all", cwd=self.repo)
+        git("commit", "--quiet", "--message=Dev commit", cwd=self.repo)
+        git("checkout", "--quiet", "main", cwd=self.repo)
+        self.output_dir = self.tmpdir / "output_dir"
+        self.output_dir.mkdir()
+
+    def make_templator(self, checkout_branch="main", **kwargs):
+        """Return a Templator for the git repo."""
+        return Templator(
+            base_dir=self.tmpdir / "base",
+            template_location=f"file://{self.repo}",
+            checkout_branch=checkout_branch,
+            destination_dir=self.output_dir,
+            no_input=True,
+            **kwargs,
+        )
+
+    def test_shallow_single_branch_mirror(self):
+        """Test only the tip of the branch is fetched, checked out as a worktree."""
+        templator = self.make_templator()
+        mirror = templator.mirror_dir
+        self.assertEqual(
+            run_git("rev-parse", "--is-shallow-repository", cwd=mirror), "true"
+        )
+        self.assertEqual(run_git("rev-list", "--all", "--count", cwd=mirror), "1")
+        self.assertEqual(
+            templator.last_commit_hash, git("rev-parse", "main", cwd=self.repo)
+        )
+        self.assertGreater(templator.bytes_fetched, 0)
+        self.assertTrue((templator.template_dir / "initialize.py").exists())
+        self.assertFalse((templator.template_dir / "templates" / "dev_only").exists())
+
+        templator.generate_context()
+        templator.render()
+        self.assertIn("John Doe", (self.output_dir / "test1").read_text())
+
+    def test_branches_share_the_mirror(self):
+        """Test each branch gets its own worktree of the same mirror."""
+        main = self.make_templator()
+        (main.template_dir / "initialize.py").write_text("Local edit")
+        dev = self.make_templator("dev")
+        self.assertEqual(dev.mirror_dir, main.mirror_dir)
+        self.assertNotEqual(dev.template_dir, main.template_dir)
+        self.assertTrue((dev.template_dir / "templates" / "dev_only").exists())
+        # Local edits in a cached worktree are discarded.
+        main = self.make_templator()
+        self.assertNotEqual(
+            (main.template_dir / "initialize.py").read_text(), "Local edit"
+        )
+
+    def test_relative_base_dir(self):
+        """Test a base directory relative to the working directory is supported."""
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.tmpdir)
+        templator = Templator(
+            base_dir="base",
+            template_location=f"file://{self.repo}",
+            destination_dir=self.output_dir,
+            no_input=True,
+        )
+        self.assertEqual(templator.base_dir, self.tmpdir.resolve() / "base")
+        self.assertTrue((templator.template_dir / "initialize.py").exists())
+        templator.generate_context()
+        templator.render()
+        self.assertIn("John Doe", (self.output_dir / "test1").read_text())
+
+    def test_missing_branch(self):
+        """Test an InvalidInputError is raised if the branch doesn't exist."""
+        with self.assertRaises(InvalidInputError):
+            self.make_templator("missing")
+
+    def test_fresh_template_is_not_fetched(self):
+        """Test the fetch is skipped within the TTL or when offline."""
+        self.make_templator()
+        with patch.object(Templator, "get_git_template") as mocked_get_git:
+            self.make_templator(fetch_ttl=3600)
+            self.make_templator(offline=True)
+            mocked_get_git.assert_not_called()
+            self.make_templator(fetch_ttl=0)
+            mocked_get_git.assert_called_once()
+
+    def test_offline_without_cache(self):
+        """Test an error is raised when offline with nothing cached."""
+        with self.assertRaises(BrokenTemplateError):
+            self.make_templator(offline=True)
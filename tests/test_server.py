@@ -0,0 +1,194 @@
+"""Testcases for pytemplator.server module."""
+
+import http.client
+import io
+import json
+import socket
+import tarfile
+import threading
+from functools import partial
+from unittest import mock
+
+from pytemplator import cache
+from pytemplator.server import GenerationServer, TemplatePool, UnixGenerationServer
+from tests.utils import TmpdirTestCase, git, make_git_repo
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTP connection over a Unix socket."""
+
+    def __init__(self, path):
+        """Connect to the socket at `path`."""
+        super().__init__("localhost")
+        self.path = str(path)
+
+    def connect(self):
+        """Open the Unix socket."""
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+
+class GenerationServerTestCase(TmpdirTestCase):
+    """TestCase for the generation server, queried by a stand-in client."""
+
+    def setUp(self):
+        """Start a server in the background."""
+        super().setUp()
+        self.output_dir = self.tmpdir / "output"
+        self.output_dir.mkdir()
+        self.repo = make_git_repo(
+            self.fixture_dir / "test_template_1", self.tmpdir / "repo"
+        )
+        self.pool = TemplatePool(self.tmpdir / "base", fetch_ttl=0)
+        self.server = GenerationServer(("127.0.0.1", 0), self.pool, self.output_dir)
+        self.connect = lambda: http.client.HTTPConnection(
+            "127.0.0.1", self.server.server_port
+        )
+        self.start(self.server)
+
+    def start(self, server):
+        """Serve in a thread until the end of the test."""
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+    def tearDown(self):
+        """Close the loaded templates."""
+        self.pool.close()
+        super().tearDown()
+
+    def request(  # pylint: disable=too-many-arguments
+        self, method, path, body=None, connection=None, headers=None
+    ):
+        """Send a request, return the response status and body."""
+        connection = connection or self.connect()
+        try:
+            connection.request(
+                method,
+                path,
+                body=json.dumps(body) if body is not None else None,
+                headers=headers or {"Content-Type": "application/json"},
+            )
+            response = connection.getresponse()
+            return response.status, response.read()
+        finally:
+            connection.close()
+
+    def test_templates_are_kept_warm(self):
+        """Test the template is loaded once and rendered for each request."""
+        with mock.patch.object(
+            cache, "_execute_module", wraps=cache._execute_module
+        ) as import_module:
+            for name in ("first", "second"):
+                status, body = self.request(
+                    "POST",
+                    "/render",
+                    {"template": f"file://{self.repo}", "destination": name},
+                )
+                self.assertEqual(status, 200, body)
+                self.assertEqual(
+                    (self.output_dir / name / "test1").read_text(),
+                    "Hi John Doe, I am just a test file.\n",
+                )
+        self.assertEqual(import_module.call_count, 1)
+        status, body = self.request("GET", "/templates")
+        self.assertEqual(status, 200)
+        (template,) = json.loads(body)["templates"]
+        self.assertEqual(template["commit"], git("rev-parse", "HEAD", cwd=self.repo))
+
+    def test_new_commits_are_loaded(self):
+        """Test the template is reloaded once its branch moved on."""
+        request = {"template": f"file://{self.repo}", "destination": "project"}
+        status, body = self.request("POST", "/render", request)
+        self.assertEqual(status, 200, body)
+        (self.repo / "templates" / "new_file").write_text("{{ user }}")
+        git("add", "--all", cwd=self.repo)
+        git("commit", "--quiet", "--message=New file", cwd=self.repo)
+        status, body = self.request("POST", "/render", request)
+        self.assertEqual(status, 200, body)
+        self.assertEqual(
+            json.loads(body)["commit"], git("rev-parse", "HEAD", cwd=self.repo)
+        )
+        self.assertEqual(
+            (self.output_dir / "project" / "new_file").read_text(), "John Doe"
+        )
+        # The snapshot of the previous commit was deleted.
+        self.assertEqual(
+            len(list((self.tmpdir / "base" / "server_snapshots").iterdir())), 1
+        )
+
+    def test_archive_over_unix_socket(self):
+        """Test the project can be sent back as an archive, with a given context."""
+        socket_path = self.tmpdir / "server.sock"
+        server = UnixGenerationServer(socket_path, self.pool, self.output_dir)
+        self.start(server)
+        context = {
+            "main_file_name": "readme",
+            "main_folder_name": "Folder",
+            "second_file": "file2",
+            "user": "Jane",
+            "nested_folder": "nested",
+        }
+        status, body = self.request(
+            "POST",
+            "/render",
+            {"template": str(self.repo), "context": context, "archive": True},
+            UnixHTTPConnection(socket_path),
+        )
+        self.assertEqual(status, 200, body)
+        with tarfile.open(fileobj=io.BytesIO(body), mode="r:gz") as archive:
+            self.assertIn("Folder_2/nested/nested_2/test.txt", archive.getnames())
+            self.assertEqual(
+                archive.extractfile("readme").read(),
+                b"Hi Jane, I am just a test file.\n",
+            )
+        self.assertEqual(list(self.output_dir.iterdir()), [])
+
+    def test_invalid_requests(self):
+        """Test invalid requests are rejected."""
+        for body in (
+            {"destination": "project"},
+            {"template": str(self.repo), "destination": "../outside"},
+            {"template": str(self.tmpdir / "missing"), "destination": "project"},
+        ):
+            status, _ = self.request("POST", "/render", body)
+            self.assertEqual(status, 400, body)
+        self.assertFalse((self.tmpdir / "outside").exists())
+        status, _ = self.request("GET", "/unknown")
+        self.assertEqual(status, 404)
+
+    def test_cross_origin_requests(self):
+        """Test requests from web pages, or without a JSON body, are refused."""
+        body = {"template": f"file://{self.repo}", "destination": "project"}
+        for headers, expected in (
+            ({"Content-Type": "text/plain"}, 415),
+            ({"Content-Type": "application/json", "Origin": "https://evil.test"}, 403),
+        ):
+            status, _ = self.request("POST", "/render", body, headers=headers)
+            self.assertEqual(status, expected)
+        self.assertEqual(list(self.output_dir.iterdir()), [])
+
+    def test_token_and_allowed_templates(self):
+        """Test the server can require a token and restrict the templates."""
+        server = GenerationServer(
+            ("127.0.0.1", 0),
+            self.pool,
+            self.output_dir,
+            token="secret",
+            allowed_templates=[f"file://{self.repo}"],
+        )
+        self.start(server)
+        connect = partial(http.client.HTTPConnection, "127.0.0.1", server.server_port)
+        body = {"template": f"file://{self.repo}", "destination": "project"}
+        status, _ = self.request("POST", "/render", body, connect())
+        self.assertEqual(status, 401)
+        headers = {"Content-Type": "application/json", "Authorization": "Bearer secret"}
+        status, _ = self.request(
+            "POST", "/render", dict(body, template=str(self.repo)), connect(), headers
+        )
+        self.assertEqual(status, 400)
+        status, _ = self.request("POST", "/render", body, connect(), headers)
+        self.assertEqual(status, 200)
+        self.assertTrue((self.output_dir / "project").is_dir())
@@ -0,0 +1,252 @@
+"""Testcases for pytemplator.sinks module."""
+
+import io
+import os
+import shutil
+import tarfile
+import zipfile
+from unittest import mock
+
+from pytemplator import sinks, utils
+from pytemplator.constants import MANIFEST_FILE, STAGING_DIR_PREFIX
+from pytemplator.manifest import Manifest
+from pytemplator.pytemplator import Templator
+from pytemplator.sinks import MemorySink, StagedFileSystemSink, TarSink, ZipSink
+from pytemplator.utils import render_templates
+from tests.test_manifest import OLD_MTIME_NS
+from tests.utils import TmpdirTestCase
+
+
+class SinksTestCase(TmpdirTestCase):
+    """TestCase for rendering into the various sinks."""
+
+    context = {
+        "main_folder_name": "Directory",
+        "nested_folder": "My_Nested_Folder",
+        "pytemplator": {"main_file_name": "test1", "second_file": "file2"},
+        "_copy_without_render": ["*.sh"],
+    }
+
+    def setUp(self):
+        """Render the fixture template on disk to compare the sinks with."""
+        super().setUp()
+        self.templates = self.tmpdir / "templates"
+        shutil.copytree(
+            self.fixture_dir / "test_template_1" / "templates", self.templates
+        )
+        (self.templates / "run.sh").write_text("#!/bin/sh\n")
+        (self.templates / "run.sh").chmod(0o755)
+        (self.templates / "large.txt").write_text(
+            "{% for i in range(1000) %}{{ main_folder_name }}\n{% endfor %}"
+        )
+        self.expected = {
+            "Directory_2/My_Nested_Folder/My_Nested_Folder_2/test.txt": b"",
+            "Directory_2/file2": b"This is the second file: file2\n",
+            "test1": b"Hi , I am just a test file.\n",
+            "run.sh": b"#!/bin/sh\n",
+            "large.txt": b"Directory\n" * 1000,
+        }
+
+    @mock.patch.object(utils, "STREAMING_THRESHOLD", 1024)
+    def render(self, sink, jobs=1):
+        """Render the templates into the sink."""
+        render_templates(
+            templates=self.templates,
+            root_directories=[],
+            context=self.context,
+            destination_dir=None,
+            no_input=True,
+            jobs=jobs,
+            sink=sink,
+        )
+
+    def test_memory_sink(self):
+        """Test the files can be kept in memory."""
+        sink = MemorySink()
+        self.render(sink)
+        self.assertEqual(sink.files, self.expected)
+
+    def test_sinks_write_bytes(self):
+        """Test a sink without `write_bytes` can't be made."""
+
+        class IncompleteSink(sinks.Sink):  # pylint: disable=abstract-method
+            """Sink forgetting to write the files."""
+
+        with self.assertRaises(TypeError):
+            IncompleteSink()
+
+    def test_tar_sink(self):
+        """Test the files are streamed into a gzipped tarball, in order."""
+        names = []
+        for jobs in (1, 2):
+            output = io.BytesIO()
+            with TarSink(output) as sink:
+                self.render(sink, jobs)
+            output.seek(0)
+            with tarfile.open(fileobj=output, mode="r:gz") as archive:
+                files = {
+                    member.name: archive.extractfile(member).read()
+                    for member in archive.getmembers()
+                }
+                self.assertEqual(archive.getmember("run.sh").mode, 0o755)
+                names.append(archive.getnames())
+            self.assertEqual(files, self.expected)
+        self.assertEqual(names[0], names[1])
+
+    def test_zip_sink(self):
+        """Test the files are streamed into a zip archive, even if not seekable."""
+        output = io.BytesIO()
+        # Mimic a socket.
+        output.seek = output.tell = mock.Mock(side_effect=OSError)
+        with ZipSink(output) as sink:
+            self.render(sink)
+        with zipfile.ZipFile(io.BytesIO(output.getvalue())) as archive:
+            files = {name: archive.read(name) for name in archive.namelist()}
+            self.assertEqual(
+                archive.getinfo("run.sh").external_attr >> 16 & 0o777, 0o755
+            )
+        self.assertEqual(files, self.expected)
+
+    def test_templator_with_finalize(self):
+        """Test a template with a finalize.py can be rendered into an archive."""
+        template = self.tmpdir / "template"
+        shutil.copytree(self.fixture_dir / "test_template_2", template)
+        templator = Templator(
+            base_dir=self.tmpdir / "base",
+            template_location=str(template),
+            destination_dir=self.tmpdir,
+            no_input=True,
+        )
+        templator.generate_context()
+        sink = MemorySink()
+        templator.render(sink)
+        self.assertIn(".pytemplator.yml", sink.files)
+        self.assertIn("Directory/file2", sink.files)
+        # Removed by finalize.py
+        self.assertNotIn("Directory/test1", sink.files)
+        self.assertEqual(
+            sorted(path.name for path in self.tmpdir.iterdir()),
+            ["base", "template", "templates"],
+        )
+
+
+class StagedFileSystemSinkTestCase(TmpdirTestCase):
+    """TestCase for generating into a staging directory first."""
+
+    def setUp(self):
+        """Generate a project a first time."""
+        super().setUp()
+        self.output_dir = self.tmpdir / "output"
+        self.output_dir.mkdir()
+        with StagedFileSystemSink(self.output_dir, Manifest(self.output_dir)) as sink:
+            sink.write_text("project/same.txt", "Same")
+            sink.write_text("project/changed.txt", "1")
+            sink.commit()
+        for path in self.output_dir.rglob("*"):
+            os.utime(path, ns=(OLD_MTIME_NS, OLD_MTIME_NS))
+
+    def snapshot(self):
+        """Return the content of every file in the output directory."""
+        return {
+            path.relative_to(self.output_dir).as_posix(): path.read_bytes()
+            for path in self.output_dir.rglob("*")
+            if path.is_file() and STAGING_DIR_PREFIX not in str(path)
+        }
+
+    def test_commit(self):
+        """Test nothing is written until committed, then only changed files."""
+        before = self.snapshot()
+        with StagedFileSystemSink(self.output_dir, Manifest(self.output_dir)) as sink:
+            sink.write_text("project/same.txt", "Same")
+            sink.write_text("project/changed.txt", "2")
+            sink.write_text("docs/index.md", "New")
+            self.assertEqual(self.snapshot(), before)
+            sink.commit()
+        self.assertEqual(
+            {
+                path.relative_to(self.output_dir).as_posix()
+                for path in self.output_dir.rglob("*")
+                if path.stat().st_mtime_ns != OLD_MTIME_NS
+            },
+            {"docs", "docs/index.md", "project", "project/changed.txt", MANIFEST_FILE},
+        )
+        self.assertEqual((self.output_dir / "project" / "changed.txt").read_text(), "2")
+        self.assertEqual(list(self.output_dir.glob(f"{STAGING_DIR_PREFIX}*")), [])
+
+    def test_failed_generation(self):
+        """Test a failed generation leaves the destination untouched."""
+        before = self.snapshot()
+        template = self.tmpdir / "template"
+        (template / "templates" / "{{ name }}").mkdir(parents=True)
+        (template / "templates" / "{{ name }}" / "changed.txt").write_text("2")
+        (template / "cookiecutter.json").write_text('{"name": "project"}')
+        templator = Templator(
+            base_dir=self.tmpdir / "base",
+            template_location=str(template),
+            destination_dir=self.output_dir,
+            no_input=True,
+        )
+        templator.generate_context()
+        with mock.patch.object(
+            Templator, "add_pytemplator_yaml", side_effect=RuntimeError
+        ), self.assertRaises(RuntimeError):
+            templator.render()
+        self.assertEqual(self.snapshot(), before)
+        self.assertEqual(list(self.output_dir.glob(f"{STAGING_DIR_PREFIX}*")), [])
+
+    def test_abandoned_staging_dir(self):
+        """Test the staging directories of dead processes are removed."""
+        abandoned = self.output_dir / f"{STAGING_DIR_PREFIX}{2 ** 30}-abcd"
+        (abandoned / "project").mkdir(parents=True)
+        with StagedFileSystemSink(self.output_dir) as sink:
+            self.assertFalse(abandoned.exists())
+            self.assertTrue(sink.staging_dir.exists())
+
+    def test_full_tree(self):
+        """Test the whole output is staged, the files deleted from it get removed."""
+        with StagedFileSystemSink(
+            self.output_dir, Manifest(self.output_dir), full_tree=True
+        ) as sink:
+            sink.write_text("project/same.txt", "Same")
+            sink.write_text("project/changed.txt", "1")
+            self.assertEqual(
+                (sink.staging_dir / "project" / "same.txt").read_text(), "Same"
+            )
+            (sink.staging_dir / "project" / "changed.txt").unlink()
+            sink.commit()
+        self.assertEqual(self.snapshot().keys(), {"project/same.txt", MANIFEST_FILE})
+        self.assertEqual(
+            (self.output_dir / "project" / "same.txt").stat().st_mtime_ns,
+            OLD_MTIME_NS,
+        )
+        self.assertEqual(
+            Manifest(self.output_dir).previous.keys(), {"project/same.txt"}
+        )
+
+    def test_durable(self):
+        """Test the data is synced once, then each directory moved into."""
+        with mock.patch.object(sinks, "sync_filesystem") as sync, mock.patch.object(
+            sinks, "fsync_directory"
+        ) as fsync_directory:
+            with StagedFileSystemSink(
+                self.output_dir, Manifest(self.output_dir), durable=True
+            ) as sink:
+                sink.write_text("project/changed.txt", "2")
+                sink.write_text("project/nested/file.txt", "New")
+                sink.write_text("docs/index.md", "New")
+                sink.commit()
+        sync.assert_called_once_with(sink.staging_dir)
+        self.assertEqual(
+            [call.args[0] for call in fsync_directory.call_args_list],
+            [self.output_dir, self.output_dir / "project"],
+        )
+
+    def test_sync_filesystem(self):
+        """Test only the filesystem of the directory is synced, if syncfs is available."""
+        with mock.patch("os.sync") as sync:
+            sinks.sync_filesystem(self.output_dir)
+            syncfs = sinks._libc_syncfs()  # pylint: disable=protected-access
+            self.assertEqual(sync.called, syncfs is None)
+            with mock.patch.object(sinks, "_libc_syncfs", return_value=None):
+                sinks.sync_filesystem(self.output_dir)
+            sync.assert_called_with()
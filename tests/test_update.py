@@ -0,0 +1,145 @@
+"""Testcases for pytemplator.update module."""
+
+from pytemplator.pytemplator import Templator
+from pytemplator.update import read_pytemplator_yaml, update_project
+from tests.utils import TmpdirTestCase, git
+
+INITIALIZE = """
+def generate_context(no_input):
+    return {
+        "name": "project",
+        "author": "Jane",
+        "with_docker": False,
+        "with_docs": False,
+        "_include_if": {"{{ name }}/docs": "with_docs"},
+        "_copy_without_render": ["*/vendor.js", "project/*.min.js"],
+    }
+"""
+
+
+class UpdateProjectTestCase(TmpdirTestCase):
+    """TestCase for the function update_project."""
+
+    def setUp(self):
+        """Generate a project from a template in a git repo."""
+        super().setUp()
+        self.repo = self.tmpdir / "repo"
+        self.write_template(
+            {
+                "initialize.py": INITIALIZE,
+                "templates/{{ name }}/merged.txt": "one\ntwo\nthree\nfour\nfive\n",
+                "templates/{{ name }}/conflict.txt": "one\n",
+                "templates/{{ name }}/untouched.txt": "Same old\n",
+                "templates/{{ name }}/removed.txt": "Removed\n",
+                "templates/{{ name }}/author.txt": "By {{ author }}\n",
+                "templates/{{ name }}/docs/index.md": "Docs by {{ author }}\n",
+                "templates/{{ name }}/vendor.js": "{% weird {{ author }}\n",
+                "templates/{{ name }}/app.min.js": "{% weird {{ author }}\n",
+            }
+        )
+        git("init", "--quiet", "--initial-branch=main", cwd=self.repo)
+        self.commit()
+        self.project_dir = self.tmpdir / "project"
+        self.project_dir.mkdir()
+        templator = Templator(
+            base_dir=self.tmpdir / "base",
+            template_location=f"file://{self.repo}",
+            destination_dir=self.project_dir,
+            no_input=True,
+        )
+        templator.generate_context()
+        templator.render()
+        self.generated = self.project_dir / "project"
+
+    def write_template(self, files):
+        """Write the given files into the template repo."""
+        for name, content in files.items():
+            path = self.repo / name
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(content)
+
+    def commit(self):
+        """Commit the changes of the template repo."""
+        git("add", "--all", cwd=self.repo)
+        git("commit", "--quiet", "--message=Change", cwd=self.repo)
+        return git("rev-parse", "HEAD", cwd=self.repo)
+
+    def update(self, **kwargs):
+        """Update the generated project."""
+        return update_project(
+            self.project_dir, base_dir=self.tmpdir / "base", no_input=True, **kwargs
+        )
+
+    def test_update_merges_template_changes(self):
+        """Test template changes are merged, keeping local edits."""
+        (self.generated / "merged.txt").write_text("one\ntwo\nthree\nfour\nFIVE\n")
+        (self.generated / "conflict.txt").write_text("local\n")
+        self.write_template(
+            {
+                "templates/{{ name }}/merged.txt": "ONE\ntwo\nthree\nfour\nfive\n",
+                "templates/{{ name }}/conflict.txt": "template\n",
+                "templates/{{ name }}/added.txt": "Added by {{ author }}\n",
+            }
+        )
+        (self.repo / "templates" / "{{ name }}" / "removed.txt").unlink()
+        new_commit = self.commit()
+        (self.generated / "untouched.txt").write_text("Local edit\n")
+
+        report = self.update()
+        self.assertEqual(report.updated, ["project/added.txt"])
+        self.assertEqual(report.merged, ["project/merged.txt"])
+        self.assertEqual(report.conflicts, ["project/conflict.txt"])
+        self.assertEqual(report.deleted, ["project/removed.txt"])
+        self.assertEqual(
+            (self.generated / "merged.txt").read_text(),
+            "ONE\ntwo\nthree\nfour\nFIVE\n",
+        )
+        self.assertIn("<<<<<<<", (self.generated / "conflict.txt").read_text())
+        self.assertEqual((self.generated / "added.txt").read_text(), "Added by Jane\n")
+        self.assertFalse((self.generated / "removed.txt").exists())
+        # Files whose template didn't change are not rendered again.
+        self.assertEqual((self.generated / "untouched.txt").read_text(), "Local edit\n")
+        self.assertEqual(
+            read_pytemplator_yaml(self.project_dir)["template_commit"], new_commit
+        )
+
+    def test_update_changed_context_keys(self):
+        """Test the files depending on a changed context key are rendered again."""
+        (self.generated / "untouched.txt").write_text("Local edit\n")
+        report = self.update(context_overrides={"author": "John"})
+        self.assertEqual(report.updated, ["project/author.txt"])
+        self.assertEqual((self.generated / "author.txt").read_text(), "By John\n")
+        for name in ("vendor.js", "app.min.js"):
+            self.assertEqual(
+                (self.generated / name).read_text(), "{% weird {{ author }}\n"
+            )
+        self.assertEqual((self.generated / "untouched.txt").read_text(), "Local edit\n")
+        self.assertEqual(
+            read_pytemplator_yaml(self.project_dir)["context"]["author"], "John"
+        )
+
+    def test_update_skips_excluded_files(self):
+        """Test the files left out of the generation are left out of the update."""
+        self.write_template(
+            {
+                "templates/{{ name }}/{% if with_docker %}docker{% endif %}/compose.yml": "",
+                "templates/{% if with_docker %}docker{% endif %}/compose.yml": "",
+                "templates/{{ name }}/docs/api.md": "API\n",
+            }
+        )
+        self.commit()
+        report = self.update()
+        self.assertEqual(report, ([], [], [], [], []))
+        self.assertFalse((self.generated / "compose.yml").exists())
+        self.assertFalse((self.generated / "docs").exists())
+        self.assertFalse((self.tmpdir / "compose.yml").exists())
+
+    def test_update_toggled_subtrees(self):
+        """Test the subtrees a changed key includes are generated."""
+        report = self.update(context_overrides={"with_docs": True})
+        self.assertEqual(report.updated, ["project/docs/index.md"])
+        self.assertEqual(
+            (self.generated / "docs" / "index.md").read_text(), "Docs by Jane\n"
+        )
+        report = self.update(context_overrides={"with_docs": False})
+        self.assertEqual(report.deleted, ["project/docs/index.md"])
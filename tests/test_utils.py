@@ -1,11 +1,28 @@
 """Testcases for pytemplator.utils modules."""
 
 import builtins
+import os
+import shutil
+import tracemalloc
 from unittest import mock
 
-from pytemplator.exceptions import UserCancellationError
-from pytemplator.utils import check_if_new_dirs_can_be_created
-from tests.utils import TmpdirTestCase
+from jinja2 import TemplateSyntaxError
+
+from pytemplator import utils
+from pytemplator.exceptions import BrokenTemplateError, UserCancellationError
+from pytemplator.manifest import Manifest
+from pytemplator.pytemplator import Templator
+from pytemplator.utils import (
+    Context,
+    Question,
+    TemplateCache,
+    TemplateIndex,
+    check_if_new_dirs_can_be_created,
+    generate_context_from_questions,
+    make_jinja_env,
+    render_templates,
+)
+from tests.utils import TmpdirTestCase, are_identical_dirs
 
 
 class CheckNewDirsCanBeCreatedTestCase(TmpdirTestCase):
@@ -54,3 +71,477 @@ class CheckNewDirsCanBeCreatedTestCase(TmpdirTestCase):
                     destination_dir=self.tmpdir,
                     no_input=False,
                 )
+
+    def test_directories_in_the_manifest_are_updated(self):
+        """Test only the dirs holding files of the previous generation are kept."""
+        for name in ("dir42", "other42"):
+            (self.tmpdir / name).mkdir()
+            (self.tmpdir / name / "notes.txt").write_text("mine")
+        (self.tmpdir / "dir42" / "generated.txt").write_text("generated")
+        manifest = Manifest(self.tmpdir)
+        manifest.record(self.tmpdir / "dir42" / "generated.txt", "digest")
+        manifest.save()
+        with mock.patch.object(utils, "logger") as logger:
+            check_if_new_dirs_can_be_created(
+                directories=[
+                    self.tmpdir / "dir{{solution}}",
+                    self.tmpdir / "other{{solution}}",
+                ],
+                context={"solution": 42},
+                destination_dir=self.tmpdir,
+                no_input=True,
+                manifest=Manifest(self.tmpdir),
+            )
+        self.assertTrue((self.tmpdir / "dir42" / "notes.txt").is_file())
+        self.assertFalse((self.tmpdir / "other42").exists())
+        (updated,), (overwritten,) = (
+            call.args for call in logger.warning.call_args_list
+        )
+        self.assertIn("updated in place", updated)
+        self.assertIn("dir42", updated)
+        self.assertNotIn("other42", updated)
+        self.assertIn("overwritten", overwritten)
+        self.assertIn("other42", overwritten)
+
+
+class TemplateCacheTestCase(TmpdirTestCase):
+    """TestCase for the TemplateCache."""
+
+    def test_sources_are_compiled_once(self):
+        """Test the same source string always yields the same template."""
+        cache = TemplateCache()
+        template = cache.get("{{ solution }}")
+        self.assertIs(cache.get("{{ solution }}"), template)
+        self.assertEqual(template.render(solution=42), "42")
+
+    def test_plain_paths_skip_jinja(self):
+        """Test paths with no Jinja markers are returned without compiling."""
+        cache = TemplateCache()
+        with mock.patch.object(cache, "get") as mocked_get:
+            self.assertEqual(
+                cache.render_path("some/plain/path", {}), "some/plain/path"
+            )
+        mocked_get.assert_not_called()
+
+    def test_render_path_by_segment(self):
+        """Test the templated segments of a path are rendered and shared."""
+        cache = TemplateCache()
+        context = {"name": "foo", "a": 6, "b": 3}
+        self.assertEqual(
+            cache.render_path("{{ name }}/src/{{ name }}/{{ name }}.py", context),
+            "foo/src/foo/foo.py",
+        )
+        self.assertEqual(len(cache._templates), 2)  # pylint: disable=protected-access
+        # A tag spanning several segments is rendered as a whole.
+        self.assertEqual(cache.render_path("dir/{{ a/b }}", context), "dir/2.0")
+
+
+class RenderTemplatesTestCase(TmpdirTestCase):
+    """TestCase for the function render_templates."""
+
+    context = {
+        "main_folder_name": "Directory",
+        "nested_folder": "My_Nested_Folder",
+        "pytemplator": {"main_file_name": "test1", "second_file": "file2"},
+    }
+
+    def render(self, output_name, context=None, jobs=1, templates=None):
+        """Render the templates into a new output directory."""
+        templates = templates or self.fixture_dir / "test_template_1" / "templates"
+        output_dir = self.tmpdir / output_name
+        output_dir.mkdir()
+        render_templates(
+            templates=templates,
+            root_directories=[],
+            context=context or self.context,
+            destination_dir=output_dir,
+            no_input=True,
+            jobs=jobs,
+        )
+        return output_dir
+
+    def test_parallel_rendering_is_identical(self):
+        """Test rendering in processes gives the same output as serially."""
+        self.assertTrue(
+            are_identical_dirs(self.render("serial"), self.render("parallel", jobs=2))
+        )
+
+    def test_parallel_rendering_unpicklable_context(self):
+        """Test rendering falls back to threads if the context can't be pickled."""
+        context = dict(self.context, unpicklable=lambda: None)
+        self.assertTrue(
+            are_identical_dirs(
+                self.render("serial"), self.render("parallel", context, jobs=2)
+            )
+        )
+
+    def test_parallel_rendering_errors_are_deterministic(self):
+        """Test the error raised is always that of the first broken template."""
+        templates = self.tmpdir / "templates"
+        templates.mkdir()
+        for index in range(20):
+            (templates / f"file_{index:02}").write_text(
+                "{{ broken" if index in (7, 13) else "{{ fine }}", encoding="UTF-8"
+            )
+        for run in range(3):
+            with self.assertRaises(TemplateSyntaxError) as error:
+                self.render(f"output_{run}", jobs=4, templates=templates)
+            self.assertEqual(error.exception.name, "file_07")
+
+    def test_copy_without_render(self):
+        """Test files matching `_copy_without_render` are copied verbatim."""
+        templates = self.tmpdir / "templates"
+        (templates / "{{ name }}" / "static").mkdir(parents=True)
+        (templates / "{{ name }}" / "static" / "bundle.min.js").write_bytes(
+            b"{{ not_rendered }}\x00\xff"
+        )
+        (templates / "{{ name }}" / "static" / "bundle.min.js").chmod(0o751)
+        (templates / "{{ name }}" / "run.sh").write_text("{{ name }}")
+        context = {"name": "project", "_copy_without_render": ["*/static/*.js"]}
+        for jobs in (1, 2):
+            output_dir = self.render(f"output_{jobs}", context, jobs, templates)
+            copied = output_dir / "project" / "static" / "bundle.min.js"
+            self.assertEqual(copied.read_bytes(), b"{{ not_rendered }}\x00\xff")
+            self.assertEqual(os.stat(copied).st_mode & 0o777, 0o751)
+            self.assertEqual((output_dir / "project" / "run.sh").read_text(), "project")
+
+    def test_copy_without_render_from_cookiecutter_json(self):
+        """Test the settings of a cookiecutter.json are kept as lists, not rendered."""
+        templates = self.tmpdir / "templates"
+        (templates / "{{ name }}").mkdir(parents=True)
+        (templates / "{{ name }}" / "vendor.js").write_text("{{ raw }}")
+        (templates / "{{ name }}" / "f.txt").write_text("{{ flavour }}")
+        context = generate_context_from_questions(
+            {
+                "name": "proj",
+                "flavour": "{{ name }}-a",
+                "count": 3,
+                "_copy_without_render": ["*/vendor.js"],
+            },
+            {"pytemplator": {}, "cookiecutter": {}},
+            no_input=True,
+        )
+        self.assertEqual(context["_copy_without_render"], ["*/vendor.js"])
+        self.assertEqual(context["count"], 3)
+        output_dir = self.render("output", context, templates=templates)
+        self.assertEqual((output_dir / "proj" / "f.txt").read_text(), "proj-a")
+        self.assertEqual((output_dir / "proj" / "vendor.js").read_text(), "{{ raw }}")
+        with self.assertRaises(BrokenTemplateError):
+            self.render("string", {"name": "proj", "_copy_without_render": "*.js"})
+
+    def test_binary_files_are_copied(self):
+        """Test binary files are copied as-is instead of crashing Jinja."""
+        templates = self.tmpdir / "templates"
+        (templates / "{{ name }}").mkdir(parents=True)
+        image = b"\x89PNG\r\n\x1a\n\x00{{ name }}\xff"
+        (templates / "{{ name }}" / "{{ name }}.png").write_bytes(image)
+        # Invalid UTF-8 beyond the sniffed prefix is detected when rendering.
+        late_binary = b"{{ name }}" * 1000 + b"\xff"
+        (templates / "{{ name }}" / "late.bin").write_bytes(late_binary)
+        for jobs in (1, 2):
+            output_dir = self.render(f"output_{jobs}", {"name": "foo"}, jobs, templates)
+            self.assertEqual((output_dir / "foo" / "foo.png").read_bytes(), image)
+            self.assertEqual(
+                (output_dir / "foo" / "late.bin").read_bytes(), late_binary
+            )
+
+    @mock.patch.object(utils, "STREAMING_THRESHOLD", 64 * 1024)
+    def test_large_outputs_are_streamed(self):
+        """Test memory stays flat when rendering a large output."""
+        templates = self.tmpdir / "templates"
+        templates.mkdir()
+        (templates / "seed.sql").write_text(
+            "{% for i in range(100000) %}INSERT INTO t VALUES ({{ i }}, '{{ name }}');\n"
+            "{% endfor %}"
+        )
+        expected = "".join(
+            f"INSERT INTO t VALUES ({i}, 'foo');\n" for i in range(100000)
+        )
+        self.assertGreater(len(expected), 3 * 1024 * 1024)
+        tracemalloc.start()
+        try:
+            output_dir = self.render("serial", {"name": "foo"}, templates=templates)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        self.assertLess(peak, 1024 * 1024)
+        self.assertEqual((output_dir / "seed.sql").read_text(), expected)
+        output_dir = self.render("parallel", {"name": "foo"}, 2, templates)
+        self.assertEqual((output_dir / "seed.sql").read_text(), expected)
+
+
+class ContextTestCase(TmpdirTestCase):
+    """TestCase for resolving the questions of a Context."""
+
+    def test_defaults_are_evaluated_once(self):
+        """Test a callable default is called once, whether asked or not."""
+        for no_input in (True, False):
+            with self.subTest(no_input=no_input):
+                default = mock.Mock(return_value="value")
+                context = Context([Question("key", default=default)])
+                with mock.patch.object(builtins, "input", return_value=""):
+                    context.resolve(no_input)
+                self.assertEqual(context.as_dict(), {"key": "value"})
+                default.assert_called_once_with()
+
+    def test_defaults_referring_to_later_keys(self):
+        """Test the questions a default refers to are resolved first."""
+        context = Context()
+        context.questions = [
+            Question("pypi_name", default=lambda: context["name"].lower()),
+            Question("name", default="Project"),
+            Question("module", default=lambda: context["pypi_name"].replace("-", "_")),
+        ]
+        context.resolve(no_input=True)
+        self.assertEqual(
+            context.as_dict(),
+            {"pypi_name": "project", "name": "Project", "module": "project"},
+        )
+        self.assertEqual(
+            context.dependencies,
+            {"pypi_name": {"name"}, "name": set(), "module": {"pypi_name"}},
+        )
+
+    def test_circular_defaults(self):
+        """Test defaults referring to each other are reported."""
+        context = Context()
+        context.questions = [
+            Question("first", default=lambda: context["second"]),
+            Question("second", default=lambda: context["first"]),
+        ]
+        with self.assertRaises(BrokenTemplateError):
+            context.resolve(no_input=True)
+
+    def test_unreferenced_questions_are_skipped(self):
+        """Test the hidden questions no template refers to are never evaluated."""
+        unused = mock.Mock(return_value="unused")
+        context = Context(skip_unreferenced=True)
+        context.questions = [
+            Question("unused", ask=False, default=unused),
+            Question("indirect", ask=False, default=lambda: "indirect"),
+            Question("used", ask=False, default=lambda: context["indirect"] + "!"),
+            Question("_setting", ask=False, default=lambda: ["*.png"]),
+            Question("asked", default=lambda: "asked"),
+        ]
+        token = utils.REFERENCED_KEYS.set(lambda: {"used", "asked"})
+        try:
+            context.resolve(no_input=True)
+        finally:
+            utils.REFERENCED_KEYS.reset(token)
+        self.assertEqual(
+            context.as_dict(),
+            {
+                "indirect": "indirect",
+                "used": "indirect!",
+                "_setting": ["*.png"],
+                "asked": "asked",
+            },
+        )
+        unused.assert_not_called()
+
+    def test_questions_are_not_skipped_by_default(self):
+        """Test skipping the unreferenced questions is opt-in."""
+        context = Context([Question("slug", ask=False, default=lambda: "slug")])
+        token = utils.REFERENCED_KEYS.set(set)
+        try:
+            context.resolve(no_input=True)
+        finally:
+            utils.REFERENCED_KEYS.reset(token)
+        self.assertEqual(context.as_dict(), {"slug": "slug"})
+
+    def test_invalid_jinja_files_refer_to_any_key(self):
+        """Test nothing is skipped if a file, e.g. copied without rendering, isn't Jinja."""
+        template = self.tmpdir / "template"
+        project = template / "templates" / "{{ name }}"
+        project.mkdir(parents=True)
+        (project / "app.js").write_text("{{#each items}}{{this}}{{/each}}")
+        (template / "initialize.py").write_text(
+            "from pytemplator.utils import Context, Question\n\n\n"
+            "def generate_context(no_input):\n"
+            "    context = Context(skip_unreferenced=True)\n"
+            "    context.questions = [\n"
+            "        Question('name', default='project'),\n"
+            "        Question('_copy_without_render', ask=False, default=['*.js']),\n"
+            "        Question('unused', ask=False, default=lambda: 'Unused'),\n"
+            "    ]\n"
+            "    context.resolve(no_input)\n"
+            "    return context.as_dict()\n"
+        )
+        output_dir = self.tmpdir / "output"
+        output_dir.mkdir()
+        templator = Templator(
+            base_dir=self.tmpdir / "base",
+            template_location=str(template),
+            destination_dir=output_dir,
+            no_input=True,
+        )
+        templator.generate_context()
+        self.assertIsNone(templator.referenced_keys)
+        self.assertEqual(templator.context["unused"], "Unused")
+        templator.render()
+        self.assertEqual(
+            (output_dir / "project" / "app.js").read_text(),
+            "{{#each items}}{{this}}{{/each}}",
+        )
+
+    def test_include_if_keys_are_not_skipped(self):
+        """Test the keys read by the `_include_if` rules count as referenced."""
+        unused = mock.Mock(return_value="unused")
+        context = Context(skip_unreferenced=True)
+        context.questions = [
+            Question("with_docs", ask=False, default=lambda: True),
+            Question("unused", ask=False, default=unused),
+            Question(
+                "_include_if", ask=False, default={"{{ name }}/docs": "with_docs"}
+            ),
+        ]
+        token = utils.REFERENCED_KEYS.set(set)
+        try:
+            context.resolve(no_input=True)
+        finally:
+            utils.REFERENCED_KEYS.reset(token)
+        self.assertTrue(context.as_dict()["with_docs"])
+        self.assertNotIn("unused", context.as_dict())
+        unused.assert_not_called()
+
+    def test_templator_skips_unreferenced_questions(self):
+        """Test the Templator tells which keys the templates refer to."""
+        template = self.tmpdir / "template"
+        (template / "templates" / "{{ name }}").mkdir(parents=True)
+        (template / "templates" / "{{ name }}" / "README").write_text("{{ title }}")
+        (template / "initialize.py").write_text(
+            "from pytemplator.utils import Context, Question\n\n\n"
+            "def generate_context(no_input):\n"
+            "    context = Context(skip_unreferenced=True)\n"
+            "    context.questions = [\n"
+            "        Question('name', default='project'),\n"
+            "        Question('title', ask=False, default=lambda: 'Title'),\n"
+            "        Question('unused', ask=False, default=lambda: 'Unused'),\n"
+            "    ]\n"
+            "    context.resolve(no_input)\n"
+            "    return context.as_dict()\n"
+        )
+        for finalize in (False, True):
+            with self.subTest(finalize=finalize):
+                if finalize:
+                    (template / "finalize.py").write_text(
+                        "def finalize(context, output_dir):\n    pass\n"
+                    )
+                templator = Templator(
+                    base_dir=self.tmpdir / "base",
+                    template_location=str(template),
+                    destination_dir=self.tmpdir,
+                    no_input=True,
+                )
+                templator.generate_context()
+                self.assertEqual(templator.context.get("title"), "Title")
+                self.assertEqual("unused" in templator.context, finalize)
+
+
+class TemplateSelectionTestCase(TmpdirTestCase):
+    """TestCase for leaving out the optional parts of a template."""
+
+    def setUp(self):
+        """Write a template with optional docs, CI and Docker files."""
+        super().setUp()
+        self.templates = self.tmpdir / "templates"
+        project = self.templates / "{{ name }}"
+        for path, content in {
+            "README": "{{ name }}",
+            "docs/index.md": "{{ title }}",
+            "docs/{{ name }}/api.md": "API",
+            "ci.yml": "{{ ci }}",
+            "{% if docker %}docker{% endif %}/Dockerfile": "FROM {{ image }}",
+        }.items():
+            (project / path).parent.mkdir(parents=True, exist_ok=True)
+            (project / path).write_text(content)
+        self.output_dir = self.tmpdir / "output"
+        self.output_dir.mkdir()
+
+    def render(self, **context):
+        """Render the template, return the rendered files and the paths rendered."""
+        template_cache = TemplateCache(make_jinja_env(self.templates))
+        with mock.patch.object(
+            template_cache, "render_path", wraps=template_cache.render_path
+        ) as render_path:
+            render_templates(
+                templates=self.templates,
+                root_directories=[self.templates / "{{ name }}"],
+                context={
+                    "name": "project",
+                    "_include_if": {"{{ name }}/docs": "with_docs", "*.yml": "ci"},
+                    **context,
+                },
+                destination_dir=self.output_dir,
+                no_input=True,
+                template_cache=template_cache,
+            )
+        return (
+            sorted(
+                path.relative_to(self.output_dir).as_posix()
+                for path in self.output_dir.rglob("*")
+                if path.is_file()
+            ),
+            {call.args[0] for call in render_path.call_args_list},
+        )
+
+    def test_subtrees_are_pruned(self):
+        """Test the excluded subtrees are never rendered, not even their paths."""
+        files, rendered_paths = self.render(with_docs=False, ci=None, docker=False)
+        self.assertEqual(files, ["project/README"])
+        self.assertFalse(any("docs" in path for path in rendered_paths))
+
+    def test_subtrees_are_included(self):
+        """Test the subtrees are rendered when their condition holds."""
+        files, _ = self.render(with_docs=True, ci="github", docker=True)
+        self.assertEqual(
+            files,
+            [
+                "project/README",
+                "project/ci.yml",
+                "project/docker/Dockerfile",
+                "project/docs/index.md",
+                "project/docs/project/api.md",
+            ],
+        )
+
+    def test_include_if_with_skipped_questions(self):
+        """Test a hidden question only read by an `_include_if` rule is still answered."""
+        template = self.tmpdir / "template"
+        shutil.copytree(self.templates, template / "templates")
+        (template / "initialize.py").write_text(
+            "from pytemplator.utils import Context, Question\n\n\n"
+            "def generate_context(no_input):\n"
+            "    context = Context(skip_unreferenced=True)\n"
+            "    context.questions = [\n"
+            "        Question('name', default='project'),\n"
+            "        Question('with_docs', ask=False, default=lambda: True),\n"
+            "        Question('_include_if', ask=False, default={\n"
+            "            '{{ name }}/docs': 'with_docs', '{{ name }}/ci.yml': 'False',\n"
+            "        }),\n"
+            "    ]\n"
+            "    context.resolve(no_input)\n"
+            "    return context.as_dict()\n"
+        )
+        templator = Templator(
+            base_dir=self.tmpdir / "base",
+            template_location=str(template),
+            destination_dir=self.output_dir,
+            no_input=True,
+        )
+        templator.generate_context()
+        templator.render()
+        self.assertTrue((self.output_dir / "project" / "docs" / "index.md").is_file())
+
+    def test_index(self):
+        """Test the index tells which keys each file refers to."""
+        jinja_env = make_jinja_env(self.templates)
+        index = TemplateIndex(self.templates, jinja_env)
+        self.assertEqual(
+            [name for name, keys in index.files.items() if "title" in keys],
+            ["{{ name }}/docs/index.md"],
+        )
+        self.assertEqual(
+            len([name for name, keys in index.files.items() if "name" in keys]), 5
+        )
+        self.assertEqual(index.keys(), {"name", "title", "ci", "docker", "image"})
@@ -1,6 +1,8 @@
 """Utility scripts used for the tests."""
 
 import filecmp
+import shutil
+import subprocess
 import tempfile
 from pathlib import Path
 from unittest import TestCase
@@ -31,6 +33,26 @@ def are_identical_dirs(dir1: Path, dir2: Path) -> bool:
     return True
 
 
+def git(*args, cwd):
+    """Run a git command as a test user and return its output."""
+    return subprocess.run(
+        ["git", "-c", "user.name=Test", "-c", "user.email=test@example.com", *args],
+        cwd=cwd,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout.strip()
+
+
+def make_git_repo(source: Path, repo: Path) -> Path:
+    """Create a git repo at `repo`, committing the content of `source` on main."""
+    shutil.copytree(source, repo)
+    git("init", "--quiet", "--initial-branch=main", cwd=repo)
+    git("add", "--all", cwd=repo)
+    git("commit", "--quiet", "--message=Initial commit", cwd=repo)
+    return repo
+
+
 class TmpdirTestCase(TestCase):
     """TestCase setting automatically a temporary directory."""
 